@@ -1,30 +1,45 @@
 # Imports of built-in libraries
 import sys
 import getopt
-from os import environ
-from json import load
-from random import choice
-from re import split
+import json
+import hashlib
+from os import environ, path, makedirs
+from functools import partial
 # This will stop tensorflow from spamming unnecessary error messages about its GPU implementation
 # Needs to set before we import anything from keras/tensorflow
 environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
-# Import data interpreter and model classes
-from data_interpreter import DataInterpreter
-from nn_model import NNModel
-# Import keras libraries
-from keras.preprocessing.text import tokenizer_from_json
-from keras.preprocessing.sequence import pad_sequences
-# Import matplotlib
-import matplotlib.pyplot as plt
+# The data interpreter, samplers, numpy and matplotlib are imported once they are needed, and model classes by
+# load_model for the selected backend, so -l and redrawing plots that didn't change stay fast
+from instrumentation import enable_tracing, traced, TRACER, TRACE_ENV
+# Import the tokenizer, it needs neither keras nor tensorflow
+from fast_tokenizer import FastTokenizer
 
 
 def print_help():
     print("Usage:")
-    print("python accuracy_assessment.py -n <num_words> -d <max_distance> -t <tests>")
+    print("python accuracy_assessment.py -n <num_words> -d <max_distance> -t <tests> [-s <seed>] [-c <chunk_size>]"
+          " [-b <backend>] [-w <workers>]")
+    print("       [-e <rel_error>] [--ciwidth <width>] [--confidence <level>] [--plotonly] [--trace <file>]")
     print("Where")
     print("<num_words> is the number of words to assess from tokenizer word_index (sorted by most common)")
     print("<max_distance> is the largest distance to check between words and should be an integer number")
     print("<tests> is the number of tests to perform with random sequences of words")
+    print("<seed> optionally seeds the random sequences so results can be reproduced")
+    print("<chunk_size> is the number of random sequences scored per model call (default 4096)")
+    print("<backend> is keras (default), numpy, quantized or count, numpy scores sequences without loading tensorflow")
+    print("          and quantized does so from the smaller %s, see quantized_model.py" % QUANTIZED_PATH)
+    print("          count uses the word gaps counted in the training files by count_model.py instead of the model")
+    print("<workers> runs the simulations and plots on a pool of worker processes that each load the model once")
+    print("          results only depend on the seed, not on the number of workers")
+    print("Adaptive mode, sample each distance until the confidence interval of every assessed word is precise enough:")
+    print("-e <rel_error> stops when the interval half widths are below <rel_error> times the estimates")
+    print("--ciwidth <width> stops when the full intervals are narrower than <width>")
+    print("--confidence <level> is the confidence level of the intervals (default 0.95)")
+    print("<tests> is then the largest number of tests per distance (default 1000000)")
+    print("Results are kept in cache/results.sqlite, reruns only simulate the random sequences that are missing")
+    print("--plotonly redraws the plots from the stored results without loading the model")
+    print("--trace <file> writes a timing trace of the run to <file> and prints a summary, as does setting %s=<file>"
+          % TRACE_ENV)
     print("To obtain the word list, try:")
     print("python testing.py -l")
     print("To obtain the word list, try:")
@@ -35,18 +50,49 @@ def word_list():
     print(load_tokenizer().word_index.keys())
 
 
-# Load the tokenizer used during training from a json
+# Model and tokenizer produced by training.py
+MODEL_PATH = "./model_51_file_training.h5"
+# Quantized artifact exported from the model by quantized_model.py, used by the quantized backend
+QUANTIZED_PATH = "./model_51_file_training.qmodel"
+# Gap and n-gram counts of the training files written by count_model.py, used by the count backend
+COUNT_PATH = "./count_model.npz"
+TOKENIZER_PATH = "./tokenizer_51_file_training.vocab"
+# File identifying the results of each backend in the result store, the keras and numpy backends share their results
+STORE_PATHS = {"keras": MODEL_PATH, "numpy": MODEL_PATH, "quantized": QUANTIZED_PATH, "count": COUNT_PATH}
+# Gap counts of the testing data, see testdata_probability_table
+TESTDATA_CACHE = "./cache/testdata_gaps.npz"
+# Digest of the data of every plot when it was last drawn, see plots_to_draw
+PLOT_DIGESTS = "./cache/plot_digests.json"
+
+
+# Load the tokenizer used during training from its binary vocabulary file
 def load_tokenizer():
-    with open('./tokenizer_51_file_training.json') as jsonf:
-        data = load(jsonf)
-        tokenizer = tokenizer_from_json(data)
-    return tokenizer
+    return FastTokenizer.load(TOKENIZER_PATH)
 
 
 # Load the model used during training
-def load_model():
+# The keras backend is the trained NNModel, the numpy backend runs the same forward pass without importing tensorflow
+# and the quantized backend runs it on the memory-mapped artifact written by quantized_model.py
+# The count backend measures P(W|d) from the training files instead of using the network
+def load_model(backend="keras"):
+    if backend == "count":
+        from count_model import CountModel
+        model = CountModel()
+        model.load_model(COUNT_PATH)
+        return model
+    if backend == "numpy":
+        from numpy_model import NumpyModel
+        model = NumpyModel()
+        model.load_model(MODEL_PATH)
+        return model
+    if backend == "quantized":
+        from quantized_model import QuantizedModel
+        model = QuantizedModel()
+        model.load_model(QUANTIZED_PATH)
+        return model
+    from nn_model import NNModel
     model = NNModel()
-    model.load_model("./model_51_file_training.h5")
+    model.load_model(MODEL_PATH)
     print(model.model.summary())
     return model
 
@@ -54,7 +100,10 @@ def load_model():
 def main():
     # Retrieve arguments, print help() if that fails
     try:
-        opts, args = getopt.getopt(sys.argv[1:], "hln:d:t:", ["help", "list", "numwords=", "maxdistance=", "tests="])
+        opts, args = getopt.getopt(sys.argv[1:], "hln:d:t:s:c:b:w:e:",
+                                   ["help", "list", "numwords=", "maxdistance=", "tests=", "seed=", "chunksize=",
+                                    "backend=", "workers=", "relerror=", "ciwidth=", "confidence=", "plotonly",
+                                    "trace="])
     except getopt.GetoptError:
         print_help()
         sys.exit(2)
@@ -62,6 +111,15 @@ def main():
     min_d = 3
     max_d = None
     num_tests = None
+    seed = None
+    chunk_size = 4096
+    backend = "keras"
+    workers = None
+    rel_error = None
+    ci_width = None
+    confidence = 0.95
+    trace_path = None
+    plot_only = False
     for opt, arg in opts:
         if opt in ("-h", "--help"):
             print_help()
@@ -90,67 +148,209 @@ def main():
                 print("--tests %s couldn't be converted to an int. \n" % arg)
                 print_help()
                 sys.exit(2)
+        elif opt in ("-s", "--seed"):
+            try:
+                seed = int(arg)
+            except ValueError:
+                print("--seed %s couldn't be converted to an int. \n" % arg)
+                print_help()
+                sys.exit(2)
+        elif opt in ("-c", "--chunksize"):
+            try:
+                chunk_size = int(arg)
+            except ValueError:
+                print("--chunksize %s couldn't be converted to an int. \n" % arg)
+                print_help()
+                sys.exit(2)
+        elif opt in ("-b", "--backend"):
+            if arg not in ("keras", "numpy", "quantized", "count"):
+                print("--backend %s should be keras, numpy, quantized or count. \n" % arg)
+                print_help()
+                sys.exit(2)
+            backend = arg
+        elif opt in ("-w", "--workers"):
+            try:
+                workers = int(arg)
+            except ValueError:
+                print("--workers %s couldn't be converted to an int. \n" % arg)
+                print_help()
+                sys.exit(2)
+        elif opt in ("-e", "--relerror", "--ciwidth", "--confidence"):
+            try:
+                value = float(arg)
+            except ValueError:
+                print("%s %s couldn't be converted to a float. \n" % (opt, arg))
+                print_help()
+                sys.exit(2)
+            if opt in ("-e", "--relerror"):
+                rel_error = value
+            elif opt == "--ciwidth":
+                ci_width = value
+            else:
+                confidence = value
+        elif opt == "--trace":
+            trace_path = arg
+        elif opt == "--plotonly":
+            plot_only = True
+    # Time the run if --trace or the LV_TRACE environment variable was given
+    enable_tracing(trace_path)
 
     # Load the tokenizer and get a list of the words used for training
     tokenizer = load_tokenizer()
     sorted_word_counts = sorted(tokenizer.word_counts.items(), key=lambda x: x[1], reverse=True)[:tokenizer.num_words]
-    sorted_words = [x[0] for x in sorted_word_counts]
+    testdata_probabilities = testdata_probability_table(tokenizer, min_d, max_d)
+
+    # The model's average output vector per distance holds P(W|d) for every word at once
+    # Random sequences are drawn from the full word list, including the words being assessed
+    # Finished chunks of random sequences are kept in the result store, so only what is missing gets simulated
+    distances = [x for x in range(min_d, max_d)]
+    if backend == "count":
+        # Longer random sequences would be cut to the distances the count model counted, check before sampling
+        try:
+            load_model(backend).check_distance(max_d - 1)
+        except ValueError as error:
+            print("%s, use another backend or a smaller -d. \n" % error)
+            print_help()
+            sys.exit(2)
+    from parallel_sampler import ParallelSampler
+    from result_store import ResultStore
+    store = ResultStore(STORE_PATHS[backend], TOKENIZER_PATH)
+    sampler = ParallelSampler(partial(load_model, backend), tokenizer, workers or 1, chunk_size=chunk_size, seed=seed,
+                              store=store)
+    word_indices = [tokenizer.word_index[word[0]] for word in sorted_word_counts[:num_words]]
+    adaptive = rel_error is not None or ci_width is not None
+    if plot_only:
+        # Use whatever the store holds, without loading the model
+        moments_table = {dist: store.moments(sampler.entropy, sampler.tests_per_task, dist, num_tests)
+                         for dist in distances}
+        for dist in [dist for dist, moments in moments_table.items() if moments is None]:
+            print("No stored results for distance %d, it won't be plotted" % dist)
+        distances = [dist for dist in distances if moments_table[dist] is not None]
+        moments_table = {dist: moments_table[dist] for dist in distances}
+        if not distances:
+            print("Nothing to plot, run without --plotonly first")
+            sys.exit(2)
+        for dist in distances:
+            print("Distance %d: %d stored tests" % (dist, moments_table[dist].count))
+    elif adaptive:
+        # Sample every distance until the interval of each assessed word meets the target
+        from adaptive_estimator import PrecisionTarget
+        target = PrecisionTarget(rel_error, ci_width, confidence, max_tests=num_tests or 1000000,
+                                 min_tests=min(chunk_size, 1000))
+        print("Simulating random sequences until %s" % target.describe())
+        moments_table = sampler.adaptive_moments_table(distances, target, word_indices)
+        for dist in distances:
+            moments = moments_table[dist]
+            half_width = moments.half_width(confidence)[word_indices]
+            print("Distance %d: %d tests, largest interval half width %g, largest relative half width %g%s"
+                  % (dist, moments.count, half_width.max(), (half_width / moments.mean[word_indices]).max(),
+                     "" if target.met(moments, word_indices) else " (target not met, budget spent)"))
+    else:
+        print("Simulating %d random sequences for distances %d to %d" % (num_tests, min_d, max_d - 1))
+        moments_table = sampler.moments_table(distances, num_tests)
+    if not plot_only:
+        print("%d chunks of random sequences simulated, %d read from the result store"
+              % (sampler.computed_tasks, sampler.stored_tasks))
+    model_probabilities = {dist: moments.mean for dist, moments in moments_table.items()}
+    # Draw the confidence intervals when a precision target was given
+    model_errors = {dist: moments.half_width(confidence) for dist, moments in moments_table.items()} \
+        if adaptive else None
+
+    # Collect the probabilities of every word, then plot them once all results are in
+    plot_args = []
+    for word in sorted_word_counts[:num_words]:
+        test_word_index = tokenizer.word_index[word[0]]
+        testdata_prob_list = testdata_probabilities[test_word_index][[dist - min_d for dist in distances]]
+        # Read the current word's column from the model's average output vector at each distance
+        model_prob_list = [model_probabilities[dist][test_word_index] for dist in distances]
+        model_err_list = [model_errors[dist][test_word_index] for dist in distances] if model_errors else None
+        plot_args.append((word[0], distances, model_prob_list, testdata_prob_list, model_err_list))
+    plot_args, digests = plots_to_draw(plot_args)
+    with TRACER.span("plot_words", words=len(plot_args)):
+        if workers and workers > 1 and plot_args:
+            from multiprocessing import get_context
+            with get_context("spawn").Pool(workers) as pool:
+                pool.starmap(plot_word, plot_args)
+        else:
+            for args in plot_args:
+                plot_word(*args)
+    with open(PLOT_DIGESTS, "w", encoding="utf-8") as digests_file:
+        json.dump(digests, digests_file, indent=1)
 
+
+# Measure P(W|d) from the testing data for every word and the distances min_d ... max_d - 1
+# The testing files are read as integer tokens through the corpus cache, simplified like the training data was, and
+# the gaps of every word are counted in one pass. The counts are kept in TESTDATA_CACHE, keyed by the tokenizer and
+# the size and modification time of the testing files, so later runs up to the same max_d don't read the files again
+@traced
+def testdata_probability_table(tokenizer, min_d, max_d):
+    import numpy
+    from data_interpreter import DataInterpreter
+    from corpus_cache import CorpusCache
+    from result_store import ResultStore
     data_interp = DataInterpreter()
-    # Read the testing data
-    txtdata = data_interp.read_text_files(data_interp.testing_files)
+    files = sorted(data_interp.testing_files)
+    key = hashlib.sha1(json.dumps([ResultStore.file_fingerprint([TOKENIZER_PATH])] +
+                                  [[file, *CorpusCache.file_key(file)] for file in files]).encode()).hexdigest()
+    if path.exists(TESTDATA_CACHE):
+        with numpy.load(TESTDATA_CACHE) as cached:
+            if str(cached["key"]) == key and cached["counts"].shape[1] >= max_d:
+                return cached["counts"][:, min_d:max_d] / (cached["occurrences"][:, None] + 1)
+    from gap_histogram import GapHistogram
+    data_interp.tokenizer = tokenizer
+    tokens, vocabulary = data_interp.read_token_files(files)
     # Make the same simplficiations to our testing data that we did with our training data
-    txtdata = data_interp.simplify_text_data_with_tokenizer(txtdata, tokenizer)
+    tokens = data_interp.simplify_token_data_with_tokenizer(tokens, vocabulary, tokenizer)
+    gap_histogram = GapHistogram(data_interp.tokens_to_indices(tokens, vocabulary), len(tokenizer.word_index) + 1,
+                                 max_d - 1)
+    makedirs(path.dirname(TESTDATA_CACHE), exist_ok=True)
+    numpy.savez(TESTDATA_CACHE, key=numpy.array(key), counts=gap_histogram.counts,
+                occurrences=gap_histogram.occurrences)
+    return gap_histogram.probability_table(range(min_d, max_d))
 
-    # Load the trained model
-    model = load_model()
 
-    # Loop over sorted words
-    for word in sorted_word_counts[:num_words]:
-        print("Assessing accuracy for word %s" % word[0])
-        model_prob_list = []
-        testdata_prob_list = []
-        # Split the txtdata by the current word using regular expressions to find word boundaries
-        txtdata_split = split(r"\b%s\b" % word[0], txtdata)
-        # Convert the txtdata to integer sequences using the tokenizer -- makes it easier to measure the distance
-        converted_txt = tokenizer.texts_to_sequences(txtdata_split)
-
-        # Now loop over the requested distances to check
-        for dist in range(min_d, max_d):
-            # Loop over sequences made from our testing data and count how many have the right distance
-            cnt = 0
-            for sequence in converted_txt:
-                if len(sequence) == dist:
-                    cnt += 1
-            testdata_prob_list.append(cnt/len(txtdata_split))
-
-            # Perform num_test tests with the model generating random word sequences
-            test_word_index = tokenizer.word_index[word[0]]
-            probability_sum = 0
-            for _ in range(num_tests):
-                # Create a random sequence of words of length --distance that doesn't include
-                random_words = ""
-                for _ in range(dist):
-                    random_words += " " + choice(sorted_words)
-                sequence = tokenizer.texts_to_sequences([random_words])[0]
-                sequence = pad_sequences([sequence], maxlen=model.model.input_shape[1], padding="pre")
-                probabilities = model.get_probability(sequence)[0]
-                # Get the probability for the current word
-                probability_sum += probabilities[test_word_index]
-            model_prob_list.append(probability_sum/num_tests)
-
-        # Create a distance list to use in plotting
-        distances = [x for x in range(min_d, max_d)]
-        # Plot the probability vs distance for the model and from the test data
+# Split the arguments of plot_word into the plots that have to be drawn, those whose data changed since they were
+# last drawn or whose file is missing, and return them with the updated digests of every plot
+def plots_to_draw(plot_args):
+    digests = {}
+    if path.exists(PLOT_DIGESTS):
+        with open(PLOT_DIGESTS, encoding="utf-8") as digests_file:
+            digests = json.load(digests_file)
+    to_draw = []
+    for args in plot_args:
+        data = [args[0]] + [None if values is None else [float(value) for value in values] for values in args[1:]]
+        digest = hashlib.sha1(json.dumps(data).encode()).hexdigest()
+        if digests.get(args[0]) == digest and path.exists(plot_path(args[0])):
+            print("Plot for word %s is up to date" % args[0])
+            continue
+        digests[args[0]] = digest
+        to_draw.append(args)
+    return to_draw, digests
+
+
+def plot_path(word):
+    return "./plots/%s.png" % word
+
+
+# Plot the probability vs distance for the model and from the test data
+# With model_err_list, the confidence intervals of the adaptive estimates are drawn as error bars
+def plot_word(word, distances, model_prob_list, testdata_prob_list, model_err_list=None):
+    import matplotlib.pyplot as plt
+    print("Assessing accuracy for word %s" % word)
+    if model_err_list is None:
         plt.plot(distances, model_prob_list, label='Model', color='darkblue', marker='.')
-        plt.plot(distances, testdata_prob_list, label='Test data', color='green', marker='^')
-        plt.legend()
-        plt.xlim(min_d-1, max_d)
-        plt.xlabel("distance (# words)")
-        plt.ylabel("Probability")
-        plt.title(word[0])
-        plt.savefig("./plots/%s.png" % word[0])
-        plt.close()
+    else:
+        plt.errorbar(distances, model_prob_list, yerr=model_err_list, label='Model', color='darkblue', marker='.',
+                     capsize=2)
+    plt.plot(distances, testdata_prob_list, label='Test data', color='green', marker='^')
+    plt.legend()
+    plt.xlim(distances[0] - 1, distances[-1] + 1)
+    plt.xlabel("distance (# words)")
+    plt.ylabel("Probability")
+    plt.title(word)
+    plt.savefig(plot_path(word))
+    plt.close()
+
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
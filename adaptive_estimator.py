@@ -0,0 +1,76 @@
+from statistics import NormalDist
+
+import numpy
+
+
+# Running count, mean and sum of squared deviations (M2) of a stream of output vectors
+# Batches are combined with the parallel variance formula of Chan et al., which stays accurate for the small
+# probabilities of rare words where the naive sum of squares would lose most of its digits
+class RunningMoments:
+    def __init__(self, count=0, mean=0.0, m2=0.0):
+        self.count = count
+        self.mean = mean
+        self.m2 = m2
+
+    # Add a batch of output vectors, one row per random sequence
+    def add(self, values):
+        values = numpy.asarray(values, dtype=numpy.float64)
+        mean = values.mean(axis=0)
+        self.merge(RunningMoments(len(values), mean, numpy.sum((values - mean) ** 2, axis=0)))
+
+    # Combine with the moments of another set of samples
+    def merge(self, other):
+        if other.count == 0:
+            return
+        total = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean = self.mean + delta * other.count / total
+        self.m2 = self.m2 + other.m2 + delta ** 2 * self.count * other.count / total
+        self.count = total
+
+    # Sample variance of every column
+    def variance(self):
+        return self.m2 / (self.count - 1) if self.count > 1 else numpy.full_like(self.mean, numpy.inf)
+
+    # Half width of the normal approximation confidence interval on the mean of every column
+    def half_width(self, confidence=0.95):
+        z = NormalDist().inv_cdf(0.5 + confidence / 2)
+        return z * numpy.sqrt(self.variance() / max(self.count, 1))
+
+
+# Stopping rule for the adaptive estimate of P(W|d)
+# Sampling stops once the confidence interval of every watched word is within rel_error of its mean and/or narrower
+# than ci_width, or once max_tests sequences have been scored. At least min_tests sequences are always scored
+class PrecisionTarget:
+    def __init__(self, rel_error=None, ci_width=None, confidence=0.95, max_tests=1000000, min_tests=1000):
+        if rel_error is None and ci_width is None:
+            raise ValueError("PrecisionTarget : set rel_error, ci_width or both")
+        self.rel_error = rel_error
+        self.ci_width = ci_width
+        self.confidence = confidence
+        self.max_tests = max_tests
+        self.min_tests = min(min_tests, max_tests)
+
+    # Whether the watched columns are precise enough
+    def met(self, moments, word_indices):
+        if moments.count < max(self.min_tests, 2):
+            return False
+        half_width = moments.half_width(self.confidence)[word_indices]
+        if self.rel_error is not None and numpy.any(half_width > self.rel_error * moments.mean[word_indices]):
+            return False
+        if self.ci_width is not None and numpy.any(2 * half_width > self.ci_width):
+            return False
+        return True
+
+    # Whether to stop sampling, either because the target is met or because the budget is spent
+    def done(self, moments, word_indices):
+        return moments.count >= self.max_tests or self.met(moments, word_indices)
+
+    def describe(self):
+        targets = []
+        if self.rel_error is not None:
+            targets.append("relative error %g" % self.rel_error)
+        if self.ci_width is not None:
+            targets.append("interval width %g" % self.ci_width)
+        return "%s at %g%% confidence, at most %d tests" % (" and ".join(targets), 100 * self.confidence,
+                                                            self.max_tests)
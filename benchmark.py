@@ -0,0 +1,306 @@
+# Imports of built-in libraries
+import sys
+import getopt
+import json
+import time
+import shutil
+import platform
+import resource
+import tracemalloc
+from os import environ, path, makedirs, listdir
+# This will stop tensorflow from spamming unnecessary error messages about its GPU implementation
+# Needs to set before we import anything from keras/tensorflow
+environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
+import numpy
+
+from data_interpreter import DataInterpreter
+from corpus_cache import CorpusCache
+from gap_histogram import GapHistogram
+from fast_tokenizer import FastTokenizer
+
+
+# Model and tokenizer produced by training.py, used as fixed inputs for the inference and measured data stages
+MODEL_PATH = "./model_51_file_training.h5"
+QUANTIZED_PATH = "./model_51_file_training.qmodel"
+TOKENIZER_PATH = "./tokenizer_51_file_training.vocab"
+# Scaled corpora and result files, under the ignored cache directory so benchmark runs leave the tree clean
+BENCHMARK_DIR = "./cache/benchmark/"
+
+
+# Class to create larger versions of the corpus in data/ for benchmarking
+# For a factor x every data file gets x synthetic counterparts with the same number of lines, drawn at random from
+# all lines of the corpus, so word frequencies and line lengths follow the real data. The vocabulary doesn't grow
+class CorpusScaler:
+    def __init__(self, datapath="./data/", output_dir=BENCHMARK_DIR, seed=0):
+        self.datapath = datapath
+        self.output_dir = output_dir
+        self.seed = seed
+
+    # Return the directory holding the corpus scaled by factor, generating it if it doesn't exist yet
+    def scale(self, factor):
+        if factor == 1:
+            return self.datapath
+        corpus_dir = path.join(self.output_dir, "corpus_%dx" % factor)
+        # The marker is written last, a directory without it is from an interrupted run
+        if path.exists(path.join(corpus_dir, "complete")):
+            return corpus_dir
+        shutil.rmtree(corpus_dir, ignore_errors=True)
+        makedirs(corpus_dir)
+        files = sorted(file for file in listdir(self.datapath) if file.endswith(".txt"))
+        file_lines = []
+        for file in files:
+            with open(path.join(self.datapath, file), "r", encoding="utf8") as datafile:
+                file_lines.append(datafile.read().split("\n"))
+        all_lines = numpy.array([line for lines in file_lines for line in lines], dtype=object)
+        rng = numpy.random.default_rng(self.seed)
+        for copy in range(factor):
+            for file, lines in zip(files, file_lines):
+                sampled = all_lines[rng.integers(0, len(all_lines), size=len(lines))]
+                with open(path.join(corpus_dir, "%s_%d.txt" % (file[:-4], copy)), "w", encoding="utf8") as outfile:
+                    outfile.write("\n".join(sampled))
+        open(path.join(corpus_dir, "complete"), "w").close()
+        return corpus_dir
+
+
+# Class to time pipeline stages and record their throughput and memory use
+# peak_rss_mb is the high-water mark of the process after the stage and rss_growth_mb how far the stage raised it
+# With track_memory, tracemalloc also records the peak of memory allocated during the stage, at the cost of slowing
+# down stages that run a lot of python code
+class Benchmark:
+    def __init__(self, track_memory=False):
+        self.track_memory = track_memory
+        self.stages = []
+
+    # Peak resident set size of the process so far in MB, ru_maxrss is in kB on Linux and in bytes on macOS
+    @staticmethod
+    def peak_rss_mb():
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / (1 << 20) if sys.platform == "darwin" else peak / (1 << 10)
+
+    # Run function(), record the stage and return the function's result, or None if it raised
+    # units is the amount of work done, a number or a function of the result, reported as unit per second
+    def run(self, name, function, units=None, unit=None):
+        print("Running %s" % name)
+        stage = {"name": name}
+        rss_before = self.peak_rss_mb()
+        if self.track_memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        try:
+            result = function()
+        except Exception as error:
+            result = None
+            stage["error"] = "%s: %s" % (type(error).__name__, error)
+            print("%s failed with %s" % (name, stage["error"]))
+        stage["seconds"] = time.perf_counter() - start
+        if self.track_memory:
+            stage["allocated_peak_mb"] = tracemalloc.get_traced_memory()[1] / (1 << 20)
+            tracemalloc.stop()
+        stage["peak_rss_mb"] = self.peak_rss_mb()
+        stage["rss_growth_mb"] = stage["peak_rss_mb"] - rss_before
+        if "error" not in stage and units is not None:
+            stage["units"] = units(result) if callable(units) else units
+            stage["unit"] = unit
+            stage["throughput"] = stage["units"] / stage["seconds"] if stage["seconds"] > 0 else None
+        self.stages.append(stage)
+        return result
+
+    # Table of the recorded stages
+    def summary(self):
+        lines = ["%-44s %10s %22s %12s" % ("stage", "seconds", "throughput", "peak rss MB")]
+        for stage in self.stages:
+            if "error" in stage:
+                throughput = "failed"
+            elif stage.get("throughput"):
+                throughput = "%.4g %s/s" % (stage["throughput"], stage["unit"])
+            else:
+                throughput = ""
+            lines.append("%-44s %10.3f %22s %12.1f" % (stage["name"], stage["seconds"], throughput,
+                                                       stage["peak_rss_mb"]))
+        return "\n".join(lines)
+
+
+# Load the trained model for one of the backends
+def load_model(backend):
+    if backend == "numpy":
+        from numpy_model import NumpyModel
+        model = NumpyModel()
+    elif backend == "quantized":
+        from quantized_model import QuantizedModel
+        model = QuantizedModel()
+        model.load_model(QUANTIZED_PATH)
+        return model
+    else:
+        from nn_model import NNModel
+        model = NNModel()
+    model.load_model(MODEL_PATH)
+    return model
+
+
+# Score batches of random sequences, n_calls calls of batch_size sequences each
+def score_batches(model, sequences, batch_size, n_calls):
+    for call in range(n_calls):
+        start = (call * batch_size) % (len(sequences) - batch_size + 1)
+        model.get_probability(sequences[start:start + batch_size], batch_size=batch_size)
+
+
+# Run every stage on the corpus in corpus_dir
+def run_benchmark(bench, corpus_dir, n_files=None, backends=("keras", "numpy"), batch_sizes=(1, 32, 256, 4096),
+                  cache_dir="./cache/benchmark/corpus_cache/"):
+    data_interp = DataInterpreter(datapath=corpus_dir)
+    # Sort the files so every run uses the same inputs, then split them like DataInterpreter does
+    data_files = sorted(data_interp.data_file_list)
+    training_files = data_files[:int(len(data_files) * data_interp.training_frac)]
+    testing_files = data_files[int(len(data_files) * data_interp.training_frac):]
+    if n_files:
+        training_files, testing_files = training_files[:n_files], testing_files[:n_files]
+    min_freq = len(training_files) / 2  # Same rule of thumb as training.py
+
+    # Training data preparation on text, as in training.py with use_corpus_cache = False
+    txtdata = bench.run("read_text_files", lambda: data_interp.read_text_files(training_files),
+                        units=len, unit="characters")
+    if txtdata is None:
+        return
+    n_words = len(txtdata.split())
+    txtdata = bench.run("simplify_text_data", lambda: data_interp.simplify_text_data(txtdata, min_freq=min_freq),
+                        units=n_words, unit="words")
+    vocab = bench.run("set_num_words", lambda: data_interp.set_num_words(txtdata, min_freq=min_freq),
+                      units=n_words, unit="words")
+    bench.run("training_data_to_padded_sequences",
+              lambda: data_interp.training_data_to_padded_sequences(txtdata, max_len=15, shuffle_data=False),
+              units=lambda result: len(result[1]), unit="sequences")
+    stream = bench.run("training_data_to_token_stream",
+                       lambda: data_interp.training_data_to_token_stream(txtdata, max_len=15),
+                       units=lambda result: len(result[2]), unit="sequences")
+
+    # One training epoch on the streamed prefixes, as in training.py
+    def fit_epoch():
+        from nn_model import NNModel
+        from prefix_sequence import PrefixSequence
+        max_length, tokens, targets = stream
+        vocab_size = len(vocab) + 1
+        model = NNModel()
+        model.prepare_model(max_length - 1, vocab_size, hidden_layer_size=int((vocab_size + max_length - 1) * 2 / 3),
+                            sparse_targets=True)
+        model.fit_model(PrefixSequence(tokens, targets, max_length - 1, seed=0), epochs=1, verbosity=0)
+    if stream is not None and vocab is not None:
+        bench.run("fit_model_epoch", fit_epoch, units=len(stream[2]), unit="sequences")
+
+    # Inference with the trained model on fixed random sequences of the words it was trained on
+    tokenizer = FastTokenizer.load(TOKENIZER_PATH)
+    for backend in backends:
+        model = bench.run("load_model_%s" % backend, lambda: load_model(backend))
+        if model is None:
+            continue
+        rng = numpy.random.default_rng(0)
+        sequences = rng.integers(1, tokenizer.num_words, size=(max(batch_sizes) * 2, model.get_input_length()),
+                                 dtype=numpy.int32)
+        for batch_size in batch_sizes:
+            n_calls = max(3, min(256, 4096 // batch_size))
+            bench.run("get_probability_%s_batch_%d" % (backend, batch_size),
+                      lambda: score_batches(model, sequences, batch_size, n_calls),
+                      units=n_calls * batch_size, unit="sequences")
+
+    # Measured data side of accuracy_assessment.py: read the testing data through a cold and then a warm corpus
+    # cache, simplify it with the trained tokenizer and histogram the gaps between words
+    shutil.rmtree(cache_dir, ignore_errors=True)
+    bench.run("corpus_cache_ingest", lambda: CorpusCache(cache_dir).update(testing_files),
+              units=sum(path.getsize(file) for file in testing_files) / (1 << 20), unit="MB")
+
+    def measured_side():
+        tokens, vocabulary = data_interp.read_token_files(testing_files, cache_dir=cache_dir)
+        tokens = data_interp.simplify_token_data_with_tokenizer(tokens, vocabulary, tokenizer)
+        data_interp.tokenizer = tokenizer
+        indices = data_interp.tokens_to_indices(tokens, vocabulary)
+        GapHistogram(indices, len(tokenizer.word_index) + 1, 15).probability_table(range(3, 16))
+        return len(tokens)
+    bench.run("measured_probabilities", measured_side, units=lambda result: result, unit="tokens")
+
+
+# Print the change of every stage against an earlier result file
+def compare(stages, baseline_path):
+    with open(baseline_path) as baseline_file:
+        baseline = {stage["name"]: stage for stage in json.load(baseline_file)["stages"]}
+    print("%-44s %10s %10s %8s" % ("stage", "baseline", "seconds", "ratio"))
+    for stage in stages:
+        old = baseline.get(stage["name"])
+        if old is None or "error" in old or "error" in stage:
+            continue
+        print("%-44s %10.3f %10.3f %8.2f" % (stage["name"], old["seconds"], stage["seconds"],
+                                             stage["seconds"] / old["seconds"] if old["seconds"] else float("inf")))
+
+
+def print_help():
+    print("Usage:")
+    print("python benchmark.py [-x <scale>] [-n <files>] [-b <backends>] [-o <output>] [-c <baseline>] [-m]")
+    print("Where")
+    print("<scale> runs on a synthetic corpus <scale> times the size of data/, e.g. 2, 10 or 100 (default 1)")
+    print("        scaled corpora are generated once in cache/benchmark/")
+    print("<files> limits the number of training and testing files used (default all)")
+    print("<backends> is a comma separated list of model backends to time, keras, numpy or quantized")
+    print("           (default keras,numpy)")
+    print("<output> is the json file the results are written to (default %sbenchmark_<scale>x.json)" % BENCHMARK_DIR)
+    print("<baseline> is an earlier result file to compare the stage timings against")
+    print("-m also records the memory allocated by every stage with tracemalloc, which slows some stages down")
+
+
+def main():
+    # Retrieve arguments, print help() if that fails
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hx:n:b:o:c:m",
+                                   ["help", "scale=", "files=", "backends=", "output=", "compare=", "memory"])
+    except getopt.GetoptError:
+        print_help()
+        sys.exit(2)
+    scale = 1
+    n_files = None
+    backends = ["keras", "numpy"]
+    output = None
+    baseline = None
+    track_memory = False
+    for opt, arg in opts:
+        if opt in ("-h", "--help"):
+            print_help()
+            sys.exit()
+        elif opt in ("-x", "--scale", "-n", "--files"):
+            try:
+                value = int(arg)
+            except ValueError:
+                print("%s %s couldn't be converted to an int. \n" % (opt, arg))
+                print_help()
+                sys.exit(2)
+            if opt in ("-x", "--scale"):
+                scale = value
+            else:
+                n_files = value
+        elif opt in ("-b", "--backends"):
+            backends = arg.split(",")
+        elif opt in ("-o", "--output"):
+            output = arg
+        elif opt in ("-c", "--compare"):
+            baseline = arg
+        elif opt in ("-m", "--memory"):
+            track_memory = True
+
+    bench = Benchmark(track_memory)
+    corpus_dir = bench.run("scale_corpus_%dx" % scale, lambda: CorpusScaler().scale(scale))
+    if corpus_dir is None:
+        sys.exit(2)
+    run_benchmark(bench, corpus_dir, n_files, backends)
+    print(bench.summary())
+
+    results = {"scale": scale, "files": n_files, "corpus": corpus_dir, "tracemalloc": track_memory,
+               "time": time.strftime("%Y-%m-%dT%H:%M:%S"), "python": platform.python_version(),
+               "numpy": numpy.__version__, "platform": platform.platform(), "stages": bench.stages}
+    if output is None:
+        makedirs(BENCHMARK_DIR, exist_ok=True)
+        output = path.join(BENCHMARK_DIR, "benchmark_%dx.json" % scale)
+    with open(output, "w") as outfile:
+        json.dump(results, outfile, indent=2)
+    print("Results written to %s" % output)
+    if baseline:
+        compare(bench.stages, baseline)
+
+
+if __name__ == "__main__":
+    main()
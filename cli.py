@@ -0,0 +1,88 @@
+# Imports of built-in libraries
+import sys
+import getopt
+from importlib import import_module
+
+
+# Single entry point to the scripts: python cli.py <command> [options]
+# Every command but list runs the main() of its script with the remaining options, and only imports that script, which
+# in turn only imports numpy, matplotlib, keras or tensorflow on the paths that need them. Listing the vocabulary,
+# looking up stored results (query --cached), the count backend and redrawing plots (assess --plotonly) never load
+# tensorflow, and assess --plotonly only loads matplotlib for plots whose data changed
+COMMANDS = {"query": "testing", "assess": "accuracy_assessment", "train": "training"}
+TOKENIZER_PATH = "./tokenizer_51_file_training.vocab"
+
+
+def print_help():
+    print("Usage:")
+    print("python cli.py list [-n <num_words>] [-a] [-c] [-t <tokenizer>]")
+    print("python cli.py query <options of testing.py>")
+    print("python cli.py assess <options of accuracy_assessment.py>")
+    print("python cli.py train <options of training.py>")
+    print("Where")
+    print("list prints the word list used during training, most common first")
+    print("     <num_words> only prints the most common <num_words> words, -a prints every word of the tokenizer")
+    print("     -c adds the number of times each word was seen, <tokenizer> is the vocabulary (default %s)"
+          % TOKENIZER_PATH)
+    print("query estimates P(W|d) for a word, e.g. python cli.py query -w long -d 3 --cached")
+    print("assess compares P(W|d) of the model with the testing data, e.g. python cli.py assess -n 20 -d 15 --plotonly")
+    print("train trains a new model")
+    print("Use python cli.py <command> -h for the options of a command")
+
+
+def list_words(args):
+    try:
+        opts, args = getopt.getopt(args, "hn:act:", ["help", "numwords=", "all", "counts", "tokenizer="])
+    except getopt.GetoptError:
+        print_help()
+        sys.exit(2)
+    num_words = None
+    all_words = False
+    counts = False
+    tokenizer_path = TOKENIZER_PATH
+    for opt, arg in opts:
+        if opt in ("-h", "--help"):
+            print_help()
+            sys.exit()
+        elif opt in ("-n", "--numwords"):
+            try:
+                num_words = int(arg)
+            except ValueError:
+                print("--numwords %s couldn't be converted to an int. \n" % arg)
+                print_help()
+                sys.exit(2)
+        elif opt in ("-a", "--all"):
+            all_words = True
+        elif opt in ("-c", "--counts"):
+            counts = True
+        elif opt in ("-t", "--tokenizer"):
+            tokenizer_path = arg
+    # The tokenizer needs neither numpy, keras nor tensorflow
+    from fast_tokenizer import FastTokenizer
+    tokenizer = FastTokenizer.load(tokenizer_path)
+    sorted_words = sorted(tokenizer.word_counts.items(), key=lambda x: x[1], reverse=True)
+    if not all_words:
+        sorted_words = sorted_words[:tokenizer.num_words]
+    for word, count in sorted_words[:num_words]:
+        print("%s %d" % (word, count) if counts else word)
+
+
+def main():
+    if len(sys.argv) < 2 or sys.argv[1] in ("-h", "--help"):
+        print_help()
+        sys.exit(2 if len(sys.argv) < 2 else 0)
+    command, args = sys.argv[1], sys.argv[2:]
+    if command == "list":
+        list_words(args)
+        return
+    if command not in COMMANDS:
+        print("Unknown command %s. \n" % command)
+        print_help()
+        sys.exit(2)
+    # The scripts read their options from sys.argv
+    sys.argv = [sys.argv[0]] + args
+    import_module(COMMANDS[command]).main()
+
+
+if __name__ == "__main__":
+    main()
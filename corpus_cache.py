@@ -0,0 +1,133 @@
+import json
+from collections import OrderedDict
+from os import path, makedirs, replace, stat
+
+import numpy
+
+from text_processing import read_file_words
+from instrumentation import traced
+
+
+# Class to keep a tokenized copy of the text data on disk so it doesn't have to be re-read and re-parsed on every run
+# Every word is encoded with an integer id from a vocabulary that only ever grows, id 0 marks a line break
+# The tokens of all files are stored back to back in one .npy file that is memory-mapped when read, and a manifest keyed
+# on file path, size and modification time records where each file's tokens are, so only new or changed files are
+# re-read when the cache is updated. Files are read and split into words in a pool of worker processes
+class CorpusCache:
+    LINE_BREAK = 0
+
+    def __init__(self, cache_dir="./cache/corpus/", workers=None):
+        self.cache_dir = cache_dir
+        self.workers = workers  # Number of worker processes, defaults to the number of CPUs
+        self.tokens_path = path.join(cache_dir, "tokens.npy")
+        self.manifest_path = path.join(cache_dir, "manifest.json")
+        self.vocabulary_path = path.join(cache_dir, "vocabulary.json")
+        self.manifest = {}  # File path -> {"size", "mtime", "offset", "length"}
+        self.vocabulary = ["\n"]  # Word id -> word
+        self.tokens = numpy.zeros(0, dtype=numpy.int32)
+        if path.exists(self.manifest_path):
+            with open(self.manifest_path, encoding="utf-8") as f:
+                self.manifest = json.load(f)
+            with open(self.vocabulary_path, encoding="utf-8") as f:
+                self.vocabulary = json.load(f)
+            self.tokens = numpy.load(self.tokens_path, mmap_mode="r")
+        self.word_ids = {word: i for i, word in enumerate(self.vocabulary)}
+
+    # Size and modification time of a file, used to detect files that changed since they were cached
+    @staticmethod
+    def file_key(file):
+        file_stat = stat(file)
+        return file_stat.st_size, file_stat.st_mtime_ns
+
+    # Make sure every file in file_list is in the cache and up to date, returns the cache itself
+    @traced
+    def update(self, file_list):
+        stale_files = [file for file in dict.fromkeys(file_list)
+                       if file not in self.manifest
+                       or (self.manifest[file]["size"], self.manifest[file]["mtime"]) != self.file_key(file)]
+        if not stale_files:
+            return self
+        # Read and split the files in parallel, but encode them here so word ids stay consistent
+        # Spawned rather than forked workers: the caller may have loaded tensorflow, which doesn't survive a fork
+        from concurrent.futures import ProcessPoolExecutor
+        from multiprocessing import get_context
+        with ProcessPoolExecutor(self.workers, mp_context=get_context("spawn")) as pool:
+            file_words = pool.map(read_file_words, stale_files, chunksize=max(1, len(stale_files) // 64))
+            new_tokens = {file: self.encode(lines) for file, lines in zip(stale_files, file_words)}
+        # Write a new token file holding the files that are still valid followed by the new ones
+        kept_files = [file for file in self.manifest if file not in new_tokens]
+        total = sum(self.manifest[file]["length"] for file in kept_files) + sum(map(len, new_tokens.values()))
+        makedirs(self.cache_dir, exist_ok=True)
+        tmp_path = self.tokens_path + ".tmp.npy"
+        tokens = numpy.lib.format.open_memmap(tmp_path, mode="w+", dtype=numpy.int32, shape=(total,))
+        manifest = {}
+        offset = 0
+        for file in kept_files:
+            entry = dict(self.manifest[file])
+            tokens[offset:offset + entry["length"]] = self.tokens[entry["offset"]:entry["offset"] + entry["length"]]
+            entry["offset"] = offset
+            manifest[file] = entry
+            offset += entry["length"]
+        for file, file_tokens in new_tokens.items():
+            size, mtime = self.file_key(file)
+            tokens[offset:offset + len(file_tokens)] = file_tokens
+            manifest[file] = {"size": size, "mtime": mtime, "offset": offset, "length": len(file_tokens)}
+            offset += len(file_tokens)
+        tokens.flush()
+        del tokens
+        self.tokens = None  # Release the memory map before the token file is replaced
+        replace(tmp_path, self.tokens_path)
+        self.write_json(self.vocabulary_path, self.vocabulary)
+        self.write_json(self.manifest_path, manifest)
+        self.manifest = manifest
+        self.tokens = numpy.load(self.tokens_path, mmap_mode="r")
+        return self
+
+    # Encode the words of a file, given line by line, adding any new words to the vocabulary
+    def encode(self, lines):
+        ids = []
+        for line in lines:
+            for word in line:
+                word_id = self.word_ids.get(word)
+                if word_id is None:
+                    word_id = self.word_ids[word] = len(self.vocabulary)
+                    self.vocabulary.append(word)
+                ids.append(word_id)
+            ids.append(self.LINE_BREAK)
+        return numpy.array(ids, dtype=numpy.int32)
+
+    # Write a json file atomically so an interrupted update never leaves a half written cache behind
+    @staticmethod
+    def write_json(file, data):
+        with open(file + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+        replace(file + ".tmp", file)
+
+    # Tokens of a single cached file, a view into the memory-mapped token file
+    def file_tokens(self, file):
+        entry = self.manifest[file]
+        return self.tokens[entry["offset"]:entry["offset"] + entry["length"]]
+
+    # Tokens of a list of cached files, in the order of the list
+    def get_tokens(self, file_list):
+        if len(file_list) == 1:
+            return self.file_tokens(file_list[0])
+        return numpy.concatenate([self.file_tokens(file) for file in file_list])
+
+    # Count how often each word appears in an array of tokens
+    # Returns an OrderedDict of word -> count in order of first appearance, like the keras Tokenizer's word_counts
+    @staticmethod
+    def word_counts(tokens, vocabulary):
+        ids, first_positions, counts = numpy.unique(tokens, return_index=True, return_counts=True)
+        order = numpy.argsort(first_positions, kind="stable")
+        return OrderedDict((vocabulary[ids[i]], int(counts[i])) for i in order if ids[i] != CorpusCache.LINE_BREAK)
+
+    # Build an array translating cache word ids into another index, words missing from word_index map to 0
+    # merge_map optionally replaces words before they are looked up, as DataInterpreter.replace_words does on text
+    # Line breaks map to line_break_id
+    @staticmethod
+    def translation_table(vocabulary, word_index, merge_map=None, line_break_id=0):
+        merge_map = merge_map or {}
+        table = numpy.array([word_index.get(merge_map.get(word, word), 0) for word in vocabulary], dtype=numpy.int64)
+        table[CorpusCache.LINE_BREAK] = line_break_id
+        return table
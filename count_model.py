@@ -0,0 +1,255 @@
+# Imports of built-in libraries
+import sys
+import getopt
+import time
+from os import path as os_path
+
+import numpy
+
+from gap_histogram import GapHistogram
+from instrumentation import traced, enable_tracing, TRACE_ENV
+
+
+# Count model built by this script and the tokenizer whose indices it uses
+COUNT_PATH = "./count_model.npz"
+TOKENIZER_PATH = "./tokenizer_51_file_training.vocab"
+# Longest distance with a gap count, also the input length of the model
+MAX_DISTANCE = 50
+# Longest n-gram counted
+ORDER = 3
+
+
+# Class answering P(W|d) and next-word queries from count tables over the training corpus instead of a neural network
+# Has the same fit_model, save_model, load_model, get_input_length and get_probability interface as NNModel, so it
+# can be used wherever a model is only used for scoring, e.g. by SequenceSampler
+# - gap counts: for every word and every distance d up to max_distance, how many fragments between consecutive
+#   occurrences of the word are exactly d words long (see GapHistogram). P(W|d) is their fraction of all fragments
+# - n-gram counts for n = 1 ... order, within lines. The n-grams sharing a context are stored next to each other, as
+#   sorted context keys (the context words as digits in base vocab_size), offsets into the arrays of following words
+#   and their counts, so the followers of a batch of contexts are found with a binary search
+class CountModel:
+    def __init__(self):
+        self.vocab_size = None
+        self.max_distance = None
+        self.order = None
+        self.gap_counts = None
+        self.occurrences = None
+        self.gap_table = None
+        self.unigram_counts = None
+        self.ngrams = []  # (context keys, offsets, next words, counts) for n = 2 ... order
+
+    # Count the gaps and n-grams of input_data, a list of lines of word indices, e.g. from
+    # DataInterpreter.tokens_to_sequences. vocab_size is one more than the largest word index
+    @traced
+    def fit_model(self, input_data, vocab_size, max_distance=MAX_DISTANCE, order=ORDER):
+        if float(vocab_size) ** order >= 2 ** 63:
+            raise ValueError("CountModel : n-grams of order %d over %d words don't fit 64 bit keys" %
+                             (order, vocab_size))
+        lines = [numpy.asarray(line, dtype=numpy.int64) for line in input_data if len(line)]
+        tokens = numpy.concatenate(lines) if lines else numpy.zeros(0, dtype=numpy.int64)
+        line_ids = numpy.repeat(numpy.arange(len(lines)), [len(line) for line in lines])
+        self.vocab_size = vocab_size
+        self.max_distance = max_distance
+        self.order = order
+        # Line breaks are ignored for the gaps, like in the accuracy assessment
+        gap_histogram = GapHistogram(tokens, vocab_size, max_distance)
+        self.gap_counts = gap_histogram.counts.astype(numpy.int32)
+        self.occurrences = gap_histogram.occurrences.astype(numpy.int64)
+        self.unigram_counts = self.occurrences.copy()
+        self.ngrams = [self.count_ngrams(tokens, line_ids, n) for n in range(2, order + 1)]
+        self.set_gap_table()
+
+    # Context keys, offsets, next words and counts of the n-grams of a token array that don't cross lines
+    def count_ngrams(self, tokens, line_ids, n):
+        starts = numpy.flatnonzero(line_ids[:len(line_ids) - n + 1] == line_ids[n - 1:]) \
+            if len(tokens) >= n else numpy.zeros(0, dtype=numpy.int64)
+        contexts = numpy.zeros(len(starts), dtype=numpy.int64)
+        for j in range(n - 1):
+            contexts = contexts * self.vocab_size + tokens[starts + j]
+        keys, counts = numpy.unique(contexts * self.vocab_size + tokens[starts + n - 1], return_counts=True)
+        context_keys, first = numpy.unique(keys // self.vocab_size, return_index=True)
+        offsets = numpy.append(first, len(keys)).astype(numpy.int64)
+        return context_keys, offsets, (keys % self.vocab_size).astype(numpy.int32), counts.astype(numpy.int32)
+
+    # P(W|d) for every distance and word, as a distances x words table so a row per sequence can be gathered
+    def set_gap_table(self):
+        self.gap_table = (self.gap_counts / (self.occurrences[:, None] + 1)).T.astype(numpy.float32)
+
+    @traced
+    def save_model(self, path=COUNT_PATH):
+        arrays = {"gap_counts": self.gap_counts, "occurrences": self.occurrences,
+                  "unigram_counts": self.unigram_counts,
+                  "settings": numpy.array([self.vocab_size, self.max_distance, self.order], dtype=numpy.int64)}
+        for n, (context_keys, offsets, next_words, counts) in enumerate(self.ngrams, start=2):
+            arrays.update({"context_keys_%d" % n: context_keys, "offsets_%d" % n: offsets,
+                           "next_words_%d" % n: next_words, "counts_%d" % n: counts})
+        numpy.savez_compressed(path, **arrays)
+
+    @traced
+    def load_model(self, path=COUNT_PATH):
+        with numpy.load(path) as arrays:
+            self.vocab_size, self.max_distance, self.order = (int(value) for value in arrays["settings"])
+            self.gap_counts = arrays["gap_counts"]
+            self.occurrences = arrays["occurrences"]
+            self.unigram_counts = arrays["unigram_counts"]
+            self.ngrams = [(arrays["context_keys_%d" % n], arrays["offsets_%d" % n], arrays["next_words_%d" % n],
+                            arrays["counts_%d" % n]) for n in range(2, self.order + 1)]
+        self.set_gap_table()
+
+    # Sequences can hold up to max_distance words
+    def get_input_length(self):
+        return self.max_distance
+
+    # Gaps were only counted up to max_distance. Samplers cut longer sequences to the last max_distance words, so
+    # P(W|d) beyond it would silently come out as P(W|max_distance): callers check the distance before asking
+    def check_distance(self, distance):
+        if distance > self.max_distance:
+            raise ValueError("CountModel : P(W|d) was only counted up to d = %d, not %d"
+                             % (self.max_distance, distance))
+
+    # P(W|d) of a single word and distance
+    def gap_probability(self, word_index, distance):
+        self.check_distance(distance)
+        return float(self.gap_table[distance, word_index])
+
+    # Given pre-padded sequences of word indices, return for every sequence and every word W the probability that W
+    # comes next after the number of words following its last occurrence in the sequence, or after the whole sequence
+    # if W isn't in it, i.e. P(W|d) at that distance. Averaged over random sequences of d words without W this is
+    # exactly the P(W|d) the testing and accuracy assessment scripts estimate with the neural network
+    @traced
+    def get_probability(self, seed_sequence, batch_size=4096):
+        seed_sequence = numpy.asarray(seed_sequence)[:, -self.max_distance:]
+        outputs = []
+        for start in range(0, len(seed_sequence), batch_size):
+            sequences = seed_sequence[start:start + batch_size]
+            probabilities = self.gap_table[numpy.count_nonzero(sequences, axis=1)]
+            rows = numpy.arange(len(sequences))
+            width = sequences.shape[1]
+            # Later occurrences overwrite earlier ones, so every word ends up at the distance of its last occurrence
+            for t in range(width):
+                words = sequences[:, t]
+                present = words != 0
+                probabilities[rows[present], words[present]] = self.gap_table[width - 1 - t, words[present]]
+            outputs.append(probabilities)
+        return numpy.concatenate(outputs) if outputs else numpy.zeros((0, self.vocab_size), numpy.float32)
+
+    # Given pre-padded sequences of word indices, return the probabilities of what the next word will be from the
+    # n-gram counts, interpolating every order with the lower ones (Witten-Bell): the counts of a context are trusted
+    # in proportion to how often it was seen relative to how many different words followed it
+    @traced
+    def next_word_probability(self, seed_sequence):
+        sequences = numpy.asarray(seed_sequence, dtype=numpy.int64)
+        lengths = numpy.count_nonzero(sequences, axis=1)
+        unigram = (self.unigram_counts + 1) / (self.unigram_counts.sum() + self.vocab_size)
+        probabilities = numpy.tile(unigram, (len(sequences), 1))
+        for n, (context_keys, offsets, next_words, counts) in enumerate(self.ngrams, start=2):
+            rows = numpy.flatnonzero(lengths >= n - 1)
+            contexts = numpy.zeros(len(rows), dtype=numpy.int64)
+            for j in range(n - 1, 0, -1):
+                contexts = contexts * self.vocab_size + sequences[rows, -j]
+            positions = numpy.minimum(numpy.searchsorted(context_keys, contexts), max(len(context_keys) - 1, 0))
+            found = context_keys[positions] == contexts if len(context_keys) else numpy.zeros(len(rows), bool)
+            rows, positions = rows[found], positions[found]
+            starts, ends = offsets[positions], offsets[positions + 1]
+            lengths_found = ends - starts
+            # Indices of the followers of every found context, concatenated
+            followers = numpy.repeat(starts - numpy.cumsum(lengths_found) + lengths_found, lengths_found) + \
+                numpy.arange(lengths_found.sum())
+            follower_rows = numpy.repeat(rows, lengths_found)
+            totals = numpy.bincount(numpy.repeat(numpy.arange(len(rows)), lengths_found), weights=counts[followers],
+                                    minlength=len(rows))
+            weights = totals / (totals + lengths_found)
+            probabilities[rows] *= (1 - weights)[:, None]
+            probabilities[follower_rows, next_words[followers]] += \
+                numpy.repeat(weights / totals, lengths_found) * counts[followers]
+        return probabilities
+
+
+# Fit a count model on the training files, read through the corpus cache and simplified with the tokenizer
+@traced
+def build_count_model(tokenizer, n_files=-1, max_distance=MAX_DISTANCE, order=ORDER):
+    from data_interpreter import DataInterpreter
+    data_interp = DataInterpreter()
+    data_interp.tokenizer = tokenizer
+    files = data_interp.select_files(data_interp.training_files, n_files)
+    tokens, vocabulary = data_interp.read_token_files(files)
+    tokens = data_interp.simplify_token_data_with_tokenizer(tokens, vocabulary, tokenizer)
+    model = CountModel()
+    model.fit_model(data_interp.tokens_to_sequences(tokens, vocabulary), len(tokenizer.word_index) + 1,
+                    max_distance, order)
+    return model, files
+
+
+def print_help():
+    print("Usage:")
+    print("python count_model.py [-n <n_files>] [-d <max_distance>] [-g <order>] [-t <tokenizer>] [-o <output>]")
+    print("       [--trace <file>]")
+    print("Counts word gaps and n-grams in the training files for the count backend of testing.py and")
+    print("accuracy_assessment.py")
+    print("Where")
+    print("<n_files> is the number of training files to count (default all of them)")
+    print("<max_distance> is the largest distance P(W|d) is counted for (default %d)" % MAX_DISTANCE)
+    print("<order> is the longest n-gram counted (default %d)" % ORDER)
+    print("<tokenizer> is the vocabulary whose word indices the model uses (default %s)" % TOKENIZER_PATH)
+    print("<output> is the file the model is saved to (default %s)" % COUNT_PATH)
+    print("--trace <file> writes a timing trace of the run to <file> and prints a summary, as does setting %s=<file>"
+          % TRACE_ENV)
+
+
+def main():
+    # Retrieve arguments, print help() if that fails
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hn:d:g:t:o:",
+                                   ["help", "nfiles=", "maxdistance=", "order=", "tokenizer=", "output=", "trace="])
+    except getopt.GetoptError:
+        print_help()
+        sys.exit(2)
+    n_files = -1
+    max_distance = MAX_DISTANCE
+    order = ORDER
+    tokenizer_path = TOKENIZER_PATH
+    output_path = COUNT_PATH
+    trace_path = None
+    for opt, arg in opts:
+        if opt in ("-h", "--help"):
+            print_help()
+            sys.exit()
+        elif opt in ("-n", "--nfiles", "-d", "--maxdistance", "-g", "--order"):
+            try:
+                value = int(arg)
+            except ValueError:
+                print("%s %s couldn't be converted to an int. \n" % (opt, arg))
+                print_help()
+                sys.exit(2)
+            if value <= 0:
+                print("%s %s should be a positive integer. \n" % (opt, arg))
+                print_help()
+                sys.exit(2)
+            if opt in ("-n", "--nfiles"):
+                n_files = value
+            elif opt in ("-d", "--maxdistance"):
+                max_distance = value
+            else:
+                order = value
+        elif opt in ("-t", "--tokenizer"):
+            tokenizer_path = arg
+        elif opt in ("-o", "--output"):
+            output_path = arg
+        elif opt == "--trace":
+            trace_path = arg
+    # Time the run if --trace or the LV_TRACE environment variable was given
+    enable_tracing(trace_path)
+
+    from fast_tokenizer import FastTokenizer
+    start = time.perf_counter()
+    model, files = build_count_model(FastTokenizer.load(tokenizer_path), n_files, max_distance, order)
+    model.save_model(output_path)
+    print("Counted %d words of %d training files in %.2f s" % (int(model.occurrences.sum()), len(files),
+                                                               time.perf_counter() - start))
+    print("%s: %d distances, %s n-grams, %d bytes" % (output_path, max_distance,
+                                                      ", ".join(str(len(ngrams[2])) for ngrams in model.ngrams),
+                                                      os_path.getsize(output_path)))
+
+
+if __name__ == "__main__":
+    main()
@@ -2,14 +2,15 @@
 
 import numpy
 import sys
-import itertools
 from random import shuffle, sample
 from os import path, listdir
-from re import sub
+from re import sub, escape, fullmatch
 
-from keras.preprocessing.text import Tokenizer
-from keras.preprocessing.sequence import pad_sequences
-from nltk import edit_distance
+from fast_tokenizer import FastTokenizer, pad_sequences
+from word_similarity import WordSimilarityIndex
+from corpus_cache import CorpusCache
+from text_processing import clean_text
+from instrumentation import traced
 
 # Class to read in and manipulate text data
 class DataInterpreter:
@@ -22,7 +23,7 @@ class DataInterpreter:
         self.training_files = self.data_file_list[:int(len(self.data_file_list)*self.training_frac)]
         self.testing_files = self.data_file_list[int(len(self.data_file_list)*self.training_frac):]
         # Initialize the tokenizer
-        self.tokenizer = Tokenizer()
+        self.tokenizer = FastTokenizer()
 
     # Function that finds all .txt files in the self.datapath directory
     def find_data_files(self):
@@ -37,8 +38,9 @@ class DataInterpreter:
 
     # Set the number of words to keep in the tokenizer based the frequency with which words appear in the txt data
     # Returns vocab size as this is used to determine the size of the hidden layer and output layer
+    @traced
     def set_num_words(self, txtdata, min_freq=100):
-        tmp_tokenizer = Tokenizer()
+        tmp_tokenizer = FastTokenizer()
         tmp_tokenizer.fit_on_texts([txtdata])
         # Sort the tokenizer word counts by the frequency with which each word appears
         sorted_word_counts = sorted(tmp_tokenizer.word_counts.items(), key=lambda x: x[1], reverse=True)
@@ -52,6 +54,7 @@ class DataInterpreter:
     # Convert text data line by line into padded sequences of integers, which we will feed into the model
     # Most of our data contains one sentence per line, hence the default sequence seperate of a line break
     # In some cases that formatting doesn't hold, so for sentences greater than max_len we will try to split by alt_seps
+    @traced
     def training_data_to_padded_sequences(self, txtdata, seq_sep="\n", max_len=50, shuffle_data=True):
         # Fit the tokenizer on the data to create a word index
         self.tokenizer.fit_on_texts([txtdata])
@@ -60,11 +63,9 @@ class DataInterpreter:
         # By default, shuffle the chunks
         if shuffle_data:
             shuffle(txtdata_split)
-        # Loop over chunks of data and convert to sequences of integers
+        # Convert all chunks of text data to sequences of integers in one call, then loop over them
         sequences = []
-        for chunk in txtdata_split:
-            # Convert the chunk of text data to a sequence of integers
-            converted_chunks = self.tokenizer.texts_to_sequences([chunk])[0]
+        for converted_chunks in self.tokenizer.texts_to_sequences(txtdata_split):
             # If converted_chunks contains more words than max_len, split it up into chunks of length max_len
             if len(converted_chunks) > max_len:
                 converted_chunks = [converted_chunks[i: i+max_len] for i in range(0, len(converted_chunks), max_len)]
@@ -84,74 +85,111 @@ class DataInterpreter:
         sequences = pad_sequences(sequences, maxlen=max_length, padding='pre')
         return max_length, sequences
 
+    # Streaming counterpart of training_data_to_padded_sequences, the prefixes are not materialized
+    # Returns max_length, the token stream and the positions of the prefix targets in the stream
+    @traced
+    def training_data_to_token_stream(self, txtdata, seq_sep="\n", max_len=50):
+        # Fit the tokenizer on the data to create a word index
+        self.tokenizer.fit_on_texts([txtdata])
+        return self.sequences_to_token_stream(self.tokenizer.texts_to_sequences(txtdata.split(seq_sep)), max_len)
+
+    # Same as training_data_to_token_stream, for token data from read_token_files
+    @traced
+    def training_tokens_to_token_stream(self, tokens, vocabulary, max_len=50):
+        self.fit_tokenizer_on_tokens(tokens, vocabulary)
+        return self.sequences_to_token_stream(self.tokens_to_sequences(tokens, vocabulary), max_len)
+
+    # Write integer sequences into a single token stream, each chunk of up to max_len words preceded by max_len - 1 zeros
+    # The padded input for the prefix ending just before position p is then simply tokens[p - (max_length - 1):p]
+    # and every non-zero token following a non-zero token is the target of exactly one prefix
+    @staticmethod
+    def sequences_to_token_stream(converted_chunks, max_len=50):
+        tokens = []
+        max_length = 0
+        for converted_chunk in converted_chunks:
+            # Split chunks with more words than max_len into chunks of length max_len
+            for i in range(0, len(converted_chunk), max_len):
+                piece = converted_chunk[i: i+max_len]
+                # A single word doesn't make a prefix, skip it
+                if len(piece) < 2:
+                    continue
+                max_length = max(max_length, len(piece))
+                tokens.extend([0] * (max_len - 1))
+                tokens.extend(piece)
+        tokens = numpy.array(tokens, dtype=numpy.int32)
+        targets = numpy.flatnonzero((tokens[1:] != 0) & (tokens[:-1] != 0)) + 1
+        return max_length, tokens, targets
+
     # Similar function to the above training_data_to_padded_sequences
     # For the testing data we won't create multiple subsequnces from each sequence
     # We will also simply drop sequences exceeding the max_len for simplicity
+    @traced
     def test_data_to_padded_sequences(self, txtdata, seq_sep, max_len=50):
-        # Split by seq_sep string, which in general will probably be a word, and loop over chunks
-        sequences = []
-        for chunk in txtdata.split(seq_sep):
-            converted_chunk = self.tokenizer.texts_to_sequences([chunk])[0]
-            # Drop sequences with length greater than max_len
-            if len(converted_chunk) > max_len:
-                continue
-            sequences.append(pad_sequences([converted_chunk], maxlen=max_len-1, padding='pre'))
+        # Split by seq_sep string, which in general will probably be a word, and convert all chunks in one call
+        converted_chunks = self.tokenizer.texts_to_sequences(txtdata.split(seq_sep))
+        # Drop sequences with length greater than max_len
+        converted_chunks = [converted_chunk for converted_chunk in converted_chunks if len(converted_chunk) <= max_len]
+        if not converted_chunks:
+            return []
         # Pad sequences up to max_len, which should be equal to the vocabulary size / size of the input layer
-        #sequences = pad_sequences(sequences, maxlen=max_len-1, padding='pre')
-        return sequences
+        sequences = pad_sequences(converted_chunks, maxlen=max_len-1, padding='pre')
+        return [sequence[None, :] for sequence in sequences]
 
-    # Read in text files from a list of paths, return a string of text data
+    # Select the files to read from a list of paths
     @staticmethod
-    def read_text_files(input_file_list, n_files_to_read=-1, sample_data=False):
-        # By default just use the entire dataset
-        data_file_list = input_file_list
+    def select_files(input_file_list, n_files_to_read=-1, sample_data=False):
         # If we want a subset of the data and sample_data is true, select a random sample from the data
         if n_files_to_read > 0 and sample_data:
-            data_file_list = sample(input_file_list, n_files_to_read)
+            return sample(input_file_list, n_files_to_read)
         # Otherwise, just take the first n files
         elif n_files_to_read > 0 and not sample_data:
-            data_file_list = input_file_list[:n_files_to_read]
-        txtdata = ""
+            return input_file_list[:n_files_to_read]
+        # By default just use the entire dataset
+        return input_file_list
+
+    # Read in text files from a list of paths, return a string of text data
+    @staticmethod
+    @traced
+    def read_text_files(input_file_list, n_files_to_read=-1, sample_data=False):
+        data_file_list = DataInterpreter.select_files(input_file_list, n_files_to_read, sample_data)
+        txtdata = []
         # Loop over file list
         for file in data_file_list:
-            # Open file and append the text to txtdata
+            # Open file and collect the text, the pieces are joined once at the end
             with open(file, "r", encoding="utf8") as datafile:
-                tmpdata = datafile.read()
                 # Remove utf8 curly quotes, tokenizer removes most punctuation but not these
-                tmpdata = tmpdata.replace(u"\u201c", "")
-                tmpdata = tmpdata.replace(u"\u201d", "")
-                tmpdata = tmpdata.replace(u"\u2018", "")
-                tmpdata = tmpdata.replace(u"\u2019", "")
-                txtdata += tmpdata
-        return txtdata
+                txtdata.append(clean_text(datafile.read()))
+        return "".join(txtdata)
+
+    # Token counterpart of read_text_files, the files are read through the on-disk CorpusCache
+    # Only files that are new or changed since the last run are read and parsed, the rest comes from a memory map
+    # Returns an array of cache word ids, with CorpusCache.LINE_BREAK between lines, and the cache vocabulary
+    @staticmethod
+    @traced
+    def read_token_files(input_file_list, n_files_to_read=-1, sample_data=False, cache_dir="./cache/corpus/"):
+        data_file_list = DataInterpreter.select_files(input_file_list, n_files_to_read, sample_data)
+        cache = CorpusCache(cache_dir).update(data_file_list)
+        return cache.get_tokens(data_file_list), cache.vocabulary
 
     # Simplify the text data by identifying similar pairs words and keeping only one of the pair
-    # Similarity of words determined using the Levenstein's distance -- from the nltk library's edit_distance
-    # This can be incredibly computation expensive for a large amount of text data so we will restrict it to common words
+    # Similarity of words determined using the Levenstein's distance, similar pairs are found with a WordSimilarityIndex
+    # Words that appear less often than min_freq are not considered for simplification
     @staticmethod
+    @traced
     def simplify_text_data(txtdata, min_dist=2, min_freq=100):
-        tmp_tokenizer = Tokenizer()
+        tmp_tokenizer = FastTokenizer()
         tmp_tokenizer.fit_on_texts([txtdata]) # Fit the textdata to get a word index
         # Sort the tokenizer word counts by the frequency with which each word appears
         sorted_word_counts = sorted(tmp_tokenizer.word_counts.items(), key=lambda x: x[1], reverse=True)
         # Filter out words that appear less often than min_freq
         filtered_word_counts = list(filter(lambda x: x[1] > min_freq, sorted_word_counts))
-        # Length of the filtered list is the new vocabulary size, i.e. tokenizer.num_words
-        # Use itertools to get all possible unique pair-wise combinations of words in the filtered word_index
-        pairs = list(itertools.combinations([filtered_word_counts[i][0] for i in range(len(filtered_word_counts))], 2))
-        # Loop over pairs and calculate the distance, don't consider words that have already been replaced
-        replaced_words = []
-        for pair in pairs:
-            dist = edit_distance(pair[0], pair[1])
-            # If the distance is less than the min_dist and we haven't already replaced one of the words, replace
-            if dist < min_dist and not (pair[0] in replaced_words or pair[1] in replaced_words):
-                # Use regular expressions to identify word boundaries and do the string replacement
-                txtdata = sub(r"\b%s\b" % pair[1], pair[0], txtdata)
-                replaced_words.append(pair[1])
-        return txtdata
+        # For pairs with distance < min_dist the less frequent word is replaced by the more frequent one
+        merge_map = WordSimilarityIndex([x[0] for x in filtered_word_counts], min_dist).merge_map()
+        return DataInterpreter.replace_words(txtdata, merge_map)
 
     # Similar to the above simplify_text_data method, but we pass an existing tokenizer (one used for training)
     @staticmethod
+    @traced
     def simplify_text_data_with_tokenizer(txtdata, tokenizer, min_dist=2):
         # Determine the number of words to use for simplification from the tokenizer
         num_words = tokenizer.num_words
@@ -161,16 +199,91 @@ class DataInterpreter:
         # If num_words was set, our training will only have considered the first num_words most frequent words
         # So we sort the tokenizer by word counts and keep only the first num_words elements
         sorted_word_counts = sorted(tokenizer.word_counts.items(), key=lambda x: x[1], reverse=True)[:num_words]
-        # Use itertools to get all possible unique pair-wise combinations of words in sorted_word_counts
-        pairs = list(itertools.combinations([sorted_word_counts[i][0] for i in range(len(sorted_word_counts))], 2))
-        # Loop over pairs and calculate the distance, don't consider words that have already been replaced
-        replaced_words = []
-        for pair in pairs:
-            dist = edit_distance(pair[0], pair[1])
-            # If the distance is less than the min_dist and we haven't already replaced one of the words, replace
-            if dist < min_dist and not (pair[0] in replaced_words or pair[1] in replaced_words):
-                # Use regular expressions to identify word boundaries and do the string replacement
-                from re import sub
-                txtdata = sub(r"\b%s\b" % pair[1], pair[0], txtdata)
-                replaced_words.append(pair[1])
-        return txtdata
\ No newline at end of file
+        merge_map = WordSimilarityIndex([x[0] for x in sorted_word_counts], min_dist).merge_map()
+        return DataInterpreter.replace_words(txtdata, merge_map)
+
+    # Replace whole words in the text data following merge_map, a dictionary of word -> replacement
+    # Replacements never chain (a replacement word is never itself replaced), so all words made only of word
+    # characters are replaced in a single pass over the text; \bword\b matches exactly such a run of word characters
+    @staticmethod
+    def replace_words(txtdata, merge_map):
+        word_merges = {word: replacement for word, replacement in merge_map.items() if fullmatch(r"\w+", word)}
+        if word_merges:
+            txtdata = sub(r"\w+", lambda match: word_merges.get(match.group(0), match.group(0)), txtdata)
+        # Any other words (e.g. starting with a byte order mark) use regular expressions on word boundaries
+        other_words = sorted([word for word in merge_map if word not in word_merges], key=len, reverse=True)
+        if other_words:
+            txtdata = sub(r"\b(?:%s)\b" % "|".join(escape(word) for word in other_words),
+                          lambda match: merge_map[match.group(0)], txtdata)
+        return txtdata
+
+    # Token counterpart of simplify_text_data, works on cache word ids from read_token_files
+    # Returns a new token array where replaced words carry the id of the word replacing them
+    @staticmethod
+    @traced
+    def simplify_token_data(tokens, vocabulary, min_dist=2, min_freq=100):
+        word_counts = CorpusCache.word_counts(tokens, vocabulary)
+        sorted_word_counts = sorted(word_counts.items(), key=lambda x: x[1], reverse=True)
+        filtered_word_counts = list(filter(lambda x: x[1] > min_freq, sorted_word_counts))
+        merge_map = WordSimilarityIndex([x[0] for x in filtered_word_counts], min_dist).merge_map()
+        return DataInterpreter.replace_word_tokens(tokens, vocabulary, merge_map)
+
+    # Token counterpart of simplify_text_data_with_tokenizer
+    @staticmethod
+    @traced
+    def simplify_token_data_with_tokenizer(tokens, vocabulary, tokenizer, min_dist=2):
+        num_words = tokenizer.num_words
+        if not num_words:  # If num_words wasn't set for the tokenizer, use all words
+            num_words = len(tokenizer.word_index.items())
+        sorted_word_counts = sorted(tokenizer.word_counts.items(), key=lambda x: x[1], reverse=True)[:num_words]
+        merge_map = WordSimilarityIndex([x[0] for x in sorted_word_counts], min_dist).merge_map()
+        return DataInterpreter.replace_word_tokens(tokens, vocabulary, merge_map)
+
+    # Token counterpart of replace_words, a single lookup through a translation table
+    @staticmethod
+    def replace_word_tokens(tokens, vocabulary, merge_map):
+        if not merge_map:
+            return tokens
+        word_ids = {word: i for i, word in enumerate(vocabulary)}
+        table = CorpusCache.translation_table(vocabulary, word_ids, merge_map, CorpusCache.LINE_BREAK)
+        return table[tokens].astype(numpy.int32)
+
+    # Token counterpart of set_num_words
+    @traced
+    def set_num_words_from_tokens(self, tokens, vocabulary, min_freq=100):
+        word_counts = CorpusCache.word_counts(tokens, vocabulary)
+        sorted_word_counts = sorted(word_counts.items(), key=lambda x: x[1], reverse=True)
+        filtered_word_counts = list(filter(lambda x: x[1] > min_freq, sorted_word_counts))
+        self.tokenizer.num_words = len(filtered_word_counts)
+        return filtered_word_counts
+
+    # Fit the tokenizer on token data the same way fit_on_texts([txtdata]) would on the equivalent text
+    @traced
+    def fit_tokenizer_on_tokens(self, tokens, vocabulary):
+        self.tokenizer.document_count += 1
+        for word, count in CorpusCache.word_counts(tokens, vocabulary).items():
+            self.tokenizer.word_counts[word] = self.tokenizer.word_counts.get(word, 0) + count
+            self.tokenizer.word_docs[word] += 1
+        self.tokenizer.build_index()
+
+    # Table translating cache word ids into tokenizer indices, words dropped by texts_to_sequences map to 0
+    def tokenizer_translation_table(self, vocabulary, line_break_id=0):
+        table = CorpusCache.translation_table(vocabulary, self.tokenizer.word_index, line_break_id=line_break_id)
+        if self.tokenizer.num_words:  # texts_to_sequences drops words beyond num_words
+            table[table >= self.tokenizer.num_words] = 0
+        return table
+
+    # Convert token data to tokenizer indices, one list of indices per line, like texts_to_sequences on each line
+    @traced
+    def tokens_to_sequences(self, tokens, vocabulary):
+        indices = self.tokenizer_translation_table(vocabulary, line_break_id=-1)[tokens]
+        indices = indices[indices != 0]
+        lines = numpy.split(indices, numpy.flatnonzero(indices == -1))
+        return [line[line != -1].tolist() for line in lines]
+
+    # Convert token data to a single array of tokenizer indices, ignoring line breaks and dropped words
+    # Equivalent to texts_to_sequences([txtdata])[0] on the equivalent text
+    @traced
+    def tokens_to_indices(self, tokens, vocabulary):
+        indices = self.tokenizer_translation_table(vocabulary)[tokens]
+        return indices[indices != 0]
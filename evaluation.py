@@ -0,0 +1,256 @@
+# Imports of built-in libraries
+import sys
+import getopt
+import json
+from os import environ
+# This will stop tensorflow from spamming unnecessary error messages about its GPU implementation
+# Needs to set before we import anything from keras/tensorflow
+environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
+
+import numpy
+
+from data_interpreter import DataInterpreter
+from prefix_batches import PrefixBatches
+from instrumentation import traced, enable_tracing, TRACE_ENV
+# Import the tokenizer, it needs neither keras nor tensorflow
+from fast_tokenizer import FastTokenizer
+
+
+# Model and tokenizer produced by training.py
+MODEL_PATH = "./model_51_file_training.h5"
+TOKENIZER_PATH = "./tokenizer_51_file_training.vocab"
+# Default model of the quantized backend, exported by quantized_model.py
+QUANTIZED_PATH = "./model_51_file_training.qmodel"
+
+
+# Class accumulating next-word prediction metrics batch by batch, memory only depends on the vocabulary size
+# - cross-entropy (mean negative log probability of the actual next word) and perplexity, exp(cross-entropy)
+# - top-k accuracy, the fraction of predictions where the actual word is among the k most probable words
+# - calibration of the most probable word: predictions are binned by its probability, and in a calibrated model the
+#   mean probability of a bin matches the fraction of its predictions that are right. The expected calibration error
+#   is the prediction weighted mean difference between the two
+# - calibration per word: the probability the model gives a word summed over all predictions, i.e. how often the model
+#   expects to see it, against how often it actually comes next
+class EvaluationMetrics:
+    def __init__(self, vocab_size, top_k=(1, 5), n_bins=10):
+        self.top_k = top_k
+        self.n_bins = n_bins
+        self.count = 0
+        self.log_loss = 0.0
+        self.top_k_hits = numpy.zeros(len(top_k), dtype=numpy.int64)
+        self.bin_counts = numpy.zeros(n_bins, dtype=numpy.int64)
+        self.bin_confidence = numpy.zeros(n_bins)
+        self.bin_correct = numpy.zeros(n_bins)
+        self.expected_counts = numpy.zeros(vocab_size)
+        self.observed_counts = numpy.zeros(vocab_size, dtype=numpy.int64)
+
+    # Add a batch of predicted probability vectors and the indices of the words that actually came next
+    def add(self, probabilities, targets):
+        targets = numpy.asarray(targets)
+        rows = numpy.arange(len(targets))
+        target_probabilities = probabilities[rows, targets]
+        self.count += len(targets)
+        self.log_loss -= numpy.sum(numpy.log(numpy.maximum(target_probabilities.astype(numpy.float64), 1e-30)))
+        # Rank of the actual word, the number of words the model found more probable
+        ranks = numpy.sum(probabilities > target_probabilities[:, None], axis=1)
+        self.top_k_hits += [numpy.sum(ranks < k) for k in self.top_k]
+        confidence = probabilities.max(axis=1).astype(numpy.float64)
+        bins = numpy.minimum((confidence * self.n_bins).astype(numpy.int64), self.n_bins - 1)
+        self.bin_counts += numpy.bincount(bins, minlength=self.n_bins)
+        self.bin_confidence += numpy.bincount(bins, weights=confidence, minlength=self.n_bins)
+        self.bin_correct += numpy.bincount(bins, weights=(ranks == 0), minlength=self.n_bins)
+        self.expected_counts += numpy.sum(probabilities, axis=0, dtype=numpy.float64)
+        self.observed_counts += numpy.bincount(targets, minlength=len(self.observed_counts))
+
+    def cross_entropy(self):
+        return self.log_loss / self.count if self.count else float("nan")
+
+    def perplexity(self):
+        return float(numpy.exp(self.cross_entropy()))
+
+    def top_k_accuracy(self):
+        return {k: hits / self.count if self.count else float("nan") for k, hits in zip(self.top_k, self.top_k_hits)}
+
+    # Mean probability of the most probable word, accuracy and number of predictions of every non-empty bin
+    def reliability(self):
+        return [(self.bin_confidence[i] / self.bin_counts[i], self.bin_correct[i] / self.bin_counts[i],
+                 int(self.bin_counts[i])) for i in range(self.n_bins) if self.bin_counts[i]]
+
+    def expected_calibration_error(self):
+        return sum(count * abs(confidence - accuracy) for confidence, accuracy, count in self.reliability()) / \
+            max(self.count, 1)
+
+    # Words whose expected and observed counts differ the most, as (index, expected, observed), most over or under
+    # predicted first. Only words that came next at least min_count times are considered
+    def miscalibrated_words(self, n=10, min_count=20):
+        indices = numpy.flatnonzero(self.observed_counts >= min_count)
+        ratios = numpy.abs(numpy.log(self.expected_counts[indices] / self.observed_counts[indices]))
+        return [(int(index), float(self.expected_counts[index]), int(self.observed_counts[index]))
+                for index in indices[numpy.argsort(-ratios)[:n]]]
+
+    def summary(self):
+        return {"predictions": self.count, "cross_entropy": self.cross_entropy(), "perplexity": self.perplexity(),
+                "top_k_accuracy": {str(k): accuracy for k, accuracy in self.top_k_accuracy().items()},
+                "expected_calibration_error": self.expected_calibration_error(),
+                "reliability": [{"confidence": confidence, "accuracy": accuracy, "predictions": count}
+                                for confidence, accuracy, count in self.reliability()]}
+
+
+# Next-word predictions over data files, as a PrefixBatches of batches of padded prefixes and the words following them
+# The files are read through the corpus cache and simplified with the tokenizer like the testing data of
+# accuracy_assessment.py, and lines are split into chunks of at most input_length + 1 words like the training data
+@traced
+def prediction_stream(files, tokenizer, input_length, batch_size=4096):
+    data_interp = DataInterpreter()
+    data_interp.tokenizer = tokenizer
+    tokens, vocabulary = data_interp.read_token_files(files)
+    tokens = data_interp.simplify_token_data_with_tokenizer(tokens, vocabulary, tokenizer)
+    _, tokens, targets = data_interp.sequences_to_token_stream(data_interp.tokens_to_sequences(tokens, vocabulary),
+                                                               max_len=input_length + 1)
+    return PrefixBatches(tokens, targets, input_length, batch_size, shuffle_data=False)
+
+
+# Score every prediction of a PrefixBatches with the model, one batch at a time
+@traced
+def evaluate(model, predictions, vocab_size, verbose=True):
+    metrics = EvaluationMetrics(vocab_size)
+    for index in range(len(predictions)):
+        inputs, targets = predictions[index]
+        metrics.add(model.get_probability(inputs, batch_size=len(inputs)), targets)
+        if verbose:
+            print("Batch %d/%d, perplexity so far %.3f" % (index + 1, len(predictions), metrics.perplexity()),
+                  end="\r" if index + 1 < len(predictions) else "\n")
+    return metrics
+
+
+# Load a model trained by training.py, see testing.py for the backends
+def load_model(model_path, backend="keras"):
+    if backend == "numpy":
+        from numpy_model import NumpyModel
+        model = NumpyModel()
+    elif backend == "quantized":
+        from quantized_model import QuantizedModel
+        model = QuantizedModel()
+    else:
+        from nn_model import NNModel
+        model = NNModel()
+    model.load_model(model_path)
+    return model
+
+
+def print_help():
+    print("Usage:")
+    print("python evaluation.py [-m <model>] [-t <tokenizer>] [-n <n_files>] [-c <chunk_size>] [-b <backend>]")
+    print("       [-o <report>] [-g <perplexity>] [--trace <file>]")
+    print("Where")
+    print("<model> is the model to evaluate (default %s, or %s for the quantized backend)"
+          % (MODEL_PATH, QUANTIZED_PATH))
+    print("<tokenizer> is the vocabulary the model was trained with (default %s)" % TOKENIZER_PATH)
+    print("<n_files> is the number of testing files to evaluate on (default all of them)")
+    print("<chunk_size> is the number of predictions scored per model call (default 4096)")
+    print("<backend> is keras (default), numpy or quantized, numpy scores sequences without loading tensorflow")
+    print("          and quantized does so from an artifact written by quantized_model.py")
+    print("<report> is a json file to write the results to")
+    print("<perplexity> makes the script exit with status 1 when the perplexity is higher, as a check for new models")
+    print("--trace <file> writes a timing trace of the run to <file> and prints a summary, as does setting %s=<file>"
+          % TRACE_ENV)
+
+
+def main():
+    # Retrieve arguments, print help() if that fails
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hm:t:n:c:b:o:g:",
+                                   ["help", "model=", "tokenizer=", "nfiles=", "chunksize=", "backend=", "output=",
+                                    "gate=", "trace="])
+    except getopt.GetoptError:
+        print_help()
+        sys.exit(2)
+    model_path = None
+    tokenizer_path = TOKENIZER_PATH
+    n_files = -1
+    chunk_size = 4096
+    backend = "keras"
+    report_path = None
+    max_perplexity = None
+    trace_path = None
+    for opt, arg in opts:
+        if opt in ("-h", "--help"):
+            print_help()
+            sys.exit()
+        elif opt in ("-m", "--model"):
+            model_path = arg
+        elif opt in ("-t", "--tokenizer"):
+            tokenizer_path = arg
+        elif opt in ("-n", "--nfiles", "-c", "--chunksize"):
+            try:
+                value = int(arg)
+            except ValueError:
+                print("%s %s couldn't be converted to an int. \n" % (opt, arg))
+                print_help()
+                sys.exit(2)
+            if value <= 0:
+                print("%s %s should be a positive integer. \n" % (opt, arg))
+                print_help()
+                sys.exit(2)
+            if opt in ("-n", "--nfiles"):
+                n_files = value
+            else:
+                chunk_size = value
+        elif opt in ("-b", "--backend"):
+            if arg not in ("keras", "numpy", "quantized"):
+                print("--backend %s should be keras, numpy or quantized. \n" % arg)
+                print_help()
+                sys.exit(2)
+            backend = arg
+        elif opt in ("-o", "--output"):
+            report_path = arg
+        elif opt in ("-g", "--gate"):
+            try:
+                max_perplexity = float(arg)
+            except ValueError:
+                print("--gate %s couldn't be converted to a float. \n" % arg)
+                print_help()
+                sys.exit(2)
+        elif opt == "--trace":
+            trace_path = arg
+    # Time the run if --trace or the LV_TRACE environment variable was given
+    enable_tracing(trace_path)
+    if model_path is None:
+        model_path = QUANTIZED_PATH if backend == "quantized" else MODEL_PATH
+
+    tokenizer = FastTokenizer.load(tokenizer_path)
+    model = load_model(model_path, backend)
+    files = DataInterpreter.select_files(DataInterpreter().testing_files, n_files)
+    predictions = prediction_stream(files, tokenizer, model.get_input_length(), chunk_size)
+    print("Evaluating %d predictions from %d testing files" % (len(predictions.targets), len(files)))
+    # The output layer has a neuron per word kept by num_words, plus the padding index
+    vocab_size = (tokenizer.num_words or len(tokenizer.word_index)) + 1
+    metrics = evaluate(model, predictions, vocab_size)
+
+    summary = metrics.summary()
+    print("Cross-entropy %.4f nats, perplexity %.3f" % (summary["cross_entropy"], summary["perplexity"]))
+    for k, accuracy in summary["top_k_accuracy"].items():
+        print("Top-%s accuracy %.4f" % (k, accuracy))
+    print("Expected calibration error %.4f" % summary["expected_calibration_error"])
+    # Binned by the probability of the most probable word
+    print("%12s %10s %12s" % ("confidence", "accuracy", "predictions"))
+    for confidence, accuracy, count in metrics.reliability():
+        print("%12.4f %10.4f %12d" % (confidence, accuracy, count))
+    print("Most miscalibrated words (expected vs observed count):")
+    words = []
+    for index, expected, observed in metrics.miscalibrated_words():
+        words.append({"word": tokenizer.index_word[index], "expected": expected, "observed": observed})
+        print("%-20s %12.1f %10d" % (tokenizer.index_word[index], expected, observed))
+    summary.update({"model": model_path, "tokenizer": tokenizer_path, "files": len(files),
+                    "miscalibrated_words": words})
+    if report_path:
+        with open(report_path, "w", encoding="utf-8") as report_file:
+            json.dump(summary, report_file, ensure_ascii=False, indent=1)
+        print("Report written to %s" % report_path)
+    if max_perplexity is not None and not summary["perplexity"] <= max_perplexity:
+        print("Perplexity %.3f is above the gate of %.3f" % (summary["perplexity"], max_perplexity))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
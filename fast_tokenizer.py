@@ -0,0 +1,254 @@
+# Imports of built-in libraries
+import sys
+import getopt
+import json
+import struct
+from array import array
+from collections import OrderedDict, defaultdict
+from itertools import repeat
+
+from text_processing import KERAS_FILTERS, text_to_words
+from instrumentation import traced
+
+
+# Drop-in replacement for the keras Tokenizer that encodes a whole batch of texts with one call
+# Words are split, filtered and lower-cased exactly like keras' text_to_word_sequence, and the index, num_words and
+# oov_token rules of texts_to_sequences are folded into a single word -> index lookup, so encoding a batch is one
+# split per text, one dict lookup per word and a few numpy operations to place the indices in a padded array
+# The vocabulary can be saved to a compact binary file that loads without parsing json, see save and load
+class FastTokenizer:
+    MAGIC = b"VOCAB1\n"
+
+    def __init__(self, num_words=None, filters=KERAS_FILTERS, lower=True, split=" ", oov_token=None,
+                 document_count=0):
+        self.num_words = num_words
+        self.filters = filters
+        self.lower = lower
+        self.split = split
+        self.oov_token = oov_token
+        self.document_count = document_count
+        self.word_counts = OrderedDict()
+        self.word_docs = defaultdict(int)
+        self.index_docs = defaultdict(int)
+        self.word_index = {}
+        self.index_word = {}
+        self.lookup_key = None
+        self.lookup = {}
+
+    # Split a text into words exactly like keras' text_to_word_sequence with this tokenizer's settings
+    def text_to_words(self, text):
+        return text_to_words(text, self.filters, self.lower, self.split)
+
+    # Update the vocabulary with a list of texts, same counts and word index as keras' fit_on_texts
+    @traced
+    def fit_on_texts(self, texts):
+        for text in texts:
+            self.document_count += 1
+            words = self.text_to_words(text)
+            for word in words:
+                self.word_counts[word] = self.word_counts.get(word, 0) + 1
+            for word in set(words):
+                self.word_docs[word] += 1
+        self.build_index()
+
+    # Rebuild word_index, index_word and index_docs from the word counts, like keras does at the end of fit_on_texts
+    # Words are sorted by decreasing count with ties kept in order of first appearance, the oov_token gets index 1
+    def build_index(self):
+        sorted_words = sorted(self.word_counts.items(), key=lambda x: x[1], reverse=True)
+        sorted_words = ([self.oov_token] if self.oov_token is not None else []) + [x[0] for x in sorted_words]
+        self.word_index = dict(zip(sorted_words, range(1, len(sorted_words) + 1)))
+        self.index_word = {index: word for word, index in self.word_index.items()}
+        self.index_docs = defaultdict(int, {self.word_index[word]: count for word, count in self.word_docs.items()})
+
+    # Word -> index lookup applying the num_words and oov_token rules of texts_to_sequences
+    # Words that texts_to_sequences would drop are left out, it is rebuilt whenever the index or num_words change
+    def get_lookup(self):
+        key = (id(self.word_index), len(self.word_index), self.num_words, self.oov_token)
+        if key != self.lookup_key:
+            oov_index = self.word_index.get(self.oov_token)
+            if self.num_words:
+                self.lookup = {word: index if index < self.num_words else oov_index
+                               for word, index in self.word_index.items()}
+                if oov_index is None:
+                    self.lookup = {word: index for word, index in self.lookup.items() if index is not None}
+            else:
+                self.lookup = dict(self.word_index)
+            self.lookup_key = key
+        return self.lookup
+
+    # Encode a batch of texts to a flat array of word indices and the number of indices of each text
+    def encode(self, texts):
+        import numpy
+        lookup = self.get_lookup()
+        # Unknown words map to the oov index, or to 0 and are then dropped
+        default = self.word_index.get(self.oov_token, 0) if self.oov_token is not None else 0
+        words = []
+        lengths = []
+        for text in texts:
+            text_words = self.text_to_words(text)
+            words.extend(text_words)
+            lengths.append(len(text_words))
+        indices = numpy.fromiter(map(lookup.get, words, repeat(default)), dtype=numpy.int64, count=len(words))
+        lengths = numpy.array(lengths, dtype=numpy.int64)
+        dropped = indices == 0
+        if dropped.any():
+            rows = numpy.repeat(numpy.arange(len(lengths)), lengths)
+            lengths = lengths - numpy.bincount(rows[dropped], minlength=len(lengths))
+            indices = indices[~dropped]
+        return indices, lengths
+
+    # Same output as keras' texts_to_sequences, one list of indices per text
+    @traced
+    def texts_to_sequences(self, texts):
+        indices, lengths = self.encode(texts)
+        starts = [0] + lengths.cumsum().tolist()
+        indices = indices.tolist()
+        return [indices[start:end] for start, end in zip(starts[:-1], starts[1:])]
+
+    # Encode a batch of texts straight into a padded 2D array, like pad_sequences(texts_to_sequences(texts), ...)
+    # maxlen defaults to the length of the longest text, padding and truncating are "pre" or "post"
+    @traced
+    def texts_to_array(self, texts, maxlen=None, padding="pre", truncating="pre", dtype="int32"):
+        indices, lengths = self.encode(texts)
+        return self.pad_indices(indices, lengths, maxlen, padding, truncating, dtype)
+
+    # Place the concatenated indices of several sequences, lengths[i] of them for sequence i, in a padded 2D array
+    @staticmethod
+    def pad_indices(indices, lengths, maxlen=None, padding="pre", truncating="pre", dtype="int32"):
+        import numpy
+        if maxlen is None:
+            maxlen = int(lengths.max()) if len(lengths) else 0
+        sequences = numpy.zeros((len(lengths), maxlen), dtype=dtype)
+        if not len(indices):
+            return sequences
+        rows = numpy.repeat(numpy.arange(len(lengths)), lengths)
+        # Position of every index within its text
+        positions = numpy.arange(len(indices)) - (lengths.cumsum() - lengths)[rows]
+        kept = numpy.minimum(lengths, maxlen)
+        # Position within the text of the first index that is kept
+        offsets = (lengths - kept if truncating == "pre" else numpy.zeros_like(lengths))[rows]
+        keep = (positions >= offsets) & (positions < offsets + kept[rows])
+        columns = positions - offsets
+        if padding == "pre":
+            columns += (maxlen - kept)[rows]
+        sequences[rows[keep], columns[keep]] = indices[keep]
+        return sequences
+
+    # Keras compatible json, can be read by keras' tokenizer_from_json and by from_json
+    def to_json(self, **kwargs):
+        config = {"num_words": self.num_words, "filters": self.filters, "lower": self.lower, "split": self.split,
+                  "char_level": False, "oov_token": self.oov_token, "document_count": self.document_count,
+                  "word_counts": json.dumps(self.word_counts), "word_docs": json.dumps(self.word_docs),
+                  "index_docs": json.dumps(self.index_docs), "index_word": json.dumps(self.index_word),
+                  "word_index": json.dumps(self.word_index)}
+        return json.dumps({"class_name": "Tokenizer", "config": config}, **kwargs)
+
+    # Create a tokenizer from the json written by to_json or by the keras Tokenizer
+    @classmethod
+    def from_json(cls, json_string):
+        config = json.loads(json_string)["config"]
+        if config.get("char_level"):
+            raise ValueError("Character level tokenizers are not supported")
+        tokenizer = cls(config["num_words"], config["filters"], config["lower"], config["split"],
+                        config["oov_token"], config["document_count"])
+        tokenizer.word_counts = OrderedDict(json.loads(config["word_counts"]))
+        tokenizer.word_docs = defaultdict(int, json.loads(config["word_docs"]))
+        tokenizer.index_docs = defaultdict(int, {int(k): v for k, v in json.loads(config["index_docs"]).items()})
+        tokenizer.word_index = json.loads(config["word_index"])
+        tokenizer.index_word = {int(k): v for k, v in json.loads(config["index_word"]).items()}
+        return tokenizer
+
+    # Write the vocabulary to a compact binary file:
+    # magic, header length (uint32), json header with the settings, then for every word in index order its count
+    # (int64), document count (int64) and position in word_counts (int32, -1 for the oov token), and finally the
+    # words themselves as utf8 separated by null characters. All numbers are little endian
+    def save(self, path):
+        words = [self.index_word[index] for index in range(1, len(self.index_word) + 1)]
+        positions = {word: i for i, word in enumerate(self.word_counts)}
+        counts = array("q", [self.word_counts.get(word, 0) for word in words])
+        docs = array("q", [self.word_docs.get(word, 0) for word in words])
+        order = array("i", [positions.get(word, -1) for word in words])
+        if sys.byteorder == "big":
+            for values in (counts, docs, order):
+                values.byteswap()
+        header = json.dumps({"num_words": self.num_words, "filters": self.filters, "lower": self.lower,
+                             "split": self.split, "oov_token": self.oov_token,
+                             "document_count": self.document_count, "size": len(words)}).encode("utf-8")
+        with open(path, "wb") as vocab_file:
+            vocab_file.write(self.MAGIC)
+            vocab_file.write(struct.pack("<I", len(header)))
+            vocab_file.write(header)
+            for values in (counts, docs, order):
+                vocab_file.write(values.tobytes())
+            vocab_file.write("\0".join(words).encode("utf-8"))
+
+    # Load a tokenizer from a binary vocabulary file written by save, or from a keras tokenizer json file
+    @classmethod
+    @traced
+    def load(cls, path):
+        with open(path, "rb") as vocab_file:
+            data = vocab_file.read()
+        if not data.startswith(cls.MAGIC):
+            # training.py writes the tokenizer json as a json encoded string
+            return cls.from_json(json.loads(data.decode("utf-8")))
+        start = len(cls.MAGIC) + 4
+        header_length, = struct.unpack_from("<I", data, len(cls.MAGIC))
+        header = json.loads(data[start:start + header_length].decode("utf-8"))
+        size = header.pop("size")
+        start += header_length
+        arrays = []
+        for typecode in ("q", "q", "i"):
+            values = array(typecode)
+            end = start + size * values.itemsize
+            values.frombytes(data[start:end])
+            if sys.byteorder == "big":
+                values.byteswap()
+            arrays.append(values)
+            start = end
+        counts, docs, order = arrays
+        words = data[start:].decode("utf-8").split("\0") if size else []
+        tokenizer = cls(**header)
+        tokenizer.word_index = dict(zip(words, range(1, size + 1)))
+        tokenizer.index_word = dict(zip(range(1, size + 1), words))
+        counted = sorted((position, index) for index, position in enumerate(order) if position >= 0)
+        tokenizer.word_counts = OrderedDict((words[index], counts[index]) for _, index in counted)
+        tokenizer.word_docs = defaultdict(int, ((words[index], docs[index]) for _, index in counted))
+        tokenizer.index_docs = defaultdict(int, ((index + 1, docs[index]) for _, index in counted))
+        return tokenizer
+
+
+# Pad lists of word indices into a 2D array with the same arguments and result as keras' pad_sequences
+def pad_sequences(sequences, maxlen=None, padding="pre", truncating="pre", dtype="int32"):
+    import numpy
+    lengths = numpy.array([len(sequence) for sequence in sequences], dtype=numpy.int64)
+    indices = numpy.fromiter((index for sequence in sequences for index in sequence), dtype=numpy.int64,
+                             count=int(lengths.sum()))
+    return FastTokenizer.pad_indices(indices, lengths, maxlen, padding, truncating, dtype)
+
+
+def print_help():
+    print("Usage:")
+    print("python fast_tokenizer.py <tokenizer_json> <vocab_file>")
+    print("Converts a tokenizer json written by training.py to the compact binary vocabulary format")
+
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "h", ["help"])
+    except getopt.GetoptError:
+        print_help()
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt in ("-h", "--help"):
+            print_help()
+            sys.exit()
+    if len(args) != 2:
+        print_help()
+        sys.exit(2)
+    tokenizer = FastTokenizer.load(args[0])
+    tokenizer.save(args[1])
+    print("Wrote %d words to %s" % (len(tokenizer.word_index), args[1]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+import numpy
+
+from instrumentation import traced
+
+
+# Class to measure P(W|d) directly from data for every word of the vocabulary at once
+# Splitting an array of tokens at every occurrence of a word gives one fragment more than the word has occurrences,
+# P(W|d) is the fraction of these fragments that are exactly d tokens long
+# The fragment lengths of all words are found in one pass: sorting the token positions by word groups the positions
+# of each word together, in increasing order, so the gaps between occurrences are differences of neighbouring positions
+class GapHistogram:
+    @traced
+    def __init__(self, tokens, vocab_size, max_distance):
+        tokens = numpy.asarray(tokens)
+        n_tokens = len(tokens)
+        self.max_distance = max_distance
+        self.occurrences = numpy.bincount(tokens, minlength=vocab_size)[:vocab_size]
+        self.counts = numpy.zeros((vocab_size, max_distance + 1), dtype=numpy.int64)
+        # A word that never appears leaves the whole array as a single fragment
+        if n_tokens <= max_distance:
+            self.counts[self.occurrences == 0, n_tokens] = 1
+        if n_tokens == 0:
+            return
+        # Positions of every token, grouped by word and in increasing order within each word
+        positions = numpy.argsort(tokens, kind="stable")
+        words = tokens[positions]
+        # Gaps between consecutive occurrences of the same word
+        same_word = words[1:] == words[:-1]
+        gap_words = [words[1:][same_word]]
+        gaps = [(numpy.diff(positions) - 1)[same_word]]
+        # Fragments before the first and after the last occurrence of each word
+        first = numpy.flatnonzero(numpy.concatenate(([True], ~same_word)))
+        last = numpy.flatnonzero(numpy.concatenate((~same_word, [True])))
+        gap_words += [words[first], words[last]]
+        gaps += [positions[first], n_tokens - 1 - positions[last]]
+        gap_words = numpy.concatenate(gap_words)
+        gaps = numpy.concatenate(gaps)
+        # Histogram of the gap lengths up to max_distance for every word
+        keep = gaps <= max_distance
+        counts = numpy.bincount(gap_words[keep] * (max_distance + 1) + gaps[keep],
+                                minlength=vocab_size * (max_distance + 1))
+        self.counts += counts[:vocab_size * (max_distance + 1)].reshape(vocab_size, max_distance + 1)
+
+    # Return a words x distances table of P(W|d), rows are indexed by word index
+    def probability_table(self, distances):
+        return self.counts[:, list(distances)] / (self.occurrences[:, None] + 1)
@@ -0,0 +1,302 @@
+# Imports of built-in libraries
+import sys
+import getopt
+import json
+import time
+import threading
+from collections import deque
+from concurrent.futures import Future
+from functools import partial
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from os import environ
+from queue import Queue, Empty
+# This will stop tensorflow from spamming unnecessary error messages about its GPU implementation
+# Needs to set before we import anything from keras/tensorflow
+environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
+import numpy
+# Import the sampler and tokenizer, the model classes are imported by load_model for the selected backend only
+from sequence_sampler import SequenceSampler
+from fast_tokenizer import FastTokenizer
+
+
+# Model and tokenizer produced by training.py
+MODEL_PATH = "./model_51_file_training.h5"
+# Quantized artifact exported from the model by quantized_model.py, used by the quantized backend
+QUANTIZED_PATH = "./model_51_file_training.qmodel"
+# Gap and n-gram counts of the training files written by count_model.py, used by the count backend
+COUNT_PATH = "./count_model.npz"
+TOKENIZER_PATH = "./tokenizer_51_file_training.vocab"
+BACKENDS = ("keras", "numpy", "quantized", "count")
+
+
+# Load the tokenizer used during training from its binary vocabulary file
+def load_tokenizer(tokenizer_path=TOKENIZER_PATH):
+    return FastTokenizer.load(tokenizer_path)
+
+
+# Load the model used during training
+# The keras backend is the trained NNModel, the numpy backend runs the same forward pass without importing tensorflow
+# and the quantized backend runs it on the memory-mapped artifact written by quantized_model.py
+# The count backend measures P(W|d) from the training files instead of using the network
+def load_model(backend="keras"):
+    if backend == "count":
+        from count_model import CountModel
+        model = CountModel()
+        model.load_model(COUNT_PATH)
+        return model
+    if backend == "numpy":
+        from numpy_model import NumpyModel
+        model = NumpyModel()
+        model.load_model(MODEL_PATH)
+        return model
+    if backend == "quantized":
+        from quantized_model import QuantizedModel
+        model = QuantizedModel()
+        model.load_model(QUANTIZED_PATH)
+        return model
+    from nn_model import NNModel
+    model = NNModel()
+    model.load_model(MODEL_PATH)
+    return model
+
+
+# Class that coalesces concurrent get_probability calls into micro-batches
+# A single worker thread owns the model: it waits for a first request, keeps collecting requests until max_batch
+# rows are queued or max_wait seconds have passed, and scores them all with one call to the model
+class MicroBatcher:
+    def __init__(self, model_loader, max_batch=4096, max_wait=0.005):
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.requests = Queue()
+        self.ready = threading.Event()
+        self.input_length = None
+        self.model = None  # Only read outside the worker thread for the count backend, whose tables never change
+        self.load_error = None
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        self.latencies = deque(maxlen=10000)  # Seconds from submit to result of the most recent requests
+        self.num_requests = 0
+        self.num_rows = 0
+        self.num_batches = 0
+        self.thread = threading.Thread(target=self.run, args=(model_loader,), daemon=True)
+        self.thread.start()
+        self.ready.wait()
+        if self.load_error:
+            raise self.load_error
+
+    # Queue a batch of padded sequences and return a Future that will hold their output vectors
+    def submit(self, sequences):
+        future = Future()
+        self.requests.put((numpy.asarray(sequences), future, time.perf_counter()))
+        return future
+
+    # Same interface as NNModel so the batcher can be handed to a SequenceSampler
+    def get_input_length(self):
+        return self.input_length
+
+    def get_probability(self, seed_sequence, batch_size=None):
+        return self.submit(seed_sequence).result()
+
+    # Worker thread, the model is loaded here so only this thread ever touches it
+    def run(self, model_loader):
+        try:
+            model = model_loader()
+            self.input_length = model.get_input_length()
+            self.model = model
+        except Exception as error:
+            self.load_error = error
+            return
+        finally:
+            self.ready.set()
+        while True:
+            batch = [self.requests.get()]
+            rows = len(batch[0][0])
+            deadline = time.perf_counter() + self.max_wait
+            while rows < self.max_batch:
+                try:
+                    request = self.requests.get(timeout=max(0.0, deadline - time.perf_counter()))
+                except Empty:
+                    break
+                batch.append(request)
+                rows += len(request[0])
+            try:
+                probabilities = model.get_probability(numpy.concatenate([request[0] for request in batch]),
+                                                      batch_size=rows)
+            except Exception as error:
+                for _, future, _ in batch:
+                    future.set_exception(error)
+                continue
+            start = 0
+            done = time.perf_counter()
+            for sequences, future, submitted in batch:
+                future.set_result(probabilities[start:start + len(sequences)])
+                start += len(sequences)
+            with self.lock:
+                self.latencies.extend(done - submitted for _, _, submitted in batch)
+                self.num_requests += len(batch)
+                self.num_rows += rows
+                self.num_batches += 1
+
+    # Latency percentiles and throughput counters
+    def stats(self):
+        with self.lock:
+            latencies = numpy.array(self.latencies) * 1000
+            elapsed = time.time() - self.start_time
+            stats = {"requests": self.num_requests, "rows": self.num_rows, "batches": self.num_batches,
+                     "mean_batch_rows": self.num_rows / self.num_batches if self.num_batches else 0,
+                     "requests_per_second": self.num_requests / elapsed, "rows_per_second": self.num_rows / elapsed}
+        for percentile in (50, 90, 99):
+            stats["latency_p%d_ms" % percentile] = float(numpy.percentile(latencies, percentile)) \
+                if len(latencies) else 0.0
+        return stats
+
+
+# Request handler serving next-word probabilities, P(W|d) estimates and statistics as json over HTTP
+# POST /next_word     {"texts": ["..."], "word": "..." (optional), "top": 5 (optional)}
+# POST /probability   {"word": "...", "distance": d, "tests": t, "seed": s (optional)}
+# GET  /stats
+# With the count backend /next_word isn't available, and /probability needs no tests but only goes up to the
+# distances it counted
+class InferenceRequestHandler(BaseHTTPRequestHandler):
+    batcher = None
+    tokenizer = None
+    backend = "keras"
+    chunk_size = 4096
+
+    def do_GET(self):
+        if self.path == "/stats":
+            self.send_json(200, self.batcher.stats())
+        else:
+            self.send_json(404, {"error": "unknown path %s" % self.path})
+
+    def do_POST(self):
+        try:
+            query = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            if self.path == "/next_word":
+                self.send_json(200, self.next_word(query))
+            elif self.path == "/probability":
+                self.send_json(200, self.probability(query))
+            else:
+                self.send_json(404, {"error": "unknown path %s" % self.path})
+        except (KeyError, ValueError, TypeError) as error:
+            self.send_json(400, {"error": "%s: %s" % (type(error).__name__, error)})
+
+    # Probabilities of the next word after each text, for one word or the most likely words
+    def next_word(self, query):
+        if self.backend == "count":
+            raise ValueError("the count backend only serves /probability")
+        texts = query.get("texts") or [query["text"]]
+        sequences = self.tokenizer.texts_to_array(texts, maxlen=self.batcher.get_input_length())
+        probabilities = self.batcher.get_probability(sequences)
+        if "word" in query:
+            return {"word": query["word"],
+                    "probabilities": probabilities[:, self.tokenizer.word_index[query["word"]]].tolist()}
+        top = int(query.get("top", 5))
+        results = []
+        for row in probabilities:
+            indices = numpy.argsort(row)[::-1][:top]
+            results.append([[self.tokenizer.index_word.get(int(i), ""), float(row[i])] for i in indices])
+        return {"top": results}
+
+    # Estimate P(W|d) with random sequences not containing the word, like testing.py
+    def probability(self, query):
+        word = query["word"]
+        distance = int(query["distance"])
+        test_word_index = self.tokenizer.word_index[word]
+        if self.backend == "count":
+            # The count model holds P(W|d) itself, there is nothing to sample, and raises beyond the counted distances
+            return {"word": word, "distance": distance, "tests": None,
+                    "probability": self.batcher.model.gap_probability(test_word_index, distance)}
+        if query.get("tests") is None:
+            raise ValueError("tests is needed to estimate P(W|d) with the %s backend at distance %d"
+                             % (self.backend, distance))
+        num_tests = int(query["tests"])
+        if num_tests < 1:
+            raise ValueError("tests should be at least 1, not %d" % num_tests)
+        sampler = SequenceSampler(self.batcher, self.tokenizer, exclude_words=(word,), chunk_size=self.chunk_size,
+                                  seed=query.get("seed"))
+        return {"word": word, "distance": distance, "tests": num_tests,
+                "probability": float(sampler.probability(test_word_index, distance, num_tests))}
+
+    def send_json(self, status, data):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # Keep the console quiet, statistics are available from /stats
+    def log_message(self, format, *args):
+        pass
+
+
+def print_help():
+    print("Usage:")
+    print("python inference_server.py [-p <port>] [-b <backend>] [-m <max_batch>] [-w <max_wait_ms>] [-c <chunk_size>]")
+    print("Where")
+    print("<port> is the local port to listen on (default 8000)")
+    print("<backend> is keras (default), numpy, quantized or count, numpy scores sequences without loading tensorflow")
+    print("          and quantized does so from the smaller %s, see quantized_model.py" % QUANTIZED_PATH)
+    print("          count answers P(W|d) from the word gaps counted by count_model.py and has no /next_word")
+    print("<max_batch> is the largest number of sequences scored in one model call (default 4096)")
+    print("<max_wait_ms> is how long to wait for more requests before scoring a batch (default 5)")
+    print("<chunk_size> is the number of random sequences per model call for P(W|d) queries (default 4096)")
+    print("Query the server with:")
+    print("python testing.py -u http://127.0.0.1:<port> -w <word> -d <distance> -t <tests>")
+
+
+def main():
+    # Retrieve arguments, print help() if that fails
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hp:b:m:w:c:",
+                                   ["help", "port=", "backend=", "maxbatch=", "maxwait=", "chunksize="])
+    except getopt.GetoptError:
+        print_help()
+        sys.exit(2)
+    port = 8000
+    max_batch = 4096
+    max_wait = 5.0
+    chunk_size = 4096
+    backend = "keras"
+    for opt, arg in opts:
+        if opt in ("-h", "--help"):
+            print_help()
+            sys.exit()
+        if opt in ("-b", "--backend"):
+            if arg not in BACKENDS:
+                print("--backend %s should be keras, numpy, quantized or count. \n" % arg)
+                print_help()
+                sys.exit(2)
+            backend = arg
+            continue
+        try:
+            if opt in ("-p", "--port"):
+                port = int(arg)
+            elif opt in ("-m", "--maxbatch"):
+                max_batch = int(arg)
+            elif opt in ("-w", "--maxwait"):
+                max_wait = float(arg)
+            elif opt in ("-c", "--chunksize"):
+                chunk_size = int(arg)
+        except ValueError:
+            print("%s %s couldn't be converted to a number. \n" % (opt, arg))
+            print_help()
+            sys.exit(2)
+
+    # Load the tokenizer and model once, the model lives in the batcher's worker thread
+    InferenceRequestHandler.tokenizer = load_tokenizer()
+    InferenceRequestHandler.batcher = MicroBatcher(partial(load_model, backend), max_batch=max_batch,
+                                                   max_wait=max_wait / 1000)
+    InferenceRequestHandler.backend = backend
+    InferenceRequestHandler.chunk_size = chunk_size
+    server = ThreadingHTTPServer(("127.0.0.1", port), InferenceRequestHandler)
+    print("Serving on http://127.0.0.1:%d" % port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+import sys
+import json
+import time
+import atexit
+import threading
+import resource
+from os import environ, getpid
+from functools import wraps
+from contextlib import contextmanager
+
+
+# Environment variable that turns tracing on, its value is the trace file to write
+TRACE_ENV = "LV_TRACE"
+
+
+# Current resident set size in MB, from /proc on Linux and the high-water mark elsewhere
+def current_rss_mb():
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize() / (1 << 20)
+    except (OSError, IndexError, ValueError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / (1 << 20) if sys.platform == "darwin" else peak / (1 << 10)
+
+
+# Class collecting timing spans and counters in the Chrome trace event format
+# Load the written file in chrome://tracing or https://ui.perfetto.dev to see the spans on a timeline
+# While disabled, span() and the traced decorator only check a flag, so instrumented code runs at full speed
+class Tracer:
+    def __init__(self):
+        self.enabled = False
+        self.path = None
+        self.events = []
+        self.start = time.perf_counter()
+        self.sampler = None
+        self.stop_sampling = threading.Event()
+
+    # Microseconds since the tracer was created, the time unit of trace events
+    def now(self):
+        return (time.perf_counter() - self.start) * 1e6
+
+    # Start recording, the trace is written to path and a summary printed when the process exits
+    # The resident set size is sampled every rss_interval seconds by a background thread
+    def enable(self, path, rss_interval=0.5):
+        if self.enabled:
+            return
+        self.enabled = True
+        self.path = path
+        self.stop_sampling.clear()
+        self.sampler = threading.Thread(target=self.sample_rss, args=(rss_interval,), daemon=True)
+        self.sampler.start()
+        atexit.register(self.finish)
+
+    def sample_rss(self, interval):
+        while not self.stop_sampling.is_set():
+            self.counter("rss_mb", rss=current_rss_mb())
+            self.stop_sampling.wait(interval)
+
+    # Time the enclosed block as a span with the given name
+    @contextmanager
+    def span(self, name, category="code", **args):
+        if not self.enabled:
+            yield
+            return
+        start = self.now()
+        try:
+            yield
+        finally:
+            self.events.append({"name": name, "cat": category, "ph": "X", "ts": start, "dur": self.now() - start,
+                                "pid": getpid(), "tid": threading.get_ident(), "args": args})
+
+    # Record counter values, e.g. memory use or throughput, shown as a graph on the timeline
+    def counter(self, name, **values):
+        if self.enabled:
+            self.events.append({"name": name, "ph": "C", "ts": self.now(), "pid": getpid(), "args": values})
+
+    # Total, mean and largest duration of every span name, largest total first
+    # Spans are inclusive, a method calling other traced methods also counts their time
+    def summary(self):
+        totals = {}
+        for event in self.events:
+            if event["ph"] == "X":
+                count, total, longest = totals.get(event["name"], (0, 0.0, 0.0))
+                totals[event["name"]] = (count + 1, total + event["dur"], max(longest, event["dur"]))
+        wall = self.now()
+        rss = [event["args"]["rss"] for event in self.events if event["name"] == "rss_mb"]
+        lines = ["%-52s %8s %12s %12s %12s %7s" % ("span", "calls", "total s", "mean ms", "max ms", "% wall")]
+        for name, (count, total, longest) in sorted(totals.items(), key=lambda x: x[1][1], reverse=True):
+            lines.append("%-52s %8d %12.3f %12.3f %12.3f %7.1f" % (name, count, total / 1e6, total / count / 1e3,
+                                                                   longest / 1e3, 100 * total / wall))
+        lines.append("Wall time %.3f s, peak sampled RSS %.1f MB"
+                     % (wall / 1e6, max(rss) if rss else current_rss_mb()))
+        return "\n".join(lines)
+
+    # Write the trace file and print the summary table
+    def finish(self):
+        if not self.enabled:
+            return
+        self.stop_sampling.set()
+        self.counter("rss_mb", rss=current_rss_mb())
+        with open(self.path, "w") as trace_file:
+            json.dump({"traceEvents": self.events, "displayTimeUnit": "ms"}, trace_file)
+        print(self.summary())
+        print("Trace written to %s" % self.path)
+        self.enabled = False
+
+
+# Tracer shared by the whole process
+TRACER = Tracer()
+
+
+# Enable tracing to path, or to the file named by the LV_TRACE environment variable when path is None
+def enable_tracing(path=None):
+    path = path or environ.get(TRACE_ENV)
+    if path:
+        TRACER.enable(path)
+    return TRACER.enabled
+
+
+# Decorator timing every call of a function or method as a span named after it
+def traced(function):
+    name = function.__qualname__
+
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        if not TRACER.enabled:
+            return function(*args, **kwargs)
+        with TRACER.span(name, category=name.split(".")[0]):
+            return function(*args, **kwargs)
+    return wrapper
+
+
+# Keras callback reporting the time and throughput of every training epoch, as spans and counters in the trace and
+# printed when verbose. Built on first use so this module doesn't import keras
+def throughput_callback(batch_size, verbose=True):
+    from keras.callbacks import Callback
+
+    class ThroughputCallback(Callback):
+        def on_epoch_begin(self, epoch, logs=None):
+            self.epoch_start = time.perf_counter()
+            self.trace_start = TRACER.now()
+            self.batches = 0
+
+        def on_batch_end(self, batch, logs=None):
+            self.batches += 1
+
+        def on_epoch_end(self, epoch, logs=None):
+            seconds = time.perf_counter() - self.epoch_start
+            samples_per_second = self.batches * batch_size / seconds if seconds > 0 else 0.0
+            if TRACER.enabled:
+                TRACER.events.append({"name": "epoch %d" % (epoch + 1), "cat": "keras", "ph": "X",
+                                      "ts": self.trace_start, "dur": TRACER.now() - self.trace_start,
+                                      "pid": getpid(), "tid": threading.get_ident(),
+                                      "args": {"batches": self.batches, "samples_per_second": samples_per_second}})
+                TRACER.counter("samples_per_second", samples=samples_per_second)
+            if verbose:
+                print("Epoch %d took %.2f s, %.0f samples/s" % (epoch + 1, seconds, samples_per_second))
+
+    return ThroughputCallback()
@@ -1,55 +1,192 @@
+import numpy
 from keras.models import load_model
-from keras.models import Sequential
+from keras.models import Sequential, Model
 from keras.layers import Dense
 from keras.layers import LSTM
 from keras.layers import Embedding
-from keras.preprocessing.sequence import pad_sequences
+from keras.layers import Input
+from instrumentation import traced, TRACER, throughput_callback
+
+
+# Let tensorflow run its operations on threads threads. It only spreads the work of each step, so it takes larger
+# batches to keep the threads busy. Has to be called before tensorflow runs anything
+def configure_threads(threads):
+    import tensorflow as tf
+    tf.config.threading.set_intra_op_parallelism_threads(threads)
+    tf.config.threading.set_inter_op_parallelism_threads(min(threads, 2))
+
 
 class NNModel():
     def __init__(self):
         self.model = None
+        # Model with a SampledSoftmax output layer used for training instead of self.model, see use_sampled_softmax
+        self.training_model = None
+        # TextGenerator reused by generate_sentence, holds a copy of the weights so it is dropped when they change
+        self.text_generator = None
 
     # Prepare the NN model
-    def prepare_model(self, input_size, output_size, projection_size=32, hidden_layer_size=75):
+    # With sparse_targets the model is trained on integer word indices instead of one-hot vectors
+    # With num_sampled the model is trained with a sampled softmax over num_sampled words, which implies sparse targets
+    # learning_rate overrides the default learning rate of the adam optimizer
+    @traced
+    def prepare_model(self, input_size, output_size, projection_size=32, hidden_layer_size=75, sparse_targets=False,
+                      num_sampled=None, learning_rate=None):
+        self.text_generator = None
         self.model = Sequential()
         self.model.add(Embedding(output_size, projection_size, input_length=input_size))
         self.model.add(LSTM(hidden_layer_size))
         self.model.add(Dense(output_size, activation='softmax'))
-        self.model.compile(loss='categorical_crossentropy', optimizer="adam", metrics=['accuracy'])
+        # Newer keras versions ignore input_length and only build the model on its first call
+        if not self.model.built:
+            self.model.build((None, input_size))
+        if num_sampled:
+            self.use_sampled_softmax(num_sampled, learning_rate)
+        else:
+            self.compile_model(sparse_targets, learning_rate)
         print(self.model.summary())
 
+    # Compile the model with a new adam optimizer, e.g. to fine-tune a loaded model on a different kind of targets
+    # The weights are kept, the optimizer state starts from scratch
+    def compile_model(self, sparse_targets=False, learning_rate=None):
+        from keras.optimizers import Adam
+        loss = 'sparse_categorical_crossentropy' if sparse_targets else 'categorical_crossentropy'
+        optimizer = Adam() if learning_rate is None else Adam(learning_rate)
+        self.training_model = None
+        self.model.compile(loss=loss, optimizer=optimizer, metrics=['accuracy'])
+
+    # Train with a SampledSoftmax output layer instead of the full softmax, so the cost of a training step doesn't grow
+    # with the vocabulary. The training model shares the embedding and LSTM layers of self.model, and its output layer
+    # starts from the weights of the Dense layer, which is updated from it after every fit_model. self.model then
+    # remains a standard model giving the exact full softmax probabilities, and is what save_model writes
+    # The optimizer state starts from scratch, the training model takes integer targets
+    def use_sampled_softmax(self, num_sampled=512, learning_rate=None):
+        from keras.optimizers import Adam
+        from sampled_softmax import SampledSoftmax, sampled_loss
+        dense = self.model.layers[-1]
+        sequence = Input(shape=(self.get_input_length(),))
+        target = Input(shape=(1,), dtype="int32")
+        hidden = sequence
+        for layer in self.model.layers[:-1]:
+            hidden = layer(hidden)
+        sampled_softmax = SampledSoftmax(dense.units, num_sampled)
+        self.training_model = Model([sequence, target], sampled_softmax([hidden, target]))
+        sampled_softmax.set_dense_weights(dense.get_weights())
+        optimizer = Adam() if learning_rate is None else Adam(learning_rate)
+        self.training_model.compile(loss=sampled_loss, optimizer=optimizer)
+
+    # Copy the weights of the SampledSoftmax layer to the Dense layer of self.model
+    def sync_output_layer(self):
+        if self.training_model is not None:
+            self.model.layers[-1].set_weights(self.training_model.layers[-1].dense_weights())
+
     # Fit the model to the data
-    def fit_model(self, input_data, output, epochs=500, verbosity=2):
-        self.model.fit(input_data, output, epochs=epochs, verbose=verbosity)
+    # If output is None, input_data should be a generator or keras Sequence yielding (input, output) batches, whose
+    # batch size is then set by the generator. validation_data is a Sequence, or an (input, output) tuple for arrays
+    # checkpoint is an optional TrainingCheckpoint saving the model during training and stopping early
+    # initial_epoch is the number of epochs already done when resuming from a checkpoint
+    # With a sampled softmax the validation loss is the sampled loss as well
+    # callbacks are further keras callbacks, the keras History of the training is returned
+    @traced
+    def fit_model(self, input_data, output=None, epochs=500, verbosity=2, batch_size=32, validation_data=None,
+                  checkpoint=None, initial_epoch=0, callbacks=()):
+        self.text_generator = None
+        callbacks = ([checkpoint] if checkpoint is not None else []) + list(callbacks)
+        if TRACER.enabled:
+            # Report the time and samples/sec of every epoch
+            callbacks.append(throughput_callback(getattr(input_data, "batch_size", batch_size), verbose=verbosity > 0))
+        model = self.model
+        if self.training_model is not None:
+            # The targets are a second input of the training model
+            model = self.training_model
+            input_data, output, validation_data = self.sampled_inputs(input_data, output, validation_data)
+        if output is None:
+            # fit takes a Sequence in every keras version, fit_generator is gone in newer ones
+            history = model.fit(input_data, epochs=epochs, verbose=verbosity, callbacks=callbacks,
+                                validation_data=validation_data, initial_epoch=initial_epoch)
+        else:
+            history = model.fit(input_data, output, batch_size=batch_size, epochs=epochs, verbose=verbosity,
+                                callbacks=callbacks, validation_data=validation_data, initial_epoch=initial_epoch)
+        self.sync_output_layer()
+        return history
+
+    # Inputs of the training model for data given to fit_model, one-hot outputs are converted to integer targets
+    @staticmethod
+    def sampled_inputs(input_data, output, validation_data):
+        from sampled_softmax import SampledTargets
+        if output is None:
+            if validation_data is not None:
+                validation_data = SampledTargets(validation_data)
+            return SampledTargets(input_data), None, validation_data
+        targets = [numpy.argmax(data, axis=-1) if data.ndim > 1 else data
+                   for data in [output] + ([validation_data[1]] if validation_data is not None else [])]
+        if validation_data is not None:
+            validation_data = ([validation_data[0], targets[1]], targets[1])
+        return [input_data, targets[0]], targets[0], validation_data
 
     # Save the model to a .h5 file so it can be retrieved for later use
+    @traced
     def save_model(self, path="./model.h5"):
         self.model.save(path)
 
-    # Load a model from a .h5 file
+    # Load a model from a .h5 file, or from a quantized artifact written by quantized_model.py
+    # A training checkpoint of a model with a SampledSoftmax layer becomes the training model, and self.model is
+    # rebuilt around its embedding and LSTM layers
+    @traced
     def load_model(self, path="./model.h5"):
-        self.model = load_model(path)
+        from sampled_softmax import CUSTOM_OBJECTS, SampledSoftmax
+        from quantized_model import QUANTIZED_SUFFIX
+        self.text_generator = None
+        if path.endswith(QUANTIZED_SUFFIX):
+            self.load_quantized_model(path)
+            return
+        model = load_model(path, custom_objects=CUSTOM_OBJECTS)
+        self.training_model = None
+        if not isinstance(model.layers[-1], SampledSoftmax):
+            self.model = model
+            return
+        self.training_model = model
+        layers = [layer for layer in model.layers if isinstance(layer, (Embedding, LSTM))]
+        self.model = Sequential(layers + [Dense(model.layers[-1].units, activation='softmax')])
+        if not self.model.built:
+            self.model.build(model.input_shape[0])
+        self.sync_output_layer()
+
+    # Build the model from the dequantized weights of a quantized artifact, it can only be used for predictions until
+    # compile_model is called
+    def load_quantized_model(self, path):
+        from quantized_model import dequantized_weights
+        embeddings, lstm_weights, dense_weights, input_length, lstm_config, dense_config = dequantized_weights(path)
+        self.training_model = None
+        self.model = Sequential()
+        self.model.add(Embedding(embeddings.shape[0], embeddings.shape[1], input_length=input_length))
+        self.model.add(LSTM(lstm_weights[1].shape[0], **lstm_config))
+        self.model.add(Dense(len(dense_weights[1]), **dense_config))
+        if not self.model.built:
+            self.model.build((None, input_length))
+        for layer, weights in zip(self.model.layers, ([embeddings], lstm_weights, dense_weights)):
+            layer.set_weights(weights)
 
     # Given a sequence of integer -> word associations, generate a new integer
+    @traced
     def generate_word(self, sequence):
-        return self.model.predict_classes(sequence, verbose=0)
+        return numpy.argmax(self.model.predict(sequence, verbose=0), axis=-1)
 
     # Given a seed word or words, generate a sentence that is length words long
+    # Always picks the word the model finds most likely after the last input_length words, like TextGenerator's
+    # generate_window. For many sentences at once or top-k/temperature sampling use the TextGenerator directly
+    # The TextGenerator is kept for later calls with the same tokenizer
     def generate_sentence(self, seed_word, length, tokenizer):
-        input_text = seed_word
-        for _ in range(length):
-            sequence = tokenizer.texts_to_sequences([input_text])[0]
-            # Pad the sequence up to the size of the input layer, given by model.input_shape[1]
-            sequence = pad_sequences([sequence], maxlen=self.model.input_shape[1], padding="pre")
-            out_int = self.generate_word(sequence)
-            out_word = ""
-            for word, index in tokenizer.word_index.items():
-                if index == out_int:
-                    out_word = word
-                    break
-            input_text += " " + out_word
-        return(input_text)
+        if self.text_generator is None or self.text_generator.tokenizer is not tokenizer:
+            from text_generator import TextGenerator
+            self.text_generator = TextGenerator(self, tokenizer)
+        return self.text_generator.generate_window([seed_word], length, top_k=1)[0]
+
+    # Size of the input layer, i.e. the length that input sequences have to be padded to
+    def get_input_length(self):
+        return self.model.input_shape[1]
 
     # Given a sequence of integer -> word associations, return the probabilities of what the next word will be
-    def get_probability(self, seed_sequence):
-        return self.model.predict_proba(seed_sequence)
\ No newline at end of file
+    # seed_sequence can hold many padded sequences, batch_size controls how many rows go through the model at once
+    @traced
+    def get_probability(self, seed_sequence, batch_size=32):
+        return self.model.predict(seed_sequence, batch_size=batch_size, verbose=0)
\ No newline at end of file
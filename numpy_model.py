@@ -0,0 +1,202 @@
+# Imports of built-in libraries
+import sys
+import getopt
+import json
+
+import numpy
+import h5py
+
+from instrumentation import traced
+
+
+# Activation functions used by the Embedding -> LSTM -> Dense model, following the keras definitions
+def sigmoid(x):
+    return 1.0 / (1.0 + numpy.exp(-x))
+
+
+def hard_sigmoid(x):
+    return numpy.clip(0.2 * x + 0.5, 0.0, 1.0)
+
+
+def softmax(x):
+    x = numpy.exp(x - numpy.max(x, axis=-1, keepdims=True))
+    return x / numpy.sum(x, axis=-1, keepdims=True)
+
+
+ACTIVATIONS = {"sigmoid": sigmoid, "hard_sigmoid": hard_sigmoid, "tanh": numpy.tanh, "linear": lambda x: x}
+
+
+# CPU inference backend running the forward pass of a model trained by NNModel in NumPy, without importing keras
+# Has the same get_input_length and get_probability interface as NNModel, so it can replace it wherever a model is
+# only used for scoring. The embedding is folded into the LSTM input kernel: embedding x kernel + bias is precomputed
+# for every word, so each time step only needs a row lookup and the recurrent matrix product. The leading zero padding
+# is the same for every sequence, so the LSTM state after any number of padding steps is also computed once
+class NumpyModel:
+    def __init__(self, dtype=numpy.float32):
+        self.dtype = dtype
+        self.input_length = None
+
+    # Read the layer configuration and weights from a keras .h5 model file
+    @traced
+    def load_model(self, path="./model.h5"):
+        self.set_weights(*self.read_weights(path, self.dtype))
+
+    # Weights and configuration of the layers in a keras .h5 model file, in the order of the arguments of set_weights
+    # Older keras versions give the input length as the batch_input_shape of the Embedding layer, newer ones save an
+    # InputLayer with a batch_shape and no weights
+    @staticmethod
+    def read_weights(path, dtype=numpy.float32):
+        with h5py.File(path, "r") as h5file:
+            config = json.loads(NumpyModel.as_str(h5file.attrs["model_config"]))["config"]
+            layers = config["layers"] if isinstance(config, dict) else config
+            weights = {}
+            for layer in layers:
+                name = layer["config"]["name"]
+                if name not in h5file["model_weights"]:
+                    continue
+                group = h5file["model_weights"][name]
+                weight_names = [NumpyModel.as_str(weight_name) for weight_name in group.attrs.get("weight_names", [])]
+                if weight_names:
+                    weights[layer["class_name"]] = [numpy.asarray(group[weight_name], dtype=dtype)
+                                                    for weight_name in weight_names]
+        layer_configs = {layer["class_name"]: layer["config"] for layer in layers}
+        input_shape = layer_configs["Embedding"].get("batch_input_shape") or \
+            layer_configs.get("InputLayer", {}).get("batch_shape") or \
+            layer_configs.get("InputLayer", {}).get("batch_input_shape")
+        return (weights["Embedding"][0], weights["LSTM"], weights["Dense"], input_shape[1], layer_configs["LSTM"],
+                layer_configs["Dense"])
+
+    @staticmethod
+    def as_str(value):
+        return value.decode("utf-8") if isinstance(value, bytes) else value
+
+    # Set the weights of the three layers, lstm_weights and dense_weights are [kernel, (recurrent kernel,) bias]
+    def set_weights(self, embeddings, lstm_weights, dense_weights, input_length, lstm_config=None, dense_config=None):
+        self.input_length = input_length
+        kernel, self.recurrent_kernel = lstm_weights[0], lstm_weights[1]
+        lstm_bias = lstm_weights[2] if len(lstm_weights) > 2 else numpy.zeros(kernel.shape[1], dtype=self.dtype)
+        self.set_activations(lstm_config, dense_config)
+        # Input contribution to the four gates (input, forget, cell, output) for every word in the vocabulary
+        self.input_table = (embeddings @ kernel + lstm_bias).astype(self.dtype)
+        self.dense_kernel = dense_weights[0]
+        self.dense_bias = dense_weights[1] if len(dense_weights) > 1 else numpy.zeros(self.dense_kernel.shape[1],
+                                                                                      dtype=self.dtype)
+        self.init_padding_states()
+
+    def set_activations(self, lstm_config=None, dense_config=None):
+        lstm_config = lstm_config or {}
+        dense_config = dense_config or {}
+        self.activation = ACTIVATIONS[lstm_config.get("activation", "tanh")]
+        self.recurrent_activation = ACTIVATIONS[lstm_config.get("recurrent_activation", "sigmoid")]
+        self.output_activation = softmax if dense_config.get("activation", "softmax") == "softmax" \
+            else ACTIVATIONS[dense_config["activation"]]
+
+    # LSTM states after 0, 1, ..., input_length padding steps
+    def init_padding_states(self):
+        self.units = self.recurrent_kernel.shape[0]
+        self.padding_h = numpy.zeros((self.input_length + 1, self.units), dtype=self.dtype)
+        self.padding_c = numpy.zeros((self.input_length + 1, self.units), dtype=self.dtype)
+        padding = numpy.zeros(1, dtype=numpy.int64)
+        for t in range(self.input_length):
+            self.padding_h[t + 1:t + 2], self.padding_c[t + 1:t + 2] = self.lstm_step(
+                self.input_rows(padding), self.padding_h[t:t + 1], self.padding_c[t:t + 1])
+
+    # Input contribution to the LSTM gates of a batch of word indices
+    def input_rows(self, word_indices):
+        return self.input_table[word_indices]
+
+    # Output layer before its activation for a batch of final LSTM states
+    def logits(self, h):
+        return h @ self.dense_kernel + self.dense_bias
+
+    # One LSTM time step for a batch of rows, z_input holds the rows of input_table for the current words
+    def lstm_step(self, z_input, h, c):
+        z = z_input + h @ self.recurrent_kernel
+        i = self.recurrent_activation(z[:, :self.units])
+        f = self.recurrent_activation(z[:, self.units:2 * self.units])
+        c = f * c + i * self.activation(z[:, 2 * self.units:3 * self.units])
+        o = self.recurrent_activation(z[:, 3 * self.units:])
+        return o * self.activation(c), c
+
+    # Size of the input layer, i.e. the length that input sequences have to be padded to
+    def get_input_length(self):
+        return self.input_length
+
+    # Final LSTM state for a batch of pre-padded sequences
+    def hidden_states(self, sequences):
+        n_padding = numpy.argmax(sequences != 0, axis=1)
+        n_padding[~numpy.any(sequences != 0, axis=1)] = self.input_length
+        h, c = self.padding_h[n_padding], self.padding_c[n_padding]
+        for t in range(int(n_padding.min()), self.input_length):
+            active = n_padding <= t
+            if active.all():
+                h, c = self.lstm_step(self.input_rows(sequences[:, t]), h, c)
+            else:
+                h[active], c[active] = self.lstm_step(self.input_rows(sequences[active, t]), h[active], c[active])
+        return h
+
+    # Given padded sequences of integer -> word associations, return the probabilities of what the next word will be
+    @traced
+    def get_probability(self, seed_sequence, batch_size=4096):
+        seed_sequence = numpy.asarray(seed_sequence)
+        outputs = []
+        for start in range(0, len(seed_sequence), batch_size):
+            h = self.hidden_states(seed_sequence[start:start + batch_size])
+            outputs.append(self.output_activation(self.logits(h)))
+        return numpy.concatenate(outputs) if outputs else numpy.zeros((0, len(self.dense_bias)), self.dtype)
+
+
+# Compare the outputs of the NumPy backend with keras on random sequences, returns the largest absolute difference
+def compare_with_keras(model_path, num_sequences=1000, seed=None, dtype=numpy.float32):
+    from nn_model import NNModel
+    keras_model = NNModel()
+    keras_model.load_model(model_path)
+    numpy_model = NumpyModel(dtype)
+    numpy_model.load_model(model_path)
+    rng = numpy.random.default_rng(seed)
+    input_length = numpy_model.get_input_length()
+    vocab_size = numpy_model.input_table.shape[0]
+    sequences = rng.integers(1, vocab_size, size=(num_sequences, input_length))
+    # Pre-pad every sequence with a random number of zeros, like padded sequences of random length
+    sequences[numpy.arange(input_length)[None, :] < rng.integers(0, input_length + 1, size=(num_sequences, 1))] = 0
+    return numpy.max(numpy.abs(keras_model.get_probability(sequences, batch_size=1024) -
+                               numpy_model.get_probability(sequences)))
+
+
+def print_help():
+    print("Usage:")
+    print("python numpy_model.py [-m <model>] [-n <sequences>] [--float64]")
+    print("Compares the NumPy backend with keras on <sequences> random sequences (default 1000)")
+    print("and prints the largest absolute difference between their output probabilities")
+
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hm:n:", ["help", "model=", "sequences=", "float64"])
+    except getopt.GetoptError:
+        print_help()
+        sys.exit(2)
+    model_path = "./model_51_file_training.h5"
+    num_sequences = 1000
+    dtype = numpy.float32
+    for opt, arg in opts:
+        if opt in ("-h", "--help"):
+            print_help()
+            sys.exit()
+        elif opt in ("-m", "--model"):
+            model_path = arg
+        elif opt in ("-n", "--sequences"):
+            try:
+                num_sequences = int(arg)
+            except ValueError:
+                print("--sequences %s couldn't be converted to an int. \n" % arg)
+                print_help()
+                sys.exit(2)
+        elif opt == "--float64":
+            dtype = numpy.float64
+    max_difference = compare_with_keras(model_path, num_sequences, seed=0, dtype=dtype)
+    print("Largest absolute difference between keras and NumPy probabilities: %g" % max_difference)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+from os import environ
+
+import numpy
+
+from sequence_sampler import SequenceSampler
+from adaptive_estimator import RunningMoments
+from instrumentation import traced
+
+
+# SequenceSampler of the current pool worker, created once per process by init_worker
+worker_sampler = None
+
+
+# Load the model once in a pool worker
+def init_worker(model_loader, tokenizer, chunk_size):
+    global worker_sampler
+    worker_sampler = SequenceSampler(model_loader(), tokenizer, chunk_size=chunk_size)
+
+
+# Moments of the output vectors over the random sequences of one task, drawn with the task's own random generator
+def run_task(task):
+    distance, num_tests, seed_sequence = task
+    worker_sampler.rng = numpy.random.default_rng(seed_sequence)
+    return worker_sampler.probability_moments(distance, num_tests)
+
+
+# Class to compute the model's average output vectors for many distances with a pool of worker processes
+# The tests for every distance are split into tasks of tests_per_task sequences. Each task draws its sequences from a
+# generator seeded by (seed, distance, task index) and the task results are merged in task order, so the results only
+# depend on the seed and never on the number of workers or the order in which tasks finish
+# With a ResultStore, finished tasks are read from and written to the store. The model is only loaded, and the pool
+# only started, once a task actually has to be computed
+# Use as a context manager to keep the pool, and the models loaded in it, alive across several calls
+class ParallelSampler:
+    def __init__(self, model_loader, tokenizer, workers, chunk_size=4096, tests_per_task=None, seed=None, store=None):
+        self.model_loader = model_loader  # Picklable function returning a model, called once in every worker
+        self.tokenizer = tokenizer
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.tests_per_task = tests_per_task or chunk_size
+        self.store = store
+        if seed is None and store is not None:
+            seed = store.default_seed()
+        # Without a seed the entropy is drawn once here, so all tasks of a run still get distinct streams
+        self.entropy = numpy.random.SeedSequence(seed).entropy
+        self.pool = None
+        self.started = False
+        self.depth = 0
+        self.computed_tasks = 0  # Number of tasks simulated and read from the store so far
+        self.stored_tasks = 0
+
+    def __enter__(self):
+        self.depth += 1
+        return self
+
+    def __exit__(self, *exc_info):
+        self.depth -= 1
+        if self.depth == 0:
+            if self.pool is not None:
+                self.pool.terminate()
+                self.pool = None
+            self.started = False
+
+    # Start the worker pool, or load the model in this process when running with a single worker
+    def start(self):
+        if self.workers > 1:
+            # Each worker gets one core, otherwise every process starts a full set of BLAS/tensorflow threads
+            for variable in ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS"):
+                environ.setdefault(variable, "1")
+            # Spawned rather than forked processes, tensorflow doesn't survive a fork
+            from multiprocessing import get_context
+            self.pool = get_context("spawn").Pool(self.workers, initializer=init_worker,
+                                                  initargs=(self.model_loader, self.tokenizer, self.chunk_size))
+        else:
+            init_worker(self.model_loader, self.tokenizer, self.chunk_size)
+        self.started = True
+
+    # Task of the given index for a distance, tests_per_task tests unless fewer are left before max_tests
+    def task(self, distance, index, max_tests):
+        num_tests = min(self.tests_per_task, max_tests - index * self.tests_per_task)
+        return distance, num_tests, numpy.random.SeedSequence(self.entropy, spawn_key=(distance, index))
+
+    # Run tasks and yield their results in task order
+    def map_tasks(self, tasks):
+        if not self.started:
+            self.start()
+        if self.pool is not None:
+            return self.pool.imap(run_task, tasks)
+        return map(run_task, tasks)
+
+    # Yield the moments of the tasks with the given (distance, index) keys in order
+    # Tasks found in the store are read from it, the others are computed and stored as soon as they finish
+    def task_moments(self, keys, max_tests):
+        tasks = [self.task(dist, index, max_tests) for dist, index in keys]
+        stored = {}
+        if self.store is not None:
+            for dist in sorted(set(dist for dist, _ in keys)):
+                for index, moments in self.store.chunks(self.entropy, self.tests_per_task, dist).items():
+                    stored[dist, index] = moments
+        # A stored task is only re-used if it has as many tests as the task asks for
+        missing = [task for key, task in zip(keys, tasks) if key not in stored or stored[key].count != task[1]]
+        computed = self.map_tasks(missing) if missing else iter(())
+        for key, task in zip(keys, tasks):
+            moments = stored.get(key)
+            if moments is None or moments.count != task[1]:
+                moments = next(computed)
+                self.computed_tasks += 1
+                if self.store is not None:
+                    self.store.add_chunk(self.entropy, self.tests_per_task, key[0], key[1], moments)
+            else:
+                self.stored_tasks += 1
+            yield moments
+
+    # Return a dictionary of distance -> RunningMoments over num_tests random sequences
+    @traced
+    def moments_table(self, distances, num_tests):
+        n_tasks = -(-num_tests // self.tests_per_task)
+        keys = [(dist, index) for dist in distances for index in range(n_tasks)]
+        table = {dist: RunningMoments() for dist in distances}
+        with self:
+            for (dist, _), moments in zip(keys, self.task_moments(keys, num_tests)):
+                table[dist].merge(moments)
+        return table
+
+    # Return a dictionary of distance -> average output vector over num_tests random sequences
+    def mean_probability_table(self, distances, num_tests):
+        return {dist: moments.mean for dist, moments in self.moments_table(distances, num_tests).items()}
+
+    # Return a dictionary of distance -> RunningMoments, sampling every distance until target (a PrecisionTarget) is
+    # met for the columns in word_indices. Tasks are handed out one round of workers at a time and the target is
+    # checked after merging each task in order, so the stopping point doesn't depend on the number of workers
+    @traced
+    def adaptive_moments_table(self, distances, target, word_indices):
+        table = {}
+        with self:
+            for dist in distances:
+                moments = RunningMoments()
+                index = 0
+                while not target.done(moments, word_indices):
+                    n_tasks = min(max(self.workers, 1), -(-(target.max_tests - moments.count) // self.tests_per_task))
+                    keys = [(dist, index + i) for i in range(n_tasks)]
+                    for task_moments in self.task_moments(keys, target.max_tests):
+                        moments.merge(task_moments)
+                        index += 1
+                        if target.done(moments, word_indices):
+                            break
+                table[dist] = moments
+        return table
@@ -0,0 +1,51 @@
+import math
+
+import numpy
+
+
+# Class that builds shuffled batches of padded prefixes on the fly from a token stream
+# Produced by DataInterpreter.training_data_to_token_stream, only the stream and the target positions are kept in
+# memory so there is no N x input_length input matrix and no N x vocab_size one-hot output matrix
+# Targets are returned as integers, so the model should be compiled with a sparse categorical loss
+# Needs neither keras nor tensorflow, PrefixSequence (prefix_sequence.py) is the keras Sequence built on it
+class PrefixBatches:
+    def __init__(self, tokens, targets, input_length, batch_size=32, shuffle_data=True, seed=None):
+        super().__init__()
+        self.tokens = tokens  # Integer token stream, every chunk preceded by at least input_length zeros
+        self.targets = targets  # Positions in the token stream of the word following each prefix
+        self.batch_size = batch_size
+        self.shuffle_data = shuffle_data
+        self.rng = numpy.random.default_rng(seed)
+        # Offsets from a target position to the positions making up its padded input
+        self.offsets = numpy.arange(-input_length, 0)
+        self.order = numpy.arange(len(targets))
+        if shuffle_data:
+            self.rng.shuffle(self.order)
+
+    def __len__(self):
+        return math.ceil(len(self.targets) / self.batch_size)
+
+    # Return the padded inputs and integer targets for batch number index
+    def __getitem__(self, index):
+        positions = self.targets[self.order[index * self.batch_size:(index + 1) * self.batch_size]]
+        return self.tokens[positions[:, None] + self.offsets], self.tokens[positions]
+
+    # Hold out a random validation_frac of the chunks of the token stream, i.e. of the sentences, for validation
+    # Whole chunks are held out so no validation prefix is also a prefix of a training sentence
+    # Returns the training and the validation sequence, the validation sequence isn't shuffled
+    def split(self, validation_frac, seed=None):
+        # Every chunk is preceded by padding, so the first target of a chunk is the one two positions after a zero
+        chunk_ids = numpy.cumsum(self.tokens[self.targets - 2] == 0) - 1
+        n_chunks = chunk_ids[-1] + 1 if len(chunk_ids) else 0
+        held_out = numpy.zeros(n_chunks, dtype=bool)
+        held_out[numpy.random.default_rng(seed).permutation(n_chunks)[:int(n_chunks * validation_frac)]] = True
+        validation = held_out[chunk_ids]
+        input_length = len(self.offsets)
+        return (type(self)(self.tokens, self.targets[~validation], input_length, self.batch_size, self.shuffle_data,
+                           seed),
+                type(self)(self.tokens, self.targets[validation], input_length, self.batch_size, False))
+
+    # Reshuffle the prefixes between epochs
+    def on_epoch_end(self):
+        if self.shuffle_data:
+            self.rng.shuffle(self.order)
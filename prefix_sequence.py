@@ -0,0 +1,8 @@
+from keras.utils import Sequence
+
+from prefix_batches import PrefixBatches
+
+
+# Keras Sequence of the batches of padded prefixes of a PrefixBatches, used to train on a token stream
+class PrefixSequence(PrefixBatches, Sequence):
+    pass
@@ -0,0 +1,301 @@
+# Imports of built-in libraries
+import sys
+import getopt
+import json
+import time
+import struct
+from os import path as os_path
+
+import numpy
+
+from numpy_model import NumpyModel
+from instrumentation import traced, enable_tracing, TRACE_ENV
+
+
+# Model produced by training.py and the quantized artifact exported from it
+MODEL_PATH = "./model_51_file_training.h5"
+QUANTIZED_PATH = "./model_51_file_training.qmodel"
+TOKENIZER_PATH = "./tokenizer_51_file_training.vocab"
+QUANTIZED_SUFFIX = ".qmodel"
+
+# Layout of a quantized artifact:
+# - MAGIC, then the length of the header as a little-endian uint32
+# - the json header: quantization, input_length, activations of the layers, and for every array its dtype, shape and
+#   offset from the start of the file
+# - the arrays, each starting on an ALIGNMENT byte boundary so they can be used straight from a memory map
+MAGIC = b"QMODEL1\n"
+ALIGNMENT = 64
+QUANTIZATIONS = ("int8", "float16")
+# Matrices stored quantized, int8 ones have a float32 scale per row (embedding) or per output column (kernels)
+# Biases are always stored as float32
+QUANTIZED_ARRAYS = {"embedding": 1, "lstm_kernel": 0, "lstm_recurrent_kernel": 0, "dense_kernel": 0}
+# Number of output columns of the dense layer dequantized at once by QuantizedModel.logits
+LOGIT_CHUNK = 16384
+
+
+# Symmetric int8 quantization of a matrix, with a scale for each slice along axis (reduced by the max)
+# Returns the int8 matrix and the float32 scales, matrix ~= quantized * scale
+def quantize_int8(matrix, axis):
+    scale = numpy.max(numpy.abs(matrix), axis=axis) / 127.0
+    scale[scale == 0] = 1.0
+    scale = scale.astype(numpy.float32)
+    expanded = numpy.expand_dims(scale, axis)
+    return numpy.clip(numpy.round(matrix / expanded), -127, 127).astype(numpy.int8), scale
+
+
+def dequantize(quantized, scale, axis, dtype=numpy.float32):
+    matrix = numpy.asarray(quantized, dtype=dtype)
+    if scale is not None:
+        matrix *= numpy.expand_dims(numpy.asarray(scale, dtype=dtype), axis)
+    return matrix
+
+
+# Write the weights of a keras .h5 model to a quantized artifact, returns the size of the artifact in bytes
+@traced
+def export_model(model_path=MODEL_PATH, output_path=QUANTIZED_PATH, quantization="float16"):
+    if quantization not in QUANTIZATIONS:
+        raise ValueError("quantization should be one of %s, not %s" % (", ".join(QUANTIZATIONS), quantization))
+    embeddings, lstm_weights, dense_weights, input_length, lstm_config, dense_config = \
+        NumpyModel.read_weights(model_path)
+    units = lstm_weights[1].shape[0]
+    matrices = {"embedding": embeddings, "lstm_kernel": lstm_weights[0], "lstm_recurrent_kernel": lstm_weights[1],
+                "dense_kernel": dense_weights[0]}
+    arrays = {"lstm_bias": lstm_weights[2] if len(lstm_weights) > 2 else numpy.zeros(4 * units, numpy.float32),
+              "dense_bias": dense_weights[1] if len(dense_weights) > 1 else
+              numpy.zeros(dense_weights[0].shape[1], numpy.float32)}
+    for name, matrix in matrices.items():
+        if quantization == "int8":
+            arrays[name], arrays[name + "_scale"] = quantize_int8(matrix, QUANTIZED_ARRAYS[name])
+        else:
+            arrays[name] = matrix.astype(numpy.float16)
+    header = {"quantization": quantization, "input_length": int(input_length),
+              "lstm_config": {key: (lstm_config or {}).get(key, default) for key, default in
+                              (("activation", "tanh"), ("recurrent_activation", "sigmoid"))},
+              "dense_config": {"activation": (dense_config or {}).get("activation", "softmax")},
+              "arrays": {}}
+    # The offsets depend on the length of the header, which depends on the offsets: reserve room for them first
+    header_size = len(json.dumps(header)) + len(arrays) * 120
+    offset = align(len(MAGIC) + 4 + header_size)
+    for name, array in arrays.items():
+        header["arrays"][name] = {"dtype": array.dtype.name, "shape": list(array.shape), "offset": offset}
+        offset = align(offset + array.nbytes)
+    header_bytes = json.dumps(header).encode("utf-8").ljust(header_size)
+    with open(output_path, "wb") as output_file:
+        output_file.write(MAGIC + struct.pack("<I", header_size) + header_bytes)
+        for name, array in arrays.items():
+            output_file.write(b"\0" * (header["arrays"][name]["offset"] - output_file.tell()))
+            output_file.write(numpy.ascontiguousarray(array).tobytes())
+    return os_path.getsize(output_path)
+
+
+def align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+# Memory map a quantized artifact, returns its header and a dict of read-only arrays backed by the file
+# Nothing is read until the arrays are used, and every process mapping the same file shares its pages
+def read_artifact(path=QUANTIZED_PATH):
+    data = numpy.memmap(path, dtype=numpy.uint8, mode="r")
+    if bytes(data[:len(MAGIC)]) != MAGIC:
+        raise ValueError("%s is not a quantized model artifact" % path)
+    header_size = struct.unpack("<I", bytes(data[len(MAGIC):len(MAGIC) + 4]))[0]
+    header = json.loads(bytes(data[len(MAGIC) + 4:len(MAGIC) + 4 + header_size]).decode("utf-8"))
+    arrays = {}
+    for name, spec in header["arrays"].items():
+        dtype = numpy.dtype(spec["dtype"])
+        size = int(numpy.prod(spec["shape"])) * dtype.itemsize
+        arrays[name] = data[spec["offset"]:spec["offset"] + size].view(dtype).reshape(spec["shape"])
+    return header, arrays
+
+
+# Weights of a quantized artifact converted back to float32, in the order of the arguments of NumpyModel.set_weights
+def dequantized_weights(path=QUANTIZED_PATH):
+    header, arrays = read_artifact(path)
+    matrices = {name: dequantize(arrays[name], arrays.get(name + "_scale"), axis)
+                for name, axis in QUANTIZED_ARRAYS.items()}
+    return (matrices["embedding"],
+            [matrices["lstm_kernel"], matrices["lstm_recurrent_kernel"], numpy.array(arrays["lstm_bias"])],
+            [matrices["dense_kernel"], numpy.array(arrays["dense_bias"])],
+            header["input_length"], header["lstm_config"], header["dense_config"])
+
+
+# NumPy inference backend reading a quantized artifact through a memory map, with the interface of NumpyModel
+# The embedding and dense kernel, whose size grows with the vocabulary, stay quantized in the mapped file: only the
+# embedding rows of the words in a batch and LOGIT_CHUNK columns of the dense kernel at a time are converted to float.
+# The LSTM kernels don't depend on the vocabulary and are dequantized when the model is loaded
+class QuantizedModel(NumpyModel):
+    def __init__(self, dtype=numpy.float32):
+        super().__init__(dtype)
+        self.quantization = None
+
+    @traced
+    def load_model(self, path=QUANTIZED_PATH):
+        header, arrays = read_artifact(path)
+        self.quantization = header["quantization"]
+        self.input_length = header["input_length"]
+        self.set_activations(header["lstm_config"], header["dense_config"])
+        self.embedding = arrays["embedding"]
+        self.embedding_scale = arrays.get("embedding_scale")
+        self.kernel = dequantize(arrays["lstm_kernel"], arrays.get("lstm_kernel_scale"), 0, self.dtype)
+        self.recurrent_kernel = dequantize(arrays["lstm_recurrent_kernel"], arrays.get("lstm_recurrent_kernel_scale"),
+                                           0, self.dtype)
+        self.lstm_bias = numpy.asarray(arrays["lstm_bias"], dtype=self.dtype)
+        self.dense_kernel = arrays["dense_kernel"]
+        self.dense_kernel_scale = arrays.get("dense_kernel_scale")
+        self.dense_bias = numpy.asarray(arrays["dense_bias"], dtype=self.dtype)
+        self.init_padding_states()
+
+    def input_rows(self, word_indices):
+        embeddings = self.embedding[word_indices].astype(self.dtype)
+        if self.embedding_scale is not None:
+            embeddings *= self.embedding_scale[word_indices, None]
+        return embeddings @ self.kernel + self.lstm_bias
+
+    def logits(self, h):
+        output = numpy.empty((len(h), len(self.dense_bias)), dtype=self.dtype)
+        for start in range(0, len(self.dense_bias), LOGIT_CHUNK):
+            columns = slice(start, start + LOGIT_CHUNK)
+            output[:, columns] = h @ self.dense_kernel[:, columns].astype(self.dtype)
+        if self.dense_kernel_scale is not None:
+            output *= self.dense_kernel_scale
+        return output + self.dense_bias
+
+
+# Compare the probabilities of the float model and of its quantized artifact on the next-word predictions of files
+# Reports the largest and mean absolute difference, the mean KL divergence from the float to the quantized
+# probabilities, how often both agree on the most probable word, the perplexity of both, and their size and load time
+@traced
+def drift_report(model_path, artifact_path, files, tokenizer, batch_size=4096):
+    from evaluation import EvaluationMetrics, prediction_stream
+    models = {}
+    load_seconds = {}
+    for name, model, model_file in (("float", NumpyModel(), model_path),
+                                    ("quantized", QuantizedModel(), artifact_path)):
+        start = time.perf_counter()
+        model.load_model(model_file)
+        load_seconds[name] = time.perf_counter() - start
+        models[name] = model
+    vocab_size = len(models["float"].dense_bias)
+    metrics = {name: EvaluationMetrics(vocab_size) for name in models}
+    predictions = prediction_stream(files, tokenizer, models["float"].get_input_length(), batch_size)
+    count, max_difference, sum_difference, sum_kl, agreements = 0, 0.0, 0.0, 0.0, 0
+    for index in range(len(predictions)):
+        inputs, targets = predictions[index]
+        expected = models["float"].get_probability(inputs, batch_size=len(inputs)).astype(numpy.float64)
+        actual = models["quantized"].get_probability(inputs, batch_size=len(inputs)).astype(numpy.float64)
+        metrics["float"].add(expected, targets)
+        metrics["quantized"].add(actual, targets)
+        difference = numpy.abs(expected - actual)
+        count += len(inputs)
+        max_difference = max(max_difference, float(difference.max()))
+        sum_difference += float(difference.mean(axis=1).sum())
+        sum_kl += float(numpy.sum(expected * (numpy.log(numpy.maximum(expected, 1e-30)) -
+                                              numpy.log(numpy.maximum(actual, 1e-30)))))
+        agreements += int(numpy.sum(expected.argmax(axis=1) == actual.argmax(axis=1)))
+    return {"model": model_path, "artifact": artifact_path, "quantization": models["quantized"].quantization,
+            "files": len(files), "predictions": count, "max_abs_difference": max_difference,
+            "mean_abs_difference": sum_difference / max(count, 1), "mean_kl_divergence": sum_kl / max(count, 1),
+            "top1_agreement": agreements / max(count, 1),
+            "perplexity": {name: metric.perplexity() for name, metric in metrics.items()},
+            "file_bytes": {"float": os_path.getsize(model_path), "quantized": os_path.getsize(artifact_path)},
+            "load_seconds": load_seconds}
+
+
+def format_drift_report(report):
+    lines = ["Drift of %s (%s) against %s on %d predictions from %d testing files"
+             % (report["artifact"], report["quantization"], report["model"], report["predictions"], report["files"]),
+             "Largest absolute probability difference %g, mean %g" % (report["max_abs_difference"],
+                                                                       report["mean_abs_difference"]),
+             "Mean KL divergence %g nats, most probable word agrees on %.4f of predictions"
+             % (report["mean_kl_divergence"], report["top1_agreement"]),
+             "%-10s %12s %12s %12s" % ("model", "perplexity", "bytes", "load (s)")]
+    for name in ("float", "quantized"):
+        lines.append("%-10s %12.3f %12d %12.4f" % (name, report["perplexity"][name], report["file_bytes"][name],
+                                                   report["load_seconds"][name]))
+    return "\n".join(lines)
+
+
+def print_help():
+    print("Usage:")
+    print("python quantized_model.py [-m <model>] [-o <artifact>] [-q <quantization>] [-d] [-n <n_files>]")
+    print("       [-t <tokenizer>] [-r <report>] [--trace <file>]")
+    print("Exports a keras model to a quantized artifact for the quantized backend of testing.py,")
+    print("accuracy_assessment.py and evaluation.py")
+    print("Where")
+    print("<model> is the keras model to export (default %s)" % MODEL_PATH)
+    print("<artifact> is the file to write (default %s)" % QUANTIZED_PATH)
+    print("<quantization> is float16 (default) or int8, int8 is smaller but drifts more, check it with -d")
+    print("-d reports the probability drift of the artifact against the model on the testing files")
+    print("<n_files> is the number of testing files for the drift report (default all of them)")
+    print("<tokenizer> is the vocabulary the model was trained with (default %s)" % TOKENIZER_PATH)
+    print("<report> is a json file to write the drift report to")
+    print("--trace <file> writes a timing trace of the run to <file> and prints a summary, as does setting %s=<file>"
+          % TRACE_ENV)
+
+
+def main():
+    # Retrieve arguments, print help() if that fails
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hm:o:q:dn:t:r:",
+                                   ["help", "model=", "output=", "quantization=", "drift", "nfiles=", "tokenizer=",
+                                    "report=", "trace="])
+    except getopt.GetoptError:
+        print_help()
+        sys.exit(2)
+    model_path = MODEL_PATH
+    output_path = QUANTIZED_PATH
+    quantization = "float16"
+    drift = False
+    n_files = -1
+    tokenizer_path = TOKENIZER_PATH
+    report_path = None
+    trace_path = None
+    for opt, arg in opts:
+        if opt in ("-h", "--help"):
+            print_help()
+            sys.exit()
+        elif opt in ("-m", "--model"):
+            model_path = arg
+        elif opt in ("-o", "--output"):
+            output_path = arg
+        elif opt in ("-q", "--quantization"):
+            if arg not in QUANTIZATIONS:
+                print("--quantization %s should be int8 or float16. \n" % arg)
+                print_help()
+                sys.exit(2)
+            quantization = arg
+        elif opt in ("-d", "--drift"):
+            drift = True
+        elif opt in ("-n", "--nfiles"):
+            try:
+                n_files = int(arg)
+            except ValueError:
+                print("--nfiles %s couldn't be converted to an int. \n" % arg)
+                print_help()
+                sys.exit(2)
+        elif opt in ("-t", "--tokenizer"):
+            tokenizer_path = arg
+        elif opt in ("-r", "--report"):
+            report_path = arg
+        elif opt == "--trace":
+            trace_path = arg
+    # Time the run if --trace or the LV_TRACE environment variable was given
+    enable_tracing(trace_path)
+
+    size = export_model(model_path, output_path, quantization)
+    print("Wrote %s (%s, %d bytes, %s is %d bytes)" % (output_path, quantization, size, model_path,
+                                                       os_path.getsize(model_path)))
+    if drift:
+        from data_interpreter import DataInterpreter
+        from fast_tokenizer import FastTokenizer
+        files = DataInterpreter.select_files(DataInterpreter().testing_files, n_files)
+        report = drift_report(model_path, output_path, files, FastTokenizer.load(tokenizer_path))
+        print(format_drift_report(report))
+        if report_path:
+            with open(report_path, "w", encoding="utf-8") as report_file:
+                json.dump(report, report_file, indent=1)
+            print("Report written to %s" % report_path)
+
+
+if __name__ == "__main__":
+    main()
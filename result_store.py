@@ -0,0 +1,82 @@
+import hashlib
+import sqlite3
+from os import path, makedirs
+
+import numpy
+
+from adaptive_estimator import RunningMoments
+
+
+# Class to persist the simulated output vectors of a model in a SQLite database, so they only have to be computed once
+# The tests for a distance are split into chunks with their own seeds (see ParallelSampler), and every finished chunk
+# is stored as its count, mean output vector and sum of squared deviations. An estimate is the merge of the chunks
+# 0, 1, 2, ... in order, so a rerun with more tests, more distances or a tighter target only computes the chunks that
+# are missing, and an interrupted run resumes at the first chunk it hadn't finished
+# Each output vector holds P(W|d) for every word in the vocabulary, so assessing more words never needs new chunks
+# Rows are keyed by a hash of the model and tokenizer files, the seed, the chunk size, the distance and the chunk index
+class ResultStore:
+    def __init__(self, model_path, tokenizer_path, store_path="./cache/results.sqlite"):
+        self.fingerprint = self.file_fingerprint([model_path, tokenizer_path])
+        if path.dirname(store_path):
+            makedirs(path.dirname(store_path), exist_ok=True)
+        self.connection = sqlite3.connect(store_path)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS default_seeds (fingerprint TEXT PRIMARY KEY, seed TEXT)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS chunks (fingerprint TEXT, seed TEXT, chunk_tests INTEGER, "
+                                "distance INTEGER, chunk INTEGER, count INTEGER, mean BLOB, m2 BLOB, "
+                                "PRIMARY KEY (fingerprint, seed, chunk_tests, distance, chunk))")
+        self.connection.commit()
+
+    # Hash the contents of a list of files, any change to the model or tokenizer starts a new set of results
+    @staticmethod
+    def file_fingerprint(file_list):
+        sha = hashlib.sha1()
+        for file in file_list:
+            with open(file, "rb") as f:
+                for block in iter(lambda: f.read(1 << 20), b""):
+                    sha.update(block)
+        return sha.hexdigest()
+
+    # Seed used by runs without a seed, drawn once per model so their results can still be extended later
+    def default_seed(self):
+        row = self.connection.execute("SELECT seed FROM default_seeds WHERE fingerprint = ?",
+                                      (self.fingerprint,)).fetchone()
+        if row:
+            return int(row[0])
+        seed = int(numpy.random.SeedSequence().entropy)
+        self.connection.execute("INSERT INTO default_seeds VALUES (?, ?)", (self.fingerprint, str(seed)))
+        self.connection.commit()
+        return seed
+
+    # Stored chunks for a distance, a dictionary of chunk index -> RunningMoments
+    def chunks(self, seed, chunk_tests, distance):
+        rows = self.connection.execute("SELECT chunk, count, mean, m2 FROM chunks WHERE fingerprint = ? AND seed = ? "
+                                       "AND chunk_tests = ? AND distance = ?",
+                                       (self.fingerprint, str(seed), chunk_tests, distance))
+        return {chunk: RunningMoments(count, numpy.frombuffer(mean, dtype=numpy.float64),
+                                      numpy.frombuffer(m2, dtype=numpy.float64))
+                for chunk, count, mean, m2 in rows}
+
+    # Store a finished chunk, replacing a shorter one with the same index
+    # A stored chunk with at least as many tests is kept, so a smaller run doesn't undo the work of a larger one
+    def add_chunk(self, seed, chunk_tests, distance, chunk, moments):
+        self.connection.execute("INSERT INTO chunks VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+                                "ON CONFLICT (fingerprint, seed, chunk_tests, distance, chunk) DO UPDATE SET "
+                                "count = excluded.count, mean = excluded.mean, m2 = excluded.m2 "
+                                "WHERE excluded.count > chunks.count",
+                                (self.fingerprint, str(seed), chunk_tests, distance, chunk, moments.count,
+                                 numpy.asarray(moments.mean, dtype=numpy.float64).tobytes(),
+                                 numpy.asarray(moments.m2, dtype=numpy.float64).tobytes()))
+        self.connection.commit()
+
+    # Merge the stored chunks of a distance in order, stopping at the first missing chunk or after max_tests tests
+    # Returns None if no chunk is stored
+    def moments(self, seed, chunk_tests, distance, max_tests=None):
+        chunks = self.chunks(seed, chunk_tests, distance)
+        moments = RunningMoments()
+        chunk = 0
+        while chunk in chunks and (max_tests is None or moments.count < max_tests):
+            if max_tests is not None and moments.count + chunks[chunk].count > max_tests:
+                break
+            moments.merge(chunks[chunk])
+            chunk += 1
+        return moments if moments.count else None
@@ -0,0 +1,74 @@
+import tensorflow as tf
+from keras.layers import Layer
+from keras.utils import Sequence
+
+
+# Output layer used for training only, it replaces Dense(units, activation='softmax') by a sampled softmax loss
+# Instead of normalizing over every word, each step scores the target word against num_sampled words drawn from a
+# log-uniform (Zipf) distribution, which matches the tokenizer indices since words are indexed by decreasing count.
+# The cost of a step then depends on num_sampled and no longer on the size of the vocabulary
+# Inputs are [hidden, targets] with integer targets, the output is the loss of every sample, see sampled_loss
+# The weights are those of the equivalent Dense layer, with the kernel transposed so the rows of the sampled words
+# can be gathered, dense_weights and set_dense_weights convert between the two
+class SampledSoftmax(Layer):
+    def __init__(self, units, num_sampled=512, **kwargs):
+        super().__init__(**kwargs)
+        self.units = units
+        self.num_sampled = num_sampled
+
+    def build(self, input_shape):
+        self.kernel = self.add_weight(name="kernel", shape=(self.units, int(input_shape[0][-1])),
+                                      initializer="glorot_uniform")
+        self.bias = self.add_weight(name="bias", shape=(self.units,), initializer="zeros")
+        super().build(input_shape)
+
+    def call(self, inputs):
+        hidden, targets = inputs
+        labels = tf.reshape(tf.cast(targets, tf.int64), (-1, 1))
+        loss = tf.nn.sampled_softmax_loss(self.kernel, self.bias, labels, hidden,
+                                          num_sampled=min(self.num_sampled, self.units - 1), num_classes=self.units)
+        return tf.reshape(loss, (-1, 1))
+
+    def compute_output_shape(self, input_shape):
+        return input_shape[0][0], 1
+
+    def get_config(self):
+        config = super().get_config()
+        config.update({"units": self.units, "num_sampled": self.num_sampled})
+        return config
+
+    # Kernel and bias of the equivalent Dense layer
+    def dense_weights(self):
+        kernel, bias = self.get_weights()
+        return [kernel.T, bias]
+
+    def set_dense_weights(self, weights):
+        kernel, bias = weights
+        self.set_weights([kernel.T, bias])
+
+
+# The SampledSoftmax layer already outputs the loss, keras only has to average it over the batch
+def sampled_loss(y_true, y_pred):
+    return y_pred
+
+
+# Needed to load a model saved with a SampledSoftmax layer, e.g. a training checkpoint
+CUSTOM_OBJECTS = {"SampledSoftmax": SampledSoftmax, "sampled_loss": sampled_loss}
+
+
+# Keras Sequence feeding the targets of another Sequence to a model with a SampledSoftmax layer as a second input
+class SampledTargets(Sequence):
+    def __init__(self, sequence):
+        self.sequence = sequence
+        self.batch_size = getattr(sequence, "batch_size", None)
+
+    def __len__(self):
+        return len(self.sequence)
+
+    # The loss ignores the outputs, the targets are passed along so keras has something of the right length
+    def __getitem__(self, index):
+        inputs, targets = self.sequence[index]
+        return (inputs, targets), targets
+
+    def on_epoch_end(self):
+        self.sequence.on_epoch_end()
@@ -0,0 +1,88 @@
+import numpy
+
+from adaptive_estimator import RunningMoments
+from instrumentation import traced
+
+
+# Class to estimate P(W|d) by scoring batches of random word sequences with a model
+# All num_tests x distance word indices for a chunk are drawn as one integer array and written straight into a
+# pre-padded input buffer, so the model is called once per chunk instead of once per test
+class SequenceSampler:
+    def __init__(self, model, tokenizer, exclude_words=(), chunk_size=4096, seed=None):
+        self.model = model  # Any model exposing get_input_length() and get_probability(), e.g. NNModel
+        self.input_length = model.get_input_length()
+        self.chunk_size = chunk_size  # Number of random sequences scored per call to the model
+        self.rng = numpy.random.default_rng(seed)
+        self.word_ids = self.candidate_word_ids(tokenizer, exclude_words)
+        # texts_to_sequences drops words beyond num_words, those are encoded as 0 and have to be compacted out
+        self.has_dropped_words = bool(numpy.any(self.word_ids == 0))
+        # Input buffer that is re-used for every chunk, rows are pre-padded with zeros like pad_sequences does
+        self.buffer = numpy.zeros((chunk_size, self.input_length), dtype=numpy.int32)
+
+    # Build the pool of integer word indices that random sequences are drawn from
+    # Mirrors the word list used by the scripts: the num_words most frequent words, minus any excluded words
+    @staticmethod
+    def candidate_word_ids(tokenizer, exclude_words=()):
+        num_words = tokenizer.num_words
+        sorted_words = sorted(tokenizer.word_counts.items(), key=lambda x: x[1], reverse=True)[:num_words]
+        sorted_words = [x[0] for x in sorted_words if x[0] not in exclude_words]
+        if not sorted_words:
+            raise ValueError("SequenceSampler : no words left to build random sequences from")
+        word_ids = numpy.array([tokenizer.word_index[word] for word in sorted_words], dtype=numpy.int32)
+        if num_words:
+            word_ids[word_ids >= num_words] = 0
+        return word_ids
+
+    # Fill the first n rows of the input buffer with random sequences of length distance and return them
+    def sample_sequences(self, distance, n):
+        batch = self.buffer[:n]
+        width = min(distance, self.input_length)
+        batch[:, :self.input_length - width] = 0
+        if width == 0:
+            return batch
+        sampled = self.word_ids[self.rng.integers(0, len(self.word_ids), size=(n, distance))]
+        if self.has_dropped_words:
+            # Move dropped words (zeros) to the front of each row while keeping the order of the remaining words
+            order = numpy.argsort(sampled != 0, axis=1, kind="stable")
+            sampled = numpy.take_along_axis(sampled, order, axis=1)
+        # pad_sequences truncates from the front, so only the last input_length words are kept
+        batch[:, self.input_length - width:] = sampled[:, distance - width:]
+        return batch
+
+    # Sum the model's output vectors over num_tests random sequences of length distance
+    # Sequences are generated and scored in chunks of chunk_size so memory stays bounded for any num_tests
+    @traced
+    def probability_sums(self, distance, num_tests):
+        sums = None
+        for start in range(0, num_tests, self.chunk_size):
+            n = min(self.chunk_size, num_tests - start)
+            probabilities = self.model.get_probability(self.sample_sequences(distance, n), batch_size=n)
+            chunk_sums = numpy.sum(probabilities, axis=0, dtype=numpy.float64)
+            sums = chunk_sums if sums is None else sums + chunk_sums
+        return sums
+
+    # Running mean and variance of the model's output vectors over num_tests random sequences of length distance
+    @traced
+    def probability_moments(self, distance, num_tests):
+        moments = RunningMoments()
+        for start in range(0, num_tests, self.chunk_size):
+            n = min(self.chunk_size, num_tests - start)
+            moments.add(self.model.get_probability(self.sample_sequences(distance, n), batch_size=n))
+        return moments
+
+    # Score chunks of random sequences until target, a PrecisionTarget, is met for the columns in word_indices or
+    # its budget of tests is spent. Returns the RunningMoments, whose mean is the estimate of P(W|d) for every word
+    @traced
+    def adaptive_moments(self, distance, target, word_indices):
+        moments = RunningMoments()
+        while not target.done(moments, word_indices):
+            moments.merge(self.probability_moments(distance, min(self.chunk_size, target.max_tests - moments.count)))
+        return moments
+
+    # Average output vector of the model over num_tests random sequences of length distance
+    def mean_probabilities(self, distance, num_tests):
+        return self.probability_sums(distance, num_tests) / num_tests
+
+    # Estimate P(W|d) for a single word index
+    def probability(self, word_index, distance, num_tests):
+        return self.mean_probabilities(distance, num_tests)[word_index]
@@ -0,0 +1,284 @@
+import sys
+import getopt
+import json
+import time
+import random
+import hashlib
+from itertools import product
+from multiprocessing import get_context
+from os import environ, path, makedirs, replace, cpu_count
+# This will stop tensorflow from spamming unnecessary error messages about its GPU implementation
+# Needs to set before we import anything from keras/tensorflow, the trial processes inherit it
+environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
+
+import numpy
+
+from data_interpreter import DataInterpreter
+from prefix_sequence import PrefixSequence
+
+
+# Hyperparameters a sweep can vary, with the values training.py uses
+# hidden_size None is the 2/3*(input layer + output layer) rule of thumb, num_sampled None the full softmax and
+# learning_rate None the adam default
+DEFAULT_TRIAL = {"projection_size": 32, "hidden_size": None, "max_len": 15, "batch_size": 32, "num_sampled": None,
+                 "learning_rate": None}
+
+
+def print_help():
+    print("Usage:")
+    print("python sweep.py [-n <n_files>] [-m <min_freq>] [-e <epochs>] [-j <cores>] [--trialcores <cores>]")
+    print("       [-v <validation_frac>] [-a <accuracy>] [-s <seed>] [-o <report>] [--projection <sizes>]")
+    print("       [--hidden <sizes>] [--maxlen <lengths>] [--batchsize <sizes>] [--sampled <sizes>]")
+    print("       [--learningrate <rates>]")
+    print("Where")
+    print("<n_files> is the number of data files to train on, sampled from the training files (default 51)")
+    print("<min_freq> keeps the words appearing more often than this in the vocabulary (default <n_files>/2)")
+    print("<epochs> is the number of epochs every trial trains for (default 10)")
+    print("<cores> is the number of cores the whole sweep may use (default all), trials run concurrently on")
+    print("        --trialcores cores each (default 1)")
+    print("<validation_frac> of the sentences is held out to score every trial after each epoch (default 0.1)")
+    print("<accuracy> is the validation accuracy whose time to reach is reported per trial (default 0.2)")
+    print("<seed> seeds the file sample, the shuffling and the validation split (default 0)")
+    print("<report> is the json file the results are written to (default cache/sweep/report.json)")
+    print("The model configurations are every combination of the comma separated values of:")
+    print("--projection <sizes> embedding size (default 32)")
+    print("--hidden <sizes> LSTM size (default 2/3 of the input and output layer sizes)")
+    print("--maxlen <lengths> longest chunk of a sentence, the input layer has <length> - 1 neurons (default 15)")
+    print("--batchsize <sizes> batch size (default 32)")
+    print("--sampled <sizes> number of sampled words with a sampled softmax, 0 for the full softmax (default 0)")
+    print("--learningrate <rates> adam learning rate (default 0.001)")
+
+
+# Read and tokenize the training files once for all trials, the same steps training.py takes with the corpus cache
+# The tokenizer indices of every line are saved in cache_dir, keyed on the files and min_freq, so later sweeps over the
+# same data skip this step. The tokenizer is saved next to them, the models of the trials use its indices
+# Returns the path of the saved data
+def prepare_shared_data(files, min_freq, cache_dir="./cache/sweep/"):
+    key = hashlib.sha1(json.dumps([sorted(files), min_freq]).encode("utf-8")).hexdigest()[:16]
+    data_path = path.join(cache_dir, "data_%s.npz" % key)
+    if path.exists(data_path):
+        return data_path
+    makedirs(cache_dir, exist_ok=True)
+    data_interp = DataInterpreter()
+    tokens, vocabulary = data_interp.read_token_files(files)
+    tokens = data_interp.simplify_token_data(tokens, vocabulary, min_freq=min_freq)
+    vocab = data_interp.set_num_words_from_tokens(tokens, vocabulary, min_freq=min_freq)
+    data_interp.fit_tokenizer_on_tokens(tokens, vocabulary)
+    lines = data_interp.tokens_to_sequences(tokens, vocabulary)
+    indices = numpy.array([index for line in lines for index in line], dtype=numpy.int32)
+    lengths = numpy.array([len(line) for line in lines], dtype=numpy.int64)
+    # Written under a temporary name first, trials only ever see a complete file
+    numpy.savez(data_path + ".tmp.npz", indices=indices, lengths=lengths, vocab_size=len(vocab) + 1)
+    data_interp.tokenizer.save(path.join(cache_dir, "tokenizer_%s.vocab" % key))
+    replace(data_path + ".tmp.npz", data_path)
+    return data_path
+
+
+# Cross-entropy and accuracy of the full softmax of an NNModel over the batches of a PrefixSequence
+def validation_metrics(model, validation_data):
+    total_loss = 0.0
+    correct = 0
+    count = 0
+    for index in range(len(validation_data)):
+        inputs, targets = validation_data[index]
+        probabilities = model.get_probability(inputs, batch_size=len(inputs))
+        target_probabilities = probabilities[numpy.arange(len(targets)), targets]
+        total_loss -= numpy.sum(numpy.log(numpy.maximum(target_probabilities, 1e-12)))
+        correct += int(numpy.sum(numpy.argmax(probabilities, axis=-1) == targets))
+        count += len(targets)
+    return total_loss / max(count, 1), correct / max(count, 1)
+
+
+# Keras callback recording the training time, the training loss and the full softmax validation metrics of every
+# epoch. The validation pass isn't counted as training time. Built on first use so this module doesn't import keras
+def trial_monitor(model, validation_data):
+    from keras.callbacks import Callback
+
+    class TrialMonitor(Callback):
+        def on_train_begin(self, logs=None):
+            self.history = []
+            self.seconds = 0.0
+
+        def on_epoch_begin(self, epoch, logs=None):
+            self.epoch_start = time.perf_counter()
+
+        def on_epoch_end(self, epoch, logs=None):
+            self.seconds += time.perf_counter() - self.epoch_start
+            # A sampled softmax only updates the Dense layer scoring the validation data at the end of fit_model
+            model.sync_output_layer()
+            val_loss, val_accuracy = validation_metrics(model, validation_data)
+            self.history.append({"epoch": epoch + 1, "seconds": self.seconds, "loss": float((logs or {})["loss"]),
+                                 "val_loss": float(val_loss), "val_accuracy": float(val_accuracy)})
+
+    return TrialMonitor()
+
+
+# Train one configuration in a pool worker, on the shared data and with cores threads
+def run_trial(task):
+    name, trial, data_path, cores, epochs, validation_frac, target_accuracy, seed = task
+    from nn_model import NNModel, configure_threads
+    configure_threads(cores)
+    data = numpy.load(data_path)
+    lines = numpy.split(data["indices"], numpy.cumsum(data["lengths"])[:-1])
+    vocab_size = int(data["vocab_size"])
+    max_length, tokens, targets = DataInterpreter.sequences_to_token_stream(lines, trial["max_len"])
+    training_data, validation_data = PrefixSequence(tokens, targets, max_length - 1, trial["batch_size"],
+                                                    seed=seed).split(validation_frac, seed)
+    hidden_layer_size = trial["hidden_size"] or int((vocab_size + max_length - 1)*2/3)
+    model = NNModel()
+    model.prepare_model(max_length - 1, vocab_size, trial["projection_size"], hidden_layer_size, sparse_targets=True,
+                        num_sampled=trial["num_sampled"], learning_rate=trial["learning_rate"])
+    monitor = trial_monitor(model, validation_data)
+    model.fit_model(training_data, epochs=epochs, verbosity=0, callbacks=[monitor])
+    history = monitor.history
+    best = min(history, key=lambda x: x["val_loss"])
+    reached = [epoch["seconds"] for epoch in history if epoch["val_accuracy"] >= target_accuracy]
+    return {"name": name, "trial": trial, "hidden_layer_size": hidden_layer_size, "vocab_size": vocab_size,
+            "cores": cores, "epochs": len(history), "train_seconds": history[-1]["seconds"],
+            "final_loss": history[-1]["loss"], "best_val_loss": best["val_loss"], "best_epoch": best["epoch"],
+            "best_val_accuracy": max(epoch["val_accuracy"] for epoch in history),
+            "time_to_accuracy": reached[0] if reached else None, "history": history}
+
+
+# One trial per combination of the values in grid, a dictionary of hyperparameter -> list of values
+def make_trials(grid):
+    names = sorted(grid)
+    return [dict(DEFAULT_TRIAL, **dict(zip(names, values))) for values in product(*[grid[name] for name in names])]
+
+
+# Short name of a trial listing the hyperparameters that differ from training.py
+def trial_name(trial):
+    return ",".join("%s=%s" % (name, value) for name, value in sorted(trial.items())
+                    if value != DEFAULT_TRIAL[name]) or "default"
+
+
+# Table of the results, lowest validation loss first
+def format_report(results, target_accuracy):
+    lines = ["%-48s %6s %10s %10s %10s %8s %12s" % ("trial", "epochs", "train s", "loss", "val loss", "val acc",
+                                                    "s to %.2f" % target_accuracy)]
+    for result in sorted(results, key=lambda x: x["best_val_loss"]):
+        lines.append("%-48s %6d %10.1f %10.4f %10.4f %8.4f %12s"
+                     % (result["name"], result["epochs"], result["train_seconds"], result["final_loss"],
+                        result["best_val_loss"], result["best_val_accuracy"],
+                        "%.1f" % result["time_to_accuracy"] if result["time_to_accuracy"] is not None else "-"))
+    return "\n".join(lines)
+
+
+# Train every trial on a pool of processes, budget // trial_cores at a time, and write the report after each one
+def run_sweep(trials, data_path, budget, trial_cores, epochs, validation_frac, target_accuracy, seed, report_path):
+    # Each process gets trial_cores cores, otherwise every process starts a full set of BLAS threads
+    for variable in ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS"):
+        environ.setdefault(variable, str(trial_cores))
+    concurrency = max(1, min(len(trials), budget // trial_cores))
+    print("Running %d trials, %d at a time on %d cores each" % (len(trials), concurrency, trial_cores))
+    tasks = [(trial_name(trial), trial, data_path, trial_cores, epochs, validation_frac, target_accuracy, seed)
+             for trial in trials]
+    results = []
+    if path.dirname(report_path):
+        makedirs(path.dirname(report_path), exist_ok=True)
+    # Spawned rather than forked processes, tensorflow doesn't survive a fork. A fresh process per trial releases the
+    # memory of the previous model
+    with get_context("spawn").Pool(concurrency, maxtasksperchild=1) as pool:
+        for result in pool.imap_unordered(run_trial, tasks):
+            print("Finished %s: validation loss %.4f, accuracy %.4f after %.1f s"
+                  % (result["name"], result["best_val_loss"], result["best_val_accuracy"], result["train_seconds"]))
+            results.append(result)
+            with open(report_path, "w", encoding="utf-8") as report_file:
+                json.dump({"data": data_path, "epochs": epochs, "target_accuracy": target_accuracy,
+                           "trials": results}, report_file, indent=1)
+    return results
+
+
+def main():
+    # Retrieve arguments, print help() if that fails
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hn:m:e:j:v:a:s:o:",
+                                   ["help", "nfiles=", "minfreq=", "epochs=", "cores=", "trialcores=", "validation=",
+                                    "accuracy=", "seed=", "output=", "projection=", "hidden=", "maxlen=",
+                                    "batchsize=", "sampled=", "learningrate="])
+    except getopt.GetoptError:
+        print_help()
+        sys.exit(2)
+    n_files = 51
+    min_freq = None
+    epochs = 10
+    budget = cpu_count()
+    trial_cores = 1
+    validation_frac = 0.1
+    target_accuracy = 0.2
+    seed = 0
+    report_path = "./cache/sweep/report.json"
+    grid = {}
+    grid_options = {"--projection": "projection_size", "--hidden": "hidden_size", "--maxlen": "max_len",
+                    "--batchsize": "batch_size", "--sampled": "num_sampled", "--learningrate": "learning_rate"}
+    for opt, arg in opts:
+        if opt in ("-h", "--help"):
+            print_help()
+            sys.exit()
+        elif opt in ("-n", "--nfiles", "-m", "--minfreq", "-e", "--epochs", "-j", "--cores", "--trialcores",
+                     "-s", "--seed"):
+            try:
+                value = int(arg)
+            except ValueError:
+                print("%s %s couldn't be converted to an int. \n" % (opt, arg))
+                print_help()
+                sys.exit(2)
+            if value < 0 or (value == 0 and opt not in ("-m", "--minfreq", "-s", "--seed")):
+                print("%s %s should be a positive integer. \n" % (opt, arg))
+                print_help()
+                sys.exit(2)
+            if opt in ("-n", "--nfiles"):
+                n_files = value
+            elif opt in ("-m", "--minfreq"):
+                min_freq = value
+            elif opt in ("-e", "--epochs"):
+                epochs = value
+            elif opt in ("-j", "--cores"):
+                budget = value
+            elif opt == "--trialcores":
+                trial_cores = value
+            else:
+                seed = value
+        elif opt in ("-v", "--validation", "-a", "--accuracy"):
+            try:
+                value = float(arg)
+            except ValueError:
+                print("%s %s couldn't be converted to a float. \n" % (opt, arg))
+                print_help()
+                sys.exit(2)
+            if not 0 < value < 1:
+                print("%s %s should be between 0 and 1. \n" % (opt, arg))
+                print_help()
+                sys.exit(2)
+            if opt in ("-v", "--validation"):
+                validation_frac = value
+            else:
+                target_accuracy = value
+        elif opt in ("-o", "--output"):
+            report_path = arg
+        elif opt in grid_options:
+            convert = float if opt == "--learningrate" else int
+            try:
+                values = [convert(value) for value in arg.split(",")]
+            except ValueError:
+                print("%s %s should be a comma separated list of numbers. \n" % (opt, arg))
+                print_help()
+                sys.exit(2)
+            if opt == "--sampled":
+                # 0 is the full softmax
+                values = [value or None for value in values]
+            grid[grid_options[opt]] = values
+
+    random.seed(seed)
+    files = DataInterpreter.select_files(DataInterpreter().training_files, n_files, sample_data=True)
+    print("Preparing the data of %d files" % len(files))
+    data_path = prepare_shared_data(files, len(files) / 2 if min_freq is None else min_freq)
+    trials = make_trials(grid)
+    results = run_sweep(trials, data_path, budget, trial_cores, epochs, validation_frac, target_accuracy, seed,
+                        report_path)
+    print(format_report(results, target_accuracy))
+    print("Report written to %s" % report_path)
+
+
+if __name__ == "__main__":
+    main()
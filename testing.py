@@ -2,45 +2,114 @@
 import sys
 import getopt
 from os import environ
-from json import load
-from random import choice
+from json import loads, dumps
 # This will stop tensorflow from spamming unnecessary error messages about its GPU implementation
 # Needs to set before we import anything from keras/tensorflow
 environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
-# Import model class
-from nn_model import NNModel
-# Import keras libraries
-from keras.preprocessing.text import tokenizer_from_json
-from keras.preprocessing.sequence import pad_sequences
+# The sampler, numpy and the model classes are imported once they are needed, so -l and --cached stay fast
+from instrumentation import enable_tracing, TRACE_ENV
+# Import the tokenizer, it needs neither keras nor tensorflow
+from fast_tokenizer import FastTokenizer
 
 
-# Load the tokenizer used during training from a json
+# Model and tokenizer produced by training.py
+MODEL_PATH = "./model_51_file_training.h5"
+# Quantized artifact exported from the model by quantized_model.py, used by the quantized backend
+QUANTIZED_PATH = "./model_51_file_training.qmodel"
+# Gap and n-gram counts of the training files written by count_model.py, used by the count backend
+COUNT_PATH = "./count_model.npz"
+TOKENIZER_PATH = "./tokenizer_51_file_training.vocab"
+# File identifying the results of each backend in the result store of accuracy_assessment.py
+STORE_PATHS = {"keras": MODEL_PATH, "numpy": MODEL_PATH, "quantized": QUANTIZED_PATH, "count": COUNT_PATH}
+
+
+# Load the tokenizer used during training from its binary vocabulary file
 def load_tokenizer():
-    with open('./tokenizer_51_file_training.json') as jsonf:
-        data = load(jsonf)
-        tokenizer = tokenizer_from_json(data)
-    return tokenizer
+    return FastTokenizer.load(TOKENIZER_PATH)
 
 
 # Load the model used during training
-def load_model():
+# The keras backend is the trained NNModel, the numpy backend runs the same forward pass without importing tensorflow
+# and the quantized backend runs it on the memory-mapped artifact written by quantized_model.py
+# The count backend measures P(W|d) from the training files instead of using the network
+def load_model(backend="keras"):
+    if backend == "count":
+        from count_model import CountModel
+        model = CountModel()
+        model.load_model(COUNT_PATH)
+        return model
+    if backend == "numpy":
+        from numpy_model import NumpyModel
+        model = NumpyModel()
+        model.load_model(MODEL_PATH)
+        return model
+    if backend == "quantized":
+        from quantized_model import QuantizedModel
+        model = QuantizedModel()
+        model.load_model(QUANTIZED_PATH)
+        return model
+    from nn_model import NNModel
     model = NNModel()
-    model.load_model("./model_51_file_training.h5")
+    model.load_model(MODEL_PATH)
     print(model.model.summary())
     return model
 
 
 def print_help():
     print("Usage:")
-    print("python testing.py -w <word> -d <distance> -t <tests>")
+    print("python testing.py -w <word> -d <distance> -t <tests> [-s <seed>] [-c <chunk_size>] [-b <backend>]"
+          " [--trace <file>]")
     print("Where")
     print("<word> should by a word in the word list used during training")
     print("<distance> is the distance between two instances of <word>")
     print("<tests> is the number of tests to perform with random sequences of words not containing <word>")
+    print("<seed> optionally seeds the random sequences so results can be reproduced")
+    print("<chunk_size> is the number of random sequences scored per model call (default 4096)")
+    print("<backend> is keras (default), numpy, quantized or count, numpy scores sequences without loading tensorflow")
+    print("          and quantized does so from the smaller %s, see quantized_model.py" % QUANTIZED_PATH)
+    print("          count uses the word gaps counted in the training files by count_model.py instead of the model,")
+    print("          it reads P(W|d) directly, needs no <tests> and only goes up to the longest distance it counted")
+    print("Add -u <url> to send the query to a running inference_server.py instead of loading the model")
+    print("Add --cached to read the estimate from the results accuracy_assessment.py stored for <backend>, with the")
+    print("same <seed> and <chunk_size>, instead of loading the model. <tests> is then optional and caps the number of")
+    print("stored tests used. Those random sequences may contain <word>")
+    print("Adaptive mode, sample until the confidence interval is precise enough instead of running exactly <tests>:")
+    print("-e <rel_error> stops when the interval half width is below <rel_error> times the estimate")
+    print("--ciwidth <width> stops when the full interval is narrower than <width>")
+    print("--confidence <level> is the confidence level of the interval (default 0.95)")
+    print("<tests> is then the largest number of tests to run (default 1000000)")
+    print("--trace <file> writes a timing trace of the run to <file> and prints a summary, as does setting %s=<file>"
+          % TRACE_ENV)
     print("To obtain the word list, try:")
     print("python testing.py -l")
 
 
+# Ask a running inference_server.py for P(W|d)
+def query_server(url, test_word, distance, num_tests, seed=None):
+    from urllib.request import urlopen, Request
+    from urllib.error import HTTPError
+    query = {"word": test_word, "distance": distance, "tests": num_tests, "seed": seed}
+    request = Request(url.rstrip("/") + "/probability", data=dumps(query).encode("utf-8"),
+                      headers={"Content-Type": "application/json"})
+    try:
+        with urlopen(request) as response:
+            return loads(response.read().decode("utf-8"))["probability"]
+    except HTTPError as error:
+        # The server rejected the query, e.g. without -t for a backend that has to sample
+        print("The server couldn't answer the query: %s" % loads(error.read().decode("utf-8"))["error"])
+        sys.exit(2)
+
+
+# Moments of the output vectors stored by accuracy_assessment.py for a distance, None if nothing is stored
+# The chunks are merged like ParallelSampler does, up to num_tests tests
+def stored_moments(backend, distance, num_tests=None, seed=None, chunk_size=4096):
+    from numpy.random import SeedSequence
+    from result_store import ResultStore
+    store = ResultStore(STORE_PATHS[backend], TOKENIZER_PATH)
+    entropy = SeedSequence(store.default_seed() if seed is None else seed).entropy
+    return store.moments(entropy, chunk_size, distance, num_tests)
+
+
 def word_list():
     print(load_tokenizer().word_index.keys())
 
@@ -48,13 +117,24 @@ def word_list():
 def main():
     # Retrieve arguments, print help() if that fails
     try:
-        opts, args = getopt.getopt(sys.argv[1:], "hlw:d:t:", ["help", "list", "word=", "distance=", "tests="])
+        opts, args = getopt.getopt(sys.argv[1:], "hlw:d:t:s:c:u:b:e:",
+                                   ["help", "list", "word=", "distance=", "tests=", "seed=", "chunksize=", "url=",
+                                    "backend=", "relerror=", "ciwidth=", "confidence=", "cached", "trace="])
     except getopt.GetoptError:
         print_help()
         sys.exit(2)
     test_word = None
     distance = None
     num_tests = None
+    seed = None
+    chunk_size = 4096
+    url = None
+    backend = "keras"
+    rel_error = None
+    ci_width = None
+    confidence = 0.95
+    trace_path = None
+    cached = False
     for opt, arg in opts:
         if opt in ("-h", "--help"):
             print_help()
@@ -78,50 +158,129 @@ def main():
                 print("--tests %s couldn't be converted to an int. \n" % arg)
                 print_help()
                 sys.exit(2)
+        elif opt in ("-s", "--seed"):
+            try:
+                seed = int(arg)
+            except ValueError:
+                print("--seed %s couldn't be converted to an int. \n" % arg)
+                print_help()
+                sys.exit(2)
+        elif opt in ("-c", "--chunksize"):
+            try:
+                chunk_size = int(arg)
+            except ValueError:
+                print("--chunksize %s couldn't be converted to an int. \n" % arg)
+                print_help()
+                sys.exit(2)
+        elif opt in ("-u", "--url"):
+            url = arg
+        elif opt in ("-b", "--backend"):
+            if arg not in ("keras", "numpy", "quantized", "count"):
+                print("--backend %s should be keras, numpy, quantized or count. \n" % arg)
+                print_help()
+                sys.exit(2)
+            backend = arg
+        elif opt in ("-e", "--relerror", "--ciwidth", "--confidence"):
+            try:
+                value = float(arg)
+            except ValueError:
+                print("%s %s couldn't be converted to a float. \n" % (opt, arg))
+                print_help()
+                sys.exit(2)
+            if opt in ("-e", "--relerror"):
+                rel_error = value
+            elif opt == "--ciwidth":
+                ci_width = value
+            else:
+                confidence = value
+        elif opt == "--cached":
+            cached = True
+        elif opt == "--trace":
+            trace_path = arg
+    # Time the run if --trace or the LV_TRACE environment variable was given
+    enable_tracing(trace_path)
 
+    adaptive = rel_error is not None or ci_width is not None
     # Check that the script recieved all necessary arguments, print help if not
-    if None not in (test_word, distance, num_tests):
+    # The count backend reads P(W|d) directly and needs no tests
+    if None not in (test_word, distance) and (num_tests is not None or adaptive or cached or backend == "count"):
         pass
     else:
         print_help()
         sys.exit(2)
 
+    # Thin client mode, the server already has the model and tokenizer loaded
+    if url:
+        if adaptive:
+            print("Adaptive mode isn't supported with --url, use -t instead. \n")
+            print_help()
+            sys.exit(2)
+        probability = query_server(url, test_word, distance, num_tests, seed)
+        print("Probability of encountering the word %s after a sequence of %d words is %f"
+              % (test_word, distance, probability))
+        return
+
     # Start by opening the tokenizer used during training
     # Will want to use the word_index and word_counts
     tokenizer = load_tokenizer()
     # Get the index of our test word in the tokenizer
     test_word_index = tokenizer.word_index[test_word]
-    # Get the num_words setting for this tokenizer, used to determine which words were used during training
+    # Check that the test word is part of the word list used during training
     num_words = tokenizer.num_words
-    # Sort the words in the tokenizer by their frequency and keep only the first num_words words
     sorted_words = sorted(tokenizer.word_counts.items(), key=lambda x: x[1], reverse=True)[:num_words]
-    # Keep only the words, not the word counts, and remove the test word
-    sorted_words = [x[0] for x in sorted_words]
-    # Try to remove the test_word from sorted words
-    try:
-        sorted_words.remove(test_word)
-    except ValueError:
+    if test_word not in [x[0] for x in sorted_words]:
         print("--word %s wasn't found in word list, printing word list and exiting." % test_word)
         word_list()
         sys.exit(2)
 
+    if cached:
+        moments = stored_moments(backend, distance, num_tests, seed, chunk_size)
+        if moments is None:
+            print("No stored results for distance %d, run accuracy_assessment.py with -d %d or more first"
+                  % (distance, distance + 1))
+            sys.exit(2)
+        print("Probability of encountering the word %s after a sequence of %d words is %f +- %f"
+              % (test_word, distance, moments.mean[test_word_index],
+                 moments.half_width(confidence)[test_word_index]))
+        print("%g%% confidence interval from %d stored tests" % (100 * confidence, moments.count))
+        return
+
     # Load the model used during training
-    model = load_model()
-
-    probability_sum = 0
-    for _ in range(num_tests):
-        # Create a random sequence of words of length --distance that doesn't include
-        random_words = ""
-        for _ in range(distance):
-            random_words += " " + choice(sorted_words)
-        sequence = tokenizer.texts_to_sequences([random_words])[0]
-        sequence = pad_sequences([sequence], maxlen=model.model.input_shape[1], padding="pre")
-        probabilities = model.get_probability(sequence)[0]
-        # Get the probability for the test word
-        probability_sum += probabilities[test_word_index]
+    model = load_model(backend)
+
+    if backend == "count":
+        # The count model holds P(W|d) itself, there is nothing to sample, but only up to the distances it counted
+        try:
+            probability = model.gap_probability(test_word_index, distance)
+        except ValueError as error:
+            print("%s, use another backend for longer distances. \n" % error)
+            print_help()
+            sys.exit(2)
+        print("Probability of encountering the word %s after a sequence of %d words is %f"
+              % (test_word, distance, probability))
+        return
+
+    from sequence_sampler import SequenceSampler
+    from adaptive_estimator import PrecisionTarget
+
+    # Score random sequences of words of length --distance that don't include the test word
+    sampler = SequenceSampler(model, tokenizer, exclude_words=(test_word,), chunk_size=chunk_size, seed=seed)
+    if adaptive:
+        # Sample until the confidence interval on the test word's probability meets the target
+        target = PrecisionTarget(rel_error, ci_width, confidence, max_tests=num_tests or 1000000,
+                                 min_tests=min(chunk_size, 1000))
+        moments = sampler.adaptive_moments(distance, target, [test_word_index])
+        half_width = moments.half_width(confidence)[test_word_index]
+        print("Probability of encountering the word %s after a sequence of %d words is %f +- %f"
+              % (test_word, distance, moments.mean[test_word_index], half_width))
+        print("%g%% confidence interval after %d tests, target %s%s"
+              % (100 * confidence, moments.count, target.describe(),
+                 "" if target.met(moments, [test_word_index]) else " (not met, budget spent)"))
+        return
+    probability = sampler.probability(test_word_index, distance, num_tests)
 
     print("Probability of encountering the word %s after a sequence of %d words is %f"
-          % (test_word, distance, probability_sum/num_tests))
+          % (test_word, distance, probability))
 
 
 if __name__ == "__main__":
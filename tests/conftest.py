@@ -0,0 +1,6 @@
+import sys
+from os import environ, path
+
+# The modules live in the root of the repository and are imported as top level modules, like the scripts do
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+environ.setdefault("TF_CPP_MIN_LOG_LEVEL", "3")
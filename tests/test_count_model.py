@@ -0,0 +1,48 @@
+from os import path
+
+import numpy
+import pytest
+
+import testing
+from count_model import CountModel
+
+REPO = path.dirname(path.dirname(path.abspath(__file__)))
+
+
+def small_model(max_distance=5):
+    rng = numpy.random.default_rng(0)
+    model = CountModel()
+    model.fit_model([rng.integers(1, 8, size=40) for _ in range(5)], 8, max_distance=max_distance, order=2)
+    return model
+
+
+# P(W|d) is available up to the counted distance and raises one step beyond instead of giving P(W|max_distance)
+def test_gap_probability_stops_at_max_distance():
+    model = small_model()
+    assert model.gap_probability(3, 5) == pytest.approx(float(model.gap_table[5, 3]))
+    with pytest.raises(ValueError):
+        model.gap_probability(3, 6)
+    model.check_distance(5)
+    with pytest.raises(ValueError):
+        model.check_distance(6)
+
+
+# A sequence of exactly max_distance words without W gives P(W|max_distance)
+def test_get_probability_at_max_distance():
+    model = small_model()
+    sequences = numpy.array([[1, 2, 1, 2, 1]])
+    numpy.testing.assert_allclose(model.get_probability(sequences)[0, 3], model.gap_table[5, 3])
+
+
+# testing.py answers up to the distances count_model.npz counted and exits beyond them instead of capping them
+def test_testing_script_boundary(monkeypatch, capsys):
+    monkeypatch.chdir(REPO)
+    max_distance = testing.load_model("count").get_input_length()
+    monkeypatch.setattr("sys.argv", ["testing.py", "-w", "long", "-d", str(max_distance), "-b", "count"])
+    testing.main()
+    assert "after a sequence of %d words" % max_distance in capsys.readouterr().out
+    monkeypatch.setattr("sys.argv", ["testing.py", "-w", "long", "-d", str(max_distance + 1), "-b", "count"])
+    with pytest.raises(SystemExit) as exit_info:
+        testing.main()
+    assert exit_info.value.code == 2
+    assert "only counted up to d = %d" % max_distance in capsys.readouterr().out
@@ -0,0 +1,38 @@
+from os import path
+
+import numpy
+
+from nn_model import NNModel
+from numpy_model import NumpyModel, compare_with_keras
+
+SHIPPED_MODEL = path.join(path.dirname(path.dirname(path.abspath(__file__))), "model_51_file_training.h5")
+
+
+def random_sequences(input_length, vocab_size, num_sequences=200, seed=0):
+    rng = numpy.random.default_rng(seed)
+    sequences = rng.integers(1, vocab_size, size=(num_sequences, input_length))
+    sequences[numpy.arange(input_length)[None, :] < rng.integers(0, input_length + 1, size=(num_sequences, 1))] = 0
+    return sequences
+
+
+# A model built and saved with the installed keras goes through NumpyModel with the same output as model.predict
+def test_round_trip_of_a_fresh_model(tmp_path):
+    model = NNModel()
+    model.prepare_model(6, 40, projection_size=8, hidden_layer_size=5)
+    model_path = str(tmp_path / "model.h5")
+    model.save_model(model_path)
+    numpy_model = NumpyModel()
+    numpy_model.load_model(model_path)
+    assert numpy_model.get_input_length() == 6
+    sequences = random_sequences(6, 40)
+    numpy.testing.assert_allclose(numpy_model.get_probability(sequences),
+                                  model.model.predict(sequences, verbose=0), atol=1e-5)
+    assert compare_with_keras(model_path, num_sequences=100, seed=0) < 1e-5
+
+
+# The shipped model was saved by an older keras, with the input length on the Embedding layer
+def test_reads_the_shipped_model():
+    embeddings, lstm_weights, dense_weights, input_length, _, _ = NumpyModel.read_weights(SHIPPED_MODEL)
+    assert input_length == 14
+    assert embeddings.shape[0] == dense_weights[0].shape[1]
+    assert lstm_weights[1].shape[1] == 4 * lstm_weights[1].shape[0]
@@ -0,0 +1,30 @@
+import numpy
+import pytest
+
+from nn_model import NNModel
+from quantized_model import QuantizedModel, export_model, read_artifact
+
+
+# Export a model trained with the installed keras, then score with the artifact like the quantized backend does
+@pytest.mark.parametrize("quantization, tolerance", [("float16", 1e-3), ("int8", 2e-2)])
+def test_export_of_a_freshly_trained_model(tmp_path, quantization, tolerance):
+    rng = numpy.random.default_rng(0)
+    model = NNModel()
+    model.prepare_model(6, 40, projection_size=8, hidden_layer_size=5, sparse_targets=True)
+    inputs = rng.integers(0, 40, size=(256, 6))
+    model.fit_model(inputs, rng.integers(1, 40, size=256), epochs=1, verbosity=0)
+    model_path = str(tmp_path / "model.h5")
+    artifact_path = str(tmp_path / "model.qmodel")
+    model.save_model(model_path)
+    assert export_model(model_path, artifact_path, quantization) > 0
+    header, arrays = read_artifact(artifact_path)
+    assert header["quantization"] == quantization and header["input_length"] == 6
+    assert arrays["embedding"].dtype == numpy.dtype(quantization)
+    quantized_model = QuantizedModel()
+    quantized_model.load_model(artifact_path)
+    expected = model.model.predict(inputs, verbose=0)
+    assert numpy.max(numpy.abs(quantized_model.get_probability(inputs) - expected)) < tolerance
+    # NNModel builds a keras model from the artifact as well
+    keras_model = NNModel()
+    keras_model.load_model(artifact_path)
+    assert numpy.max(numpy.abs(keras_model.get_probability(inputs) - expected)) < tolerance
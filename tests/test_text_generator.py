@@ -0,0 +1,46 @@
+import numpy
+
+from fast_tokenizer import FastTokenizer, pad_sequences
+from nn_model import NNModel
+from text_generator import TextGenerator
+
+TEXTS = ["mi laik go long haus", "yu go long taun", "em i stap long haus bilong mi", "mi laik kaikai"]
+
+
+def small_model(input_length=4):
+    tokenizer = FastTokenizer()
+    tokenizer.fit_on_texts(TEXTS)
+    model = NNModel()
+    model.prepare_model(input_length, len(tokenizer.word_index) + 1, projection_size=8, hidden_layer_size=6)
+    return model, tokenizer
+
+
+# The sliding window of the original generate_sentence, with the padding index left out of the argmax like
+# TextGenerator.sample does
+def window_sentence(model, seed_word, length, tokenizer):
+    text = seed_word
+    for _ in range(length):
+        sequence = pad_sequences(tokenizer.texts_to_sequences([text]), maxlen=model.get_input_length())
+        probabilities = model.model.predict(sequence, verbose=0)[0]
+        text += " " + tokenizer.index_word[int(numpy.argmax(probabilities[1:])) + 1]
+    return text
+
+
+def test_generate_sentence_keeps_the_sliding_window():
+    model, tokenizer = small_model()
+    # Longer than the input length, so the window slides
+    assert model.generate_sentence("mi laik", 8, tokenizer) == window_sentence(model, "mi laik", 8, tokenizer)
+    # The generator is kept between calls and dropped when the weights change
+    generator = model.text_generator
+    model.generate_sentence("yu", 2, tokenizer)
+    assert model.text_generator is generator
+    model.fit_model(numpy.ones((2, 4)), numpy.eye(len(tokenizer.word_index) + 1)[:2], epochs=1, verbosity=0)
+    assert model.text_generator is None
+
+
+def test_generate_window_batches_seed_texts():
+    model, tokenizer = small_model()
+    generator = TextGenerator(model, tokenizer)
+    seeds = ["mi laik", "yu go long", "em"]
+    assert generator.generate_window(seeds, 5, top_k=1) == [window_sentence(model, seed, 5, tokenizer)
+                                                            for seed in seeds]
@@ -0,0 +1,37 @@
+import json
+import sys
+from os import path, symlink
+
+import keras
+
+import training
+from sampled_softmax import CUSTOM_OBJECTS
+from training_checkpoint import TrainingCheckpoint
+
+DATA_PATH = path.join(path.dirname(path.dirname(path.abspath(__file__))), "data")
+
+
+def run_training(monkeypatch, *args):
+    monkeypatch.setattr(sys, "argv", ["training.py"] + list(args))
+    training.main()
+    with open(path.join("checkpoints", TrainingCheckpoint.STATE_FILE), encoding="utf-8") as state_file:
+        state = json.load(state_file)
+    model = keras.models.load_model(path.join("checkpoints", TrainingCheckpoint.CHECKPOINT_FILE),
+                                    custom_objects=CUSTOM_OBJECTS)
+    return state, int(model.optimizer.iterations.numpy())
+
+
+# Train for two epochs, then resume the run for a third one: the epoch count and the optimizer state carry on
+def test_resume_continues_the_run(tmp_path, monkeypatch):
+    # training.py reads data/ and writes its tokenizer to the working directory
+    monkeypatch.chdir(tmp_path)
+    symlink(DATA_PATH, "data")
+    state, iterations = run_training(monkeypatch, "-n", "2", "-e", "2", "--every", "1", "-s", "1", "-c",
+                                     "checkpoints", "-o", "model.h5")
+    assert state["epoch"] == 2 and iterations > 0
+    resumed_state, resumed_iterations = run_training(monkeypatch, "-r", "-c", "checkpoints", "-e", "3")
+    assert resumed_state["epoch"] == 3
+    assert resumed_state["run_info"]["files"] == state["run_info"]["files"]
+    # One more epoch of the same number of steps on top of the restored optimizer
+    assert resumed_iterations == iterations * 3 // 2
+    assert path.exists("model.h5")
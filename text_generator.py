@@ -0,0 +1,92 @@
+import numpy
+from keras.models import Sequential
+from keras.layers import Dense
+from keras.layers import LSTM
+from keras.layers import Embedding
+from keras.layers import Input
+from instrumentation import traced
+
+
+# Class to generate text with a trained NNModel one word at a time
+# The trained weights are copied into a stateful model that reads a single word per step, so the LSTM keeps its hidden
+# state between steps and every new word costs one step instead of a pass over the whole window
+# Many sentences are generated at once as the rows of one batch
+class TextGenerator:
+    def __init__(self, nn_model, tokenizer):
+        self.trained_model = nn_model.model
+        self.input_length = nn_model.get_input_length()
+        embedding, lstm, dense = self.trained_model.layers
+        self.vocab_size = dense.units
+        self.projection_size = embedding.output_dim
+        self.hidden_layer_size = lstm.units
+        self.tokenizer = tokenizer
+        # Index -> word array so sampled indices are converted to words with a single lookup
+        self.index_word = numpy.array([tokenizer.index_word.get(i, "") for i in range(self.vocab_size)], dtype=object)
+        self.step_models = {}  # Batch size -> stateful model, stateful models have a fixed batch size
+
+    # Return the stateful single step model for a batch size, building it on first use
+    def step_model(self, batch_size):
+        if batch_size not in self.step_models:
+            # An Input layer fixes the batch size, newer keras versions don't take batch_input_shape
+            model = Sequential()
+            model.add(Input(batch_shape=(batch_size, 1)))
+            model.add(Embedding(self.vocab_size, self.projection_size))
+            model.add(LSTM(self.hidden_layer_size, stateful=True))
+            model.add(Dense(self.vocab_size, activation='softmax'))
+            model.set_weights(self.trained_model.get_weights())
+            self.step_models[batch_size] = model
+        return self.step_models[batch_size]
+
+    # Pick the next word index for every row of probabilities
+    # top_k keeps only the k most likely words, temperature < 1 sharpens and > 1 flattens the distribution
+    # A temperature of 0 or top_k of 1 always picks the most likely word
+    @staticmethod
+    def sample(probabilities, rng, temperature=1.0, top_k=None):
+        probabilities = numpy.array(probabilities, dtype=numpy.float64)
+        probabilities[:, 0] = 0  # Index 0 is padding, not a word
+        if temperature == 0 or top_k == 1:
+            return numpy.argmax(probabilities, axis=1)
+        if top_k:
+            cutoff = -numpy.partition(-probabilities, top_k - 1, axis=1)[:, top_k - 1:top_k]
+            probabilities[probabilities < cutoff] = 0
+        if temperature != 1.0:
+            probabilities = numpy.power(probabilities, 1.0 / temperature)
+        # Draw from (0, total] and pick the first word whose cumulative probability reaches the draw
+        cumulative = numpy.cumsum(probabilities, axis=1)
+        draws = (1.0 - rng.random((len(probabilities), 1))) * cumulative[:, -1:]
+        return numpy.minimum(numpy.sum(cumulative < draws, axis=1), probabilities.shape[1] - 1)
+
+    # Generate length words following each of the seed texts, returns the seed texts with the words appended
+    # The state carries the whole text, including the padding the seeds were primed with, so from the second word on
+    # the predictions differ from those of the trained model on the last input_length words, see generate_window
+    @traced
+    def generate(self, seed_texts, length, temperature=1.0, top_k=None, seed=None):
+        rng = numpy.random.default_rng(seed)
+        model = self.step_model(len(seed_texts))
+        # The LSTM holds the state, newer keras versions only reset states on layers
+        model.layers[1].reset_states()
+        # Prime the hidden state with the padded seeds, the same input the trained model would have seen
+        sequences = self.tokenizer.texts_to_array(seed_texts, maxlen=self.input_length)
+        for step in range(self.input_length):
+            probabilities = model.predict_on_batch(sequences[:, step:step + 1])
+        generated = numpy.zeros((len(seed_texts), length), dtype=numpy.int64)
+        for step in range(length):
+            generated[:, step] = self.sample(probabilities, rng, temperature, top_k)
+            if step < length - 1:
+                probabilities = model.predict_on_batch(generated[:, step:step + 1])
+        words = self.index_word[generated]
+        return [" ".join([seed_text] + list(row)) for seed_text, row in zip(seed_texts, words)]
+
+    # Same as generate, but every word is predicted by the trained model from the last input_length words of the text
+    # so far, padded like during training, as NNModel.generate_sentence always did. Each word costs a pass over the
+    # whole window instead of a single step, still for all seed texts at once
+    @traced
+    def generate_window(self, seed_texts, length, temperature=1.0, top_k=None, seed=None):
+        rng = numpy.random.default_rng(seed)
+        texts = list(seed_texts)
+        for _ in range(length):
+            sequences = self.tokenizer.texts_to_array(texts, maxlen=self.input_length)
+            probabilities = self.trained_model.predict(sequences, batch_size=len(texts), verbose=0)
+            words = self.index_word[self.sample(probabilities, rng, temperature, top_k)]
+            texts = [text + " " + word for text, word in zip(texts, words)]
+        return texts
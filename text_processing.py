@@ -0,0 +1,33 @@
+# Text cleaning and word splitting shared by the DataInterpreter, the corpus cache and its worker processes
+# Kept free of keras imports so worker processes start quickly
+
+# Characters the keras Tokenizer filters out by default
+KERAS_FILTERS = '!"#$%&()*+,-./:;<=>?@[\\]^_`{|}~\t\n'
+# utf8 curly quotes, the tokenizer removes most punctuation but not these
+CURLY_QUOTES = str.maketrans("", "", u"\u201c\u201d\u2018\u2019")
+# Translation table mapping every keras filter character to a space
+FILTER_TABLE = str.maketrans(KERAS_FILTERS, " " * len(KERAS_FILTERS))
+
+
+# Remove utf8 curly quotes from text data
+def clean_text(txtdata):
+    return txtdata.translate(CURLY_QUOTES)
+
+
+# Split text into words exactly like keras' text_to_word_sequence
+def text_to_words(text, filters=KERAS_FILTERS, lower=True, split=" "):
+    if lower:
+        text = text.lower()
+    if filters == KERAS_FILTERS and split == " ":
+        text = text.translate(FILTER_TABLE)
+    else:
+        text = text.translate(str.maketrans({char: split for char in filters}))
+    return [word for word in text.split(split) if word]
+
+
+# Read a text file, clean it and split every line into words
+# Used by the corpus cache worker processes
+def read_file_words(file):
+    with open(file, "r", encoding="utf8") as datafile:
+        txtdata = clean_text(datafile.read())
+    return [text_to_words(line) for line in txtdata.split("\n")]
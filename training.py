@@ -1,44 +1,301 @@
+import sys
+import getopt
+import random
 from json import dumps
-from os import environ
+from os import environ, path, cpu_count
 # This will stop tensorflow from spamming unnecessary error messages about its GPU implementation
 # Needs to set before we import anything from keras/tensorflow
 environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
+import numpy
 from data_interpreter import DataInterpreter
-from nn_model import NNModel
-from keras.utils import to_categorical
-
-
-# Number of files to use for training
-n_files = 51
-
-# Create the DataInterpreter
-data_interp = DataInterpreter()
-# Read data files as a string
-txtdata = data_interp.read_text_files(data_interp.training_files, n_files, sample_data=True)
-# Simplify text files by replacing similar words, ignore words that appear less often than min_freq
-# Using n_files/2 as the min_freq is a rule of thumb I determined empirically to keep the training time reasonable
-txtdata = data_interp.simplify_text_data(txtdata, min_freq=n_files/2)
-# Set the number of words to keep based on the number of words that appear more often min_feq
-vocab = data_interp.set_num_words(txtdata, min_freq=n_files/2)
-vocab_size = len(vocab) + 1
-# Convert the data to sequences of integers with some maximum length
-max_length, sequences = data_interp.training_data_to_padded_sequences(txtdata, max_len=15, shuffle_data=True)
-# Break up the sequences into input (sequence of n words) and output (single word to test against)
-input_data, output = sequences[:, :-1], sequences[:, -1]
-output = to_categorical(output, num_classes=vocab_size)
-
-# Save the tokenizer for later use, in case we randomized the training data
-# If the training data was randomized we will need to know the words and word_index later for testing
-tokenizer_json = data_interp.tokenizer.to_json()
-with open("./tokenizer_%s_file_training.json" % n_files, "w", encoding="utf-8") as jsonf:
-    jsonf.write(dumps(tokenizer_json, ensure_ascii=False))
-
-# Prepare the model
-model = NNModel()
-# Input layer should have max_length - 1 neurons, output layer should have one neuron per word token
-# Hidden layer size determined by the 2/3*(input layer + output layer) rule of thumb
-model.prepare_model(max_length - 1, vocab_size, hidden_layer_size=int((vocab_size + max_length - 1)*2/3))
-# Fit on training data
-model.fit_model(input_data, output)
-# Save model, can be loaded later for testing without re-training
-model.save_model("./model_%s_file_training.h5" % str(n_files))
\ No newline at end of file
+from fast_tokenizer import FastTokenizer
+# The model, checkpoint and prefix sequence modules import keras and tensorflow, they are imported once the options
+# have been parsed so -h and bad options answer immediately
+from instrumentation import enable_tracing, TRACE_ENV
+
+
+# Stream shuffled batches of prefixes with integer targets instead of materializing every prefix and a one-hot matrix
+# Peak memory then only depends on the size of the token stream, not on the number of prefixes times the vocabulary
+streaming = True
+# Read the training files through the tokenized corpus cache in ./cache/corpus/ instead of parsing the text every run
+# Only supported together with streaming
+use_corpus_cache = True
+# Longest chunk of a sentence used for training, the input layer has max_len - 1 neurons
+max_len = 15
+# Tokenizer used by --warmstart unless --tokenizer is given
+TOKENIZER_PATH = "./tokenizer_51_file_training.vocab"
+
+
+def print_help():
+    print("Usage:")
+    print("python training.py [-n <n_files>] [-e <epochs>] [-b <batch_size>] [-v <validation_frac>] [-p <patience>]")
+    print("       [-c <checkpoint_dir>] [--every <epochs>] [-o <output>] [-s <seed>] [-m <min_freq>]")
+    print("       [--sampled <num_sampled>] [--hidden <size>] [--threads <threads>] [--trace <file>]")
+    print("python training.py -w <model> [-t <tokenizer>] [options] <data_file> [<data_file> ...]")
+    print("python training.py -r [-c <checkpoint_dir>] [-e <epochs>] [--trace <file>]")
+    print("Where")
+    print("<n_files> is the number of data files to train on, sampled from the training files (default 51)")
+    print("<epochs> is the number of epochs to train for (default 500)")
+    print("<batch_size> is the number of prefixes per training batch (default 32)")
+    print("<validation_frac> holds out this fraction of the sentences to measure the validation loss (default 0)")
+    print("<patience> stops training once the validation loss hasn't improved for this many epochs and keeps the")
+    print("           model of the best epoch, needs -v")
+    print("<checkpoint_dir> is where the model, its optimizer state and the run are saved (default cache/checkpoints)")
+    print("--every <epochs> saves a checkpoint every this many epochs (default 10), and always at the end")
+    print("<output> is the file the final model is saved to (default ./model_<n_files>_file_training.h5)")
+    print("<seed> seeds the file sample, the shuffling and the validation split")
+    print("<min_freq> keeps the words appearing more often than this in the vocabulary (default <n_files>/2)")
+    print("--sampled <num_sampled> trains with a sampled softmax over <num_sampled> words per step instead of the full")
+    print("          softmax, so training time no longer grows with the vocabulary, e.g. with -m 0")
+    print("--hidden <size> sets the size of the LSTM layer, by default 2/3 of the input and output layer sizes")
+    print("--threads <threads> runs every training step on <threads> tensorflow threads (0 for one per core) with a")
+    print("          batch of <threads> x <batch_size> prefixes, and the learning rate grows with sqrt(<threads>)")
+    print("          this is a larger batch on more threads, not data parallel training on model replicas")
+    print("          without --threads tensorflow picks its own number of threads and the batch isn't scaled")
+    print("-r resumes the run saved in <checkpoint_dir> from its latest checkpoint, with the same files and settings")
+    print("   -e can raise the number of epochs of the resumed run")
+    print("-w fine-tunes an existing <model> on the given data files, e.g. files added since it was trained")
+    print("   <tokenizer> is the vocabulary the model was trained with (default %s)" % TOKENIZER_PATH)
+    print("   it isn't changed so the fine-tuned model works with it, words outside of it are dropped")
+    print("   <output> defaults to <model>_warmstart.h5")
+    print("--trace <file> writes a timing trace of the run to <file> and prints a summary, as does setting %s=<file>"
+          % TRACE_ENV)
+
+
+# Read the training files, fit the tokenizer of data_interp on them and build the training data
+# Returns max_length, the vocabulary size, the input data and the outputs, which are None when the input data is a
+# PrefixSequence yielding batches of inputs and integer targets
+def prepare_data(data_interp, files, batch_size, seed, min_freq=None):
+    from prefix_sequence import PrefixSequence
+    # Using n_files/2 as the min_freq is a rule of thumb I determined empirically to keep the training time reasonable
+    if min_freq is None:
+        min_freq = len(files) / 2
+    if use_corpus_cache:
+        # Same steps as below on integer tokens, files only have to be parsed the first time they are used
+        tokens, vocabulary = data_interp.read_token_files(files)
+        tokens = data_interp.simplify_token_data(tokens, vocabulary, min_freq=min_freq)
+        vocab = data_interp.set_num_words_from_tokens(tokens, vocabulary, min_freq=min_freq)
+        max_length, tokens, targets = data_interp.training_tokens_to_token_stream(tokens, vocabulary, max_len=max_len)
+        return max_length, len(vocab) + 1, PrefixSequence(tokens, targets, max_length - 1, batch_size, seed=seed), None
+    # Read data files as a string
+    txtdata = data_interp.read_text_files(files)
+    # Simplify text files by replacing similar words, ignore words that appear less often than min_freq
+    txtdata = data_interp.simplify_text_data(txtdata, min_freq=min_freq)
+    # Set the number of words to keep based on the number of words that appear more often min_feq
+    vocab = data_interp.set_num_words(txtdata, min_freq=min_freq)
+    if streaming:
+        # Convert the data to a stream of integers, prefixes with some maximum length are built batch by batch
+        max_length, tokens, targets = data_interp.training_data_to_token_stream(txtdata, max_len=max_len)
+        return max_length, len(vocab) + 1, PrefixSequence(tokens, targets, max_length - 1, batch_size, seed=seed), None
+    # Convert the data to sequences of integers with some maximum length
+    max_length, sequences = data_interp.training_data_to_padded_sequences(txtdata, max_len=max_len, shuffle_data=True)
+    # Break up the sequences into input (sequence of n words) and output (single word to test against)
+    from keras.utils import to_categorical
+    output = to_categorical(sequences[:, -1], num_classes=len(vocab) + 1)
+    return max_length, len(vocab) + 1, sequences[:, :-1], output
+
+
+# Read new data files with the vocabulary of an existing tokenizer, to fine-tune a model trained with it
+# The files are simplified like testing data and words outside the vocabulary are dropped, as texts_to_sequences
+# would, so the input and output layers of the model still match the tokenizer
+def prepare_warm_start_data(data_interp, files, input_length, batch_size, seed):
+    from prefix_sequence import PrefixSequence
+    tokens, vocabulary = data_interp.read_token_files(files)
+    tokens = data_interp.simplify_token_data_with_tokenizer(tokens, vocabulary, data_interp.tokenizer)
+    _, tokens, targets = data_interp.sequences_to_token_stream(data_interp.tokens_to_sequences(tokens, vocabulary),
+                                                               max_len=input_length + 1)
+    return PrefixSequence(tokens, targets, input_length, batch_size, seed=seed)
+
+
+# Hold out validation_frac of the training data, returns the training data and the validation data
+def split_validation(input_data, output, validation_frac, seed):
+    if not validation_frac:
+        return input_data, output, None
+    if output is None:
+        input_data, validation = input_data.split(validation_frac, seed)
+        return input_data, None, validation
+    # The padded sequences are already shuffled, hold out the last rows
+    n_train = len(input_data) - int(len(input_data) * validation_frac)
+    return input_data[:n_train], output[:n_train], (input_data[n_train:], output[n_train:])
+
+
+def main():
+    # Retrieve arguments, print help() if that fails
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hn:e:b:v:p:c:o:s:rw:t:m:",
+                                   ["help", "nfiles=", "epochs=", "batchsize=", "validation=", "patience=",
+                                    "checkpointdir=", "every=", "output=", "seed=", "resume", "warmstart=",
+                                    "tokenizer=", "minfreq=", "sampled=", "hidden=", "threads=", "trace="])
+    except getopt.GetoptError:
+        print_help()
+        sys.exit(2)
+    # Settings of the run, saved with every checkpoint so -r can rebuild the same training data
+    run_info = {"n_files": 51, "epochs": 500, "batch_size": 32, "validation_frac": 0.0, "patience": None,
+                "every": 10, "output": None, "seed": None, "warm_start": None, "tokenizer": TOKENIZER_PATH,
+                "files": None, "min_freq": None, "num_sampled": None, "hidden_size": None, "threads": None}
+    checkpoint_dir = "./cache/checkpoints/"
+    resume = False
+    epochs = None
+    trace_path = None
+    for opt, arg in opts:
+        if opt in ("-h", "--help"):
+            print_help()
+            sys.exit()
+        elif opt in ("-n", "--nfiles", "-e", "--epochs", "-b", "--batchsize", "-p", "--patience", "--every",
+                     "-s", "--seed", "-m", "--minfreq", "--sampled", "--hidden", "--threads"):
+            try:
+                value = int(arg)
+            except ValueError:
+                print("%s %s couldn't be converted to an int. \n" % (opt, arg))
+                print_help()
+                sys.exit(2)
+            if value < 0 or (value == 0 and opt not in ("-s", "--seed", "-p", "--patience", "-m", "--minfreq",
+                                                       "--threads")):
+                print("%s %s should be a positive integer. \n" % (opt, arg))
+                print_help()
+                sys.exit(2)
+            if opt in ("-n", "--nfiles"):
+                run_info["n_files"] = value
+            elif opt in ("-e", "--epochs"):
+                epochs = value
+            elif opt in ("-b", "--batchsize"):
+                run_info["batch_size"] = value
+            elif opt in ("-p", "--patience"):
+                run_info["patience"] = value
+            elif opt == "--every":
+                run_info["every"] = value
+            elif opt in ("-m", "--minfreq"):
+                run_info["min_freq"] = value
+            elif opt == "--sampled":
+                run_info["num_sampled"] = value
+            elif opt == "--hidden":
+                run_info["hidden_size"] = value
+            elif opt == "--threads":
+                run_info["threads"] = value or cpu_count()
+            else:
+                run_info["seed"] = value
+        elif opt in ("-v", "--validation"):
+            try:
+                run_info["validation_frac"] = float(arg)
+            except ValueError:
+                print("--validation %s couldn't be converted to a float. \n" % arg)
+                print_help()
+                sys.exit(2)
+            if not 0 <= run_info["validation_frac"] < 1:
+                print("--validation %s should be at least 0 and less than 1. \n" % arg)
+                print_help()
+                sys.exit(2)
+        elif opt in ("-c", "--checkpointdir"):
+            checkpoint_dir = arg
+        elif opt in ("-o", "--output"):
+            run_info["output"] = arg
+        elif opt in ("-r", "--resume"):
+            resume = True
+        elif opt in ("-w", "--warmstart"):
+            run_info["warm_start"] = arg
+        elif opt in ("-t", "--tokenizer"):
+            run_info["tokenizer"] = arg
+        elif opt == "--trace":
+            trace_path = arg
+    # Time the run if --trace or the LV_TRACE environment variable was given
+    enable_tracing(trace_path)
+    from nn_model import NNModel, configure_threads
+    from training_checkpoint import TrainingCheckpoint
+
+    state = None
+    if resume:
+        state = TrainingCheckpoint.load_state(checkpoint_dir)
+        if state is None:
+            print("No checkpoint found in %s, nothing to resume. \n" % checkpoint_dir)
+            print_help()
+            sys.exit(2)
+        # The resumed run keeps its own settings, only the number of epochs can be changed
+        run_info = state["run_info"]
+        run_info["epochs"] = epochs or run_info["epochs"]
+        print("Resuming from epoch %d of %d in %s" % (state["epoch"], run_info["epochs"], checkpoint_dir))
+    else:
+        run_info["epochs"] = epochs or run_info["epochs"]
+        if run_info["patience"] is not None and not run_info["validation_frac"]:
+            print("--patience needs a validation split, set one with -v. \n")
+            print_help()
+            sys.exit(2)
+        if run_info["warm_start"] and not args:
+            print("--warmstart needs the data files to fine-tune on. \n")
+            print_help()
+            sys.exit(2)
+        # Draw a seed once, so a resumed run holds out the same validation data
+        if run_info["seed"] is None:
+            run_info["seed"] = int(numpy.random.SeedSequence().entropy % (1 << 32))
+    random.seed(run_info["seed"])
+    seed = run_info["seed"]
+    # With --threads tensorflow splits the work of each step over that many threads, which only pays off with
+    # correspondingly larger batches. There is still a single model, so this is large batch training rather than data
+    # parallel training. The adam learning rate is scaled by the square root of the batch size increase, the default
+    # learning rate being 0.001
+    # Without --threads tensorflow keeps its own thread pools, which already use every core, and the batch is unchanged
+    batch_size = run_info["batch_size"]
+    learning_rate = None
+    threads = run_info.get("threads")
+    if threads:
+        configure_threads(threads)
+        batch_size *= threads
+        learning_rate = 0.001 * threads ** 0.5 if threads > 1 else None
+
+    # Create the DataInterpreter
+    data_interp = DataInterpreter()
+    model = NNModel()
+    if run_info["warm_start"]:
+        # Fine-tune an existing model on new files, keeping the vocabulary it was trained with
+        data_interp.tokenizer = FastTokenizer.load(run_info["tokenizer"])
+        run_info["files"] = run_info["files"] or args
+        model.load_model(run_info["warm_start"])
+        input_data = prepare_warm_start_data(data_interp, run_info["files"], model.get_input_length(), batch_size,
+                                             seed)
+        output = None
+        if not state:
+            # The streamed targets are integers, the optimizer starts from scratch
+            if run_info["num_sampled"]:
+                model.use_sampled_softmax(run_info["num_sampled"], learning_rate)
+            else:
+                model.compile_model(sparse_targets=True, learning_rate=learning_rate)
+        run_info["output"] = run_info["output"] or path.splitext(run_info["warm_start"])[0] + "_warmstart.h5"
+    else:
+        # Sample the training files once, a resumed run reads the same ones
+        run_info["files"] = run_info["files"] or data_interp.select_files(data_interp.training_files,
+                                                                          run_info["n_files"], sample_data=True)
+        max_length, vocab_size, input_data, output = prepare_data(data_interp, run_info["files"], batch_size, seed,
+                                                                  run_info["min_freq"])
+        # Save the tokenizer for later use, in case we randomized the training data
+        # If the training data was randomized we will need to know the words and word_index later for testing
+        tokenizer_json = data_interp.tokenizer.to_json()
+        with open("./tokenizer_%s_file_training.json" % run_info["n_files"], "w", encoding="utf-8") as jsonf:
+            jsonf.write(dumps(tokenizer_json, ensure_ascii=False))
+        # Compact binary copy of the vocabulary, this is what testing.py and accuracy_assessment.py load
+        data_interp.tokenizer.save("./tokenizer_%s_file_training.vocab" % run_info["n_files"])
+        if not state:
+            # Input layer should have max_length - 1 neurons, output layer should have one neuron per word token
+            # Hidden layer size determined by the 2/3*(input layer + output layer) rule of thumb unless given
+            hidden_layer_size = run_info["hidden_size"] or int((vocab_size + max_length - 1)*2/3)
+            model.prepare_model(max_length - 1, vocab_size, hidden_layer_size=hidden_layer_size,
+                                sparse_targets=output is None, num_sampled=run_info["num_sampled"],
+                                learning_rate=learning_rate)
+        run_info["output"] = run_info["output"] or "./model_%s_file_training.h5" % run_info["n_files"]
+    if state:
+        # The checkpoint holds the model together with its optimizer state
+        model.load_model(state["checkpoint"])
+    input_data, output, validation_data = split_validation(input_data, output, run_info["validation_frac"], seed)
+
+    checkpoint = TrainingCheckpoint(checkpoint_dir, every=run_info["every"], patience=run_info["patience"],
+                                    run_info=run_info, state=state)
+    # A run that already stopped early only restores its best model
+    epochs = checkpoint.epoch if checkpoint.stopped else run_info["epochs"]
+    # Fit on training data
+    model.fit_model(input_data, output, epochs=epochs, batch_size=batch_size, validation_data=validation_data,
+                    checkpoint=checkpoint, initial_epoch=checkpoint.epoch)
+    # Save model, can be loaded later for testing without re-training
+    model.save_model(run_info["output"])
+    print("Model saved to %s" % run_info["output"])
+
+
+if __name__ == "__main__":
+    main()
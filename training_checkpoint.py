@@ -0,0 +1,93 @@
+import json
+from os import path, makedirs, replace
+
+import keras
+from keras.callbacks import Callback
+
+
+# Keras callback that saves the model, including its optimizer state, every few epochs together with what is needed to
+# resume the run: the number of epochs done, the early stopping progress and run_info, a dictionary describing the
+# training data (the files trained on, the validation seed, ...) so a resumed run can rebuild exactly the same data
+# With patience, training stops once the monitored validation loss hasn't improved for that many epochs and the
+# weights of the best epoch are restored at the end of training. The best weights are kept in their own file so early
+# stopping carries on across a restart
+# Files in checkpoint_dir: checkpoint.keras (last saved model), best.weights.h5 (weights of the best epoch), state.json
+# Keras 3 only restores the optimizer state from its native .keras format, older versions save checkpoint.h5 instead
+class TrainingCheckpoint(Callback):
+    STATE_FILE = "state.json"
+    CHECKPOINT_FILE = "checkpoint.keras" if int(keras.__version__.split(".")[0]) >= 3 else "checkpoint.h5"
+    BEST_FILE = "best.weights.h5"
+
+    def __init__(self, checkpoint_dir="./cache/checkpoints/", every=10, patience=None, monitor="val_loss",
+                 min_delta=0.0, run_info=None, state=None):
+        super().__init__()
+        self.checkpoint_dir = checkpoint_dir
+        self.every = every  # Save a checkpoint every this many epochs, and always at the end of training
+        self.patience = patience  # None disables early stopping
+        self.monitor = monitor
+        self.min_delta = min_delta
+        # A state from load_state continues the early stopping progress of the run being resumed
+        state = state or {}
+        self.run_info = run_info if run_info is not None else state.get("run_info", {})
+        self.epoch = state.get("epoch", 0)
+        self.best = state.get("best")
+        self.best_epoch = state.get("best_epoch")
+        self.wait = state.get("wait", 0)
+        self.stopped = state.get("stopped", False)
+        self.saved_epoch = self.epoch
+        makedirs(checkpoint_dir, exist_ok=True)
+
+    def file_path(self, name):
+        return path.join(self.checkpoint_dir, name)
+
+    # State saved with the latest checkpoint in checkpoint_dir, or None if there is no checkpoint
+    @classmethod
+    def load_state(cls, checkpoint_dir="./cache/checkpoints/"):
+        state_path = path.join(checkpoint_dir, cls.STATE_FILE)
+        if not path.exists(state_path):
+            return None
+        with open(state_path, "r", encoding="utf-8") as state_file:
+            state = json.load(state_file)
+        state["checkpoint"] = path.join(checkpoint_dir, cls.CHECKPOINT_FILE)
+        return state
+
+    # Save the model and then the state, each written to a temporary file first so a crash while saving leaves the
+    # previous checkpoint intact
+    def save(self):
+        checkpoint_path = self.file_path(self.CHECKPOINT_FILE)
+        # Keras picks the file format from the extension, so it has to stay at the end of the temporary name
+        temporary_path = "%s.tmp%s" % path.splitext(checkpoint_path)
+        self.model.save(temporary_path)
+        replace(temporary_path, checkpoint_path)
+        state = {"epoch": self.epoch, "best": self.best, "best_epoch": self.best_epoch, "wait": self.wait,
+                 "stopped": self.stopped, "run_info": self.run_info}
+        state_path = self.file_path(self.STATE_FILE)
+        with open(state_path + ".tmp", "w", encoding="utf-8") as state_file:
+            json.dump(state, state_file, ensure_ascii=False, indent=1)
+        replace(state_path + ".tmp", state_path)
+        self.saved_epoch = self.epoch
+
+    def on_epoch_end(self, epoch, logs=None):
+        self.epoch = epoch + 1
+        value = (logs or {}).get(self.monitor)
+        if self.patience is not None and value is not None:
+            if self.best is None or value < self.best - self.min_delta:
+                self.best, self.best_epoch, self.wait = float(value), self.epoch, 0
+                self.model.save_weights(self.file_path(self.BEST_FILE))
+            else:
+                self.wait += 1
+                if self.wait >= self.patience:
+                    print("Early stopping after epoch %d, %s hasn't improved since epoch %d (%g)"
+                          % (self.epoch, self.monitor, self.best_epoch, self.best))
+                    self.stopped = True
+                    self.model.stop_training = True
+        if self.epoch % self.every == 0 or self.stopped:
+            self.save()
+
+    def on_train_end(self, logs=None):
+        if self.epoch != self.saved_epoch:
+            self.save()
+        # The checkpoint keeps the last epoch so a resumed run continues from there, the model returns the best one
+        if self.patience is not None and self.best_epoch is not None and self.best_epoch != self.epoch:
+            print("Restoring the weights of epoch %d, %s %g" % (self.best_epoch, self.monitor, self.best))
+            self.model.load_weights(self.file_path(self.BEST_FILE))
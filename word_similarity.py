@@ -0,0 +1,65 @@
+from collections import defaultdict
+from itertools import combinations
+
+from instrumentation import traced
+
+
+# Class to find pairs of similar words without comparing every pair in the vocabulary
+# Two words within Levenstein's distance k of each other always share a string obtained by deleting at most k
+# characters from each of them, so words are indexed by these deletion variants and only words sharing a variant are
+# compared, using an edit distance that gives up as soon as the distance is known to exceed k
+class WordSimilarityIndex:
+    def __init__(self, words, min_dist=2):
+        self.words = list(words)  # Words sorted by how often they appear, most frequent first
+        self.max_dist = min_dist - 1  # Pairs are considered similar if their distance is less than min_dist
+        self.variants = defaultdict(list)  # Deletion variant -> ranks of the words that produce it
+        if self.max_dist > 0:
+            for rank, word in enumerate(self.words):
+                for variant in self.deletion_variants(word, self.max_dist):
+                    self.variants[variant].append(rank)
+
+    # All strings obtained by deleting up to max_deletions characters from word, including word itself
+    @staticmethod
+    def deletion_variants(word, max_deletions):
+        variants = {word}
+        current = {word}
+        for _ in range(max_deletions):
+            current = {w[:i] + w[i + 1:] for w in current for i in range(len(w))}
+            variants |= current
+        return variants
+
+    # Levenstein's distance between a and b (same costs as nltk's edit_distance without transpositions)
+    # Returns max_dist + 1 as soon as the distance is known to be larger than max_dist
+    @staticmethod
+    def edit_distance(a, b, max_dist):
+        if abs(len(a) - len(b)) > max_dist:
+            return max_dist + 1
+        previous = list(range(len(b) + 1))
+        for i, char_a in enumerate(a, 1):
+            current = [i]
+            for j, char_b in enumerate(b, 1):
+                current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char_a != char_b)))
+            if min(current) > max_dist:
+                return max_dist + 1
+            previous = current
+        return min(previous[-1], max_dist + 1)
+
+    # Return the (rank, rank) pairs of similar words, in the order itertools.combinations would produce them
+    def similar_pairs(self):
+        candidates = set()
+        for ranks in self.variants.values():
+            candidates.update(combinations(sorted(set(ranks)), 2))
+        return sorted(pair for pair in candidates
+                      if self.edit_distance(self.words[pair[0]], self.words[pair[1]], self.max_dist) <= self.max_dist)
+
+    # Map each word that should be replaced to the word replacing it
+    # Pairs are visited from most to least frequent and a pair is skipped if either word was already replaced,
+    # the less frequent word of the pair is replaced by the more frequent one
+    @traced
+    def merge_map(self):
+        merges = {}
+        for first, second in self.similar_pairs():
+            if self.words[first] in merges or self.words[second] in merges:
+                continue
+            merges[self.words[second]] = self.words[first]
+        return merges